@@ -0,0 +1,116 @@
+# Benchmark: NDJSON (pandas) vs typed Parquet (DuckDB) landing files for load-all-data
+#
+# Generates a synthetic netflix_countries history, writes it both ways and times the raw-table
+# load of each path against a local DuckDB database, each in a fresh process started through the
+# suite's launcher (pipeline_suite.run_measured) so peak RSS is the load's own, not this process's.
+#
+#   python benchmarks/landing_format.py --rows 500000
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pipeline_suite import run_measured
+
+# same schema as extract-top10 writes for netflix_countries
+schema = pa.schema([
+    ('country_name', pa.string()), ('country_code', pa.string()), ('week', pa.timestamp('us')),
+    ('category', pa.string()), ('weekly_rank', pa.int32()), ('show_title', pa.string()),
+    ('season_title', pa.string()), ('cumulative_weeks_in_top_10', pa.int32())
+])
+
+def generate_rows(n_rows, seed=42):
+    """Synthetic netflix_countries rows: 94 countries x 4 categories x 10 ranks per week"""
+    rng = random.Random(seed)
+    countries = [(f"Country {i}", f"C{i:02d}") for i in range(94)]
+    categories = ['Films', 'TV', 'Films (English)', 'TV (English)']
+    titles = [f"Title {i}" for i in range(5000)]
+    week = datetime.datetime(2021, 7, 4)
+    rows = []
+    while len(rows) < n_rows:
+        for country_name, country_code in countries:
+            for category in categories:
+                for rank in range(1, 11):
+                    title = rng.choice(titles)
+                    rows.append({
+                        'country_name': country_name,
+                        'country_code': country_code,
+                        'week': week.strftime('%Y-%m-%d'),
+                        'category': category,
+                        'weekly_rank': rank,
+                        'show_title': title,
+                        'season_title': f"{title}: Season {rng.randint(1, 5)}" if category.startswith('TV') else None,
+                        'cumulative_weeks_in_top_10': rng.randint(1, 30)
+                    })
+        week += datetime.timedelta(days=7)
+    return rows[:n_rows]
+
+def write_files(rows, directory):
+    ndjson_path = os.path.join(directory, 'netflix_countries.json')
+    with open(ndjson_path, 'w') as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+
+    parquet_path = os.path.join(directory, 'netflix_countries.parquet')
+    typed = [dict(row, week=datetime.datetime.fromisoformat(row['week'])) for row in rows]
+    pq.write_table(pa.Table.from_pylist(typed, schema=schema), parquet_path, compression='zstd')
+    return ndjson_path, parquet_path
+
+def load(path_kind, path, db_path):
+    """One load path, as load-all-data runs it (called in a child process)"""
+    import duckdb
+
+    md = duckdb.connect(db_path)
+    start = time.perf_counter()
+    if path_kind == 'ndjson':
+        import io
+        import pandas as pd
+        with open(path) as f:
+            json_data = f.read()
+        json_df = pd.read_json(io.StringIO(json_data), lines=True)
+        md.sql("CREATE OR REPLACE TABLE netflix_countries AS SELECT * FROM json_df")
+    else:
+        md.sql(f"CREATE OR REPLACE TABLE netflix_countries AS SELECT * FROM read_parquet('{path}')")
+    seconds = time.perf_counter() - start
+    rows = md.sql("SELECT COUNT(*) FROM netflix_countries").fetchone()[0]
+    print(json.dumps({
+        'path': path_kind,
+        'rows': rows,
+        'seconds': round(seconds, 3)
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description="NDJSON vs Parquet landing file load benchmark")
+    parser.add_argument('--rows', type=int, default=500000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        ndjson_path, parquet_path = write_files(generate_rows(args.rows), directory)
+        results = {
+            'rows': args.rows,
+            'file_mb': {
+                'ndjson': round(os.path.getsize(ndjson_path) / 2**20, 1),
+                'parquet': round(os.path.getsize(parquet_path) / 2**20, 1)
+            },
+            'loads': []
+        }
+        for path_kind, path in (('ndjson', ndjson_path), ('parquet', parquet_path)):
+            lines, peak_rss_mb = run_measured(
+                [sys.executable, os.path.abspath(__file__), '--load', path_kind, path, os.path.join(directory, f'{path_kind}.duckdb')]
+            )
+            results['loads'].append(dict(json.loads(lines[-1]), peak_rss_mb=peak_rss_mb))
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == '--load':
+        load(sys.argv[2], sys.argv[3], sys.argv[4])
+    else:
+        main()
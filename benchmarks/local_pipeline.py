@@ -0,0 +1,139 @@
+# Offline end-to-end run of the ELT + ML pipeline against a local DuckDB file
+#
+# Runs the Cloud Functions in-process in local mode (DUCKDB_PATH / LOCAL_BUCKET_DIR): schema setup,
+# extract, load-all-data, the ML view and both trainers, and reports the time of every step.
+# Extraction is replaced by fixture job files (<dataset>.json, .json.gz or .parquet) staged into the
+# local bucket like an extractor would write them, unless --extract calls the real extractors.
+#
+#   python benchmarks/local_pipeline.py --fixtures path/to/fixtures --workdir /tmp/ba882-local
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import resource
+import shutil
+import sys
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the bucket the extractors write to and the load reads from
+bucket_name = 'ba882-team05'
+datasets = ['netflix_api', 'youtube_api', 'youtube_stats', 'netflix_global', 'netflix_countries', 'netflix_most_popular']
+
+# function sources (the serving functions are imported by the benchmark suite)
+function_paths = {
+    'schema-netflix': 'functions/schema-netflix/main.py',
+    'schema-top10': 'functions/schema-top10/main.py',
+    'schema-youtube': 'functions/schema-youtube/main.py',
+    'ml-schema-setup': 'ml/pipeline/functions/schema-setup/main.py',
+    'extract-netflix': 'functions/extract-netflix/main.py',
+    'extract-top10': 'functions/extract-top10/main.py',
+    'extract-youtube': 'functions/extract-youtube/main.py',
+    'load-all-data': 'functions/load-all-data/main.py',
+    'netflix-api-ml': 'prefect/functions/netflix-api-ml/main.py',
+    'movies-trainer': 'ml/pipeline/functions/movies-trainer/main.py',
+    'shows-trainer': 'ml/pipeline/functions/shows-trainer/main.py',
+    'movies-knn-train': 'ml/functions/movies-knn-train/main.py',
+    'shows-knn-train': 'ml/functions/shows-knn-train/main.py',
+    'movies-knn-serve': 'ml/functions/movies-knn-serve/main.py',
+    'shows-knn-serve': 'ml/functions/shows-knn-serve/main.py'
+}
+pipeline_steps = ['schema-netflix', 'schema-top10', 'schema-youtube', 'ml-schema-setup', 'load-all-data',
+                  'netflix-api-ml', 'movies-trainer', 'shows-trainer']
+
+class Request:
+    """The part of the Flask request the functions read"""
+    def __init__(self, payload=None):
+        self.payload = payload or {}
+
+    def get_json(self, silent=False):
+        return self.payload
+
+def load_function(name):
+    """Import a function's main.py under its own module name (every function has a main.py)"""
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(ROOT, function_paths[name]))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def stage_fixtures(fixtures_dir, bucket_dir):
+    """Copy each fixture job file into the local bucket as a new job and point the dataset manifest at it"""
+    job_id = datetime.datetime.now().strftime("%Y%m%d%H%M") + "-" + str(uuid.uuid4())
+    paths = {}
+    for file_name in sorted(os.listdir(fixtures_dir)):
+        dataset, _, extension = file_name.partition('.')
+        if dataset not in datasets or extension not in ('json', 'json.gz', 'parquet'):
+            continue
+        blob_name = f"jobs/{dataset}/{job_id}/{file_name}"
+        os.makedirs(os.path.join(bucket_dir, os.path.dirname(blob_name)), exist_ok=True)
+        shutil.copyfile(os.path.join(fixtures_dir, file_name), os.path.join(bucket_dir, blob_name))
+        paths[dataset] = f"gs://{bucket_name}/{blob_name}"
+        with open(os.path.join(bucket_dir, f"jobs/{dataset}/latest.json"), 'w') as f:
+            json.dump({'job_id': job_id, 'blob_name': blob_name, 'filepath': paths[dataset]}, f)
+    return paths
+
+def run_step(timings, step, call):
+    start = time.perf_counter()
+    result = call()
+    timings.append({'step': step, 'seconds': round(time.perf_counter() - start, 3)})
+    print(f"{step}: {timings[-1]['seconds']}s")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end pipeline run against a local DuckDB file")
+    parser.add_argument('--workdir', default='/tmp/ba882-local', help="holds ba882_project.duckdb and the local bucket")
+    parser.add_argument('--fixtures', help="directory of fixture job files named after their dataset")
+    parser.add_argument('--extract', action='store_true', help="call the real extractors (needs network and API keys)")
+    parser.add_argument('--fresh', action='store_true', help="start from an empty database and bucket")
+    args = parser.parse_args()
+    if not args.fixtures and not args.extract:
+        parser.error("pass --fixtures or --extract")
+
+    # Local mode must be configured before the functions are imported
+    if args.fresh and os.path.exists(args.workdir):
+        shutil.rmtree(args.workdir)
+    os.makedirs(os.path.join(args.workdir, 'gcs'), exist_ok=True)
+    os.environ['DUCKDB_PATH'] = os.path.join(args.workdir, 'ba882_project.duckdb')
+    os.environ['LOCAL_BUCKET_DIR'] = os.path.join(args.workdir, 'gcs')
+
+    timings = []
+    start = time.perf_counter()
+    functions = {name: run_step(timings, f"import {name}", lambda name=name: load_function(name))
+                 for name in pipeline_steps + (['extract-netflix', 'extract-top10', 'extract-youtube'] if args.extract else [])}
+
+    for name in ('schema-netflix', 'schema-top10', 'schema-youtube', 'ml-schema-setup'):
+        run_step(timings, name, lambda name=name: functions[name].task(Request()))
+
+    if args.extract:
+        extracted = {name: run_step(timings, name, lambda name=name: functions[name].main(Request())[0])
+                     for name in ('extract-netflix', 'extract-top10', 'extract-youtube')}
+        paths = {'netflix_api': extracted['extract-netflix'].get('filepath'),
+                 'youtube_api': extracted['extract-youtube'].get('filepath')}
+        for dataset, result in extracted['extract-top10'].get('results', {}).items():
+            paths[dataset] = result.get('filepath')
+    else:
+        paths = run_step(timings, 'stage fixtures', lambda: stage_fixtures(args.fixtures, os.path.join(os.environ['LOCAL_BUCKET_DIR'], bucket_name)))
+
+    load_result, status = run_step(timings, 'load-all-data', lambda: functions['load-all-data'].main(Request({'paths': paths})))
+    if status != 200:
+        print(json.dumps(load_result, indent=2))
+        sys.exit(1)
+
+    run_step(timings, 'netflix-api-ml', lambda: functions['netflix-api-ml'].task(Request()))
+    for name in ('movies-trainer', 'shows-trainer'):
+        run_step(timings, name, lambda name=name: functions[name].task(Request()))
+
+    print(json.dumps({
+        'workdir': args.workdir,
+        'steps': timings,
+        'load': load_result['datasets'],
+        'total_seconds': round(time.perf_counter() - start, 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+# End-to-end pipeline benchmark suite
+#
+# For every size, generates a synthetic dataset (benchmarks/synthetic_data.py), stages it as job files
+# in a local bucket and runs each stage of the pipeline against local stand-ins (DUCKDB_PATH and
+# LOCAL_BUCKET_DIR, see benchmarks/local_pipeline.py):
+#
+#   process_dataset   load-all-data's load of each job file into its stage table
+#   trainers          fit + metrics of the mlops movies/shows trainers
+#   knn_train         fit of the serving bundles
+#   knn_serve         kneighbors serving: catalog titles, unseen payloads and one batch request
+#   streamlit_sql     the SQL of the Streamlit apps
+#
+# Every stage runs in a fresh process, started through a small launcher process so its peak RSS is its
+# own (see run_measured). The results (throughput,
+# latency percentiles, peak memory) are written to one JSON artifact that can be diffed between commits.
+#
+#   python benchmarks/pipeline_suite.py --sizes 10000 100000 1000000 --output pipeline_suite.json
+
+import argparse
+import ast
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from local_pipeline import ROOT, Request, bucket_name, load_function, stage_fixtures
+from synthetic_data import generate_all
+
+# stages in the order they depend on each other
+stages = ['schema', 'process_dataset', 'ml_view', 'trainers', 'knn_train', 'knn_serve', 'streamlit_sql']
+loaded_datasets = ['netflix_api', 'netflix_global', 'netflix_countries', 'netflix_most_popular', 'youtube_api']
+streamlit_apps = ['reporting/streamlit/netflix-dashboard.py', 'reporting/streamlit/netflix-recommendations.py']
+
+##################################################### helpers
+
+def summarize(seconds):
+    """Latency percentiles of a list of durations, in milliseconds"""
+    ms = np.asarray(seconds) * 1000
+    return {
+        'n': len(ms),
+        'mean': round(float(ms.mean()), 3),
+        'p50': round(float(np.percentile(ms, 50)), 3),
+        'p95': round(float(np.percentile(ms, 95)), 3),
+        'p99': round(float(np.percentile(ms, 99)), 3),
+        'max': round(float(ms.max()), 3)
+    }
+
+def timed(call, repeat):
+    """Run call repeat times with the functions' prints silenced; returns (durations, last result)"""
+    durations = []
+    result = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = call()
+            durations.append(time.perf_counter() - start)
+    return durations, result
+
+def record(stage, name, durations, rows=None, unit='rows/s', **extra):
+    latency = summarize(durations)
+    result = {'stage': stage, 'name': name, 'latency_ms': latency}
+    if rows is not None:
+        result['rows'] = rows
+        result['throughput'] = round(rows / (latency['p50'] / 1000), 1) if latency['p50'] else None
+        result['throughput_unit'] = unit
+    result.update(extra)
+    return result
+
+# ru_maxrss carries over from the process that forks the child (and across exec), so a stage spawned
+# straight from the suite would report the suite's own peak. A launcher that imports next to nothing
+# spawns the command instead and reports the peak of its children (RUSAGE_CHILDREN) as its last line.
+LAUNCHER = (
+    "import json, resource, subprocess, sys; "
+    "child = subprocess.run(sys.argv[1:]); "
+    "print(json.dumps({'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)})); "
+    "sys.exit(child.returncode)"
+)
+
+def run_measured(command, env=None):
+    """Run a command in a fresh process; returns its output lines and its peak RSS in MB"""
+    output = subprocess.run([sys.executable, '-c', LAUNCHER] + command, check=True, capture_output=True, text=True, env=env).stdout
+    lines = output.strip().splitlines()
+    return lines[:-1], json.loads(lines[-1])['peak_rss_mb']
+
+def warehouse():
+    import duckdb
+    return duckdb.connect(os.environ['DUCKDB_PATH'])
+
+def streamlit_queries(path, namespace):
+    """
+    The SQL an app runs: every assignment to query / *_query that is passed to an .execute() call,
+    with its parameter names. f-string queries are rendered with the values in namespace.
+    """
+    tree = ast.parse(open(os.path.join(ROOT, path)).read())
+    queries = []
+    current = {}
+
+    class Visitor(ast.NodeVisitor):
+        def visit_Assign(self, node):
+            self.generic_visit(node)
+            target = node.targets[0]
+            if isinstance(target, ast.Name) and (target.id == 'query' or target.id.endswith('_query')):
+                try:
+                    current[target.id] = eval(compile(ast.Expression(node.value), path, 'eval'), dict(namespace))
+                except Exception:
+                    current[target.id] = None
+
+        def visit_Call(self, node):
+            self.generic_visit(node)
+            if isinstance(node.func, ast.Attribute) and node.func.attr == 'execute' and node.args and isinstance(node.args[0], ast.Name):
+                params = [arg.id for arg in node.args[1].elts] if len(node.args) > 1 and isinstance(node.args[1], ast.List) else []
+                sql = current.get(node.args[0].id)
+                if sql:
+                    queries.append({'name': f"{os.path.basename(path)}:{node.lineno}", 'sql': sql, 'params': params})
+
+    Visitor().visit(tree)
+    return queries
+
+##################################################### stages (each runs in its own process)
+
+def run_schema(args):
+    results = []
+    for name in ('schema-netflix', 'schema-top10', 'schema-youtube', 'ml-schema-setup'):
+        module = load_function(name)
+        durations, _ = timed(lambda: module.task(Request()), 1)
+        results.append(record('schema', name, durations))
+    return results
+
+def run_process_dataset(args):
+    module = load_function('load-all-data')
+    md = module.connect_warehouse()
+    md.sql(f"CREATE SCHEMA IF NOT EXISTS {module.raw_db_schema}")
+    pool = module.connection_pool(md, 1)
+    json_path = module.get_latest_job_file(bucket_name, args.dataset)
+
+    def load():
+        # every repetition loads the whole file into an empty stage table
+        md.sql(f"DELETE FROM {module.stage_db_schema}.{args.dataset}")
+        return module.process_dataset(pool, args.dataset, json_path, {})
+
+    durations, result = timed(load, args.repeat)
+    return [record('process_dataset', args.dataset, durations, rows=result['raw_rows'],
+                   download_s=result['download_s'], load_s=result['load_s'])]
+
+def run_ml_view(args):
+    module = load_function('netflix-api-ml')
+    durations, _ = timed(lambda: module.task(Request()), 1)
+    return [record('ml_view', 'netflix-api-ml', durations)]
+
+def run_trainers(args):
+    md = warehouse()
+    catalog = dict(md.sql("SELECT showType, COUNT(*) FROM ba882_project.stage.netflix_api GROUP BY 1").fetchall())
+    md.close()
+    results = []
+    for name, show_type in (('movies-trainer', 'movie'), ('shows-trainer', 'series')):
+        module = load_function(name)
+        durations, _ = timed(lambda: module.task(Request()), args.repeat)
+        results.append(record('trainers', name, durations, rows=catalog.get(show_type, 0)))
+    return results
+
+def run_knn_train(args):
+    md = warehouse()
+    catalog = dict(md.sql("SELECT showType, COUNT(*) FROM ba882_project.stage.netflix_api GROUP BY 1").fetchall())
+    md.close()
+    results = []
+    for name, show_type in (('movies-knn-train', 'movie'), ('shows-knn-train', 'series')):
+        module = load_function(name)
+        durations, _ = timed(lambda: module.main(Request()), args.repeat)
+        results.append(record('knn_train', name, durations, rows=catalog.get(show_type, 0)))
+    return results
+
+def run_knn_serve(args):
+    name, show_type = {'movies': ('movies-knn-serve', 'movie'), 'shows': ('shows-knn-serve', 'series')}[args.dataset]
+    md = warehouse()
+    catalog = md.sql(f"""
+        SELECT title, CAST(genres AS VARCHAR) AS genres, CAST("cast" AS VARCHAR) AS "cast",
+               CAST(directors AS VARCHAR) AS directors, overview, episodeCount, seasonCount
+        FROM ba882_project.stage.netflix_api WHERE showType = '{show_type}'
+        USING SAMPLE {args.queries} ROWS (reservoir, 42)
+    """).df()
+    md.close()
+    payloads = [{key: (None if value != value else value) for key, value in row.items()} for row in catalog.to_dict('records')]
+    unseen = [dict(payload, title=f"Unseen {i}") for i, payload in enumerate(payloads)]
+
+    # import = cold start (bundle mapping and index setup)
+    durations, module = timed(lambda: load_function(name), 1)
+    results = [record('knn_serve', f"{name} cold start", durations)]
+    for kind, items in (('catalog title', payloads), ('unseen payload', unseen)):
+        latencies = []
+        for item in items:
+            latencies.extend(timed(lambda: module.main(Request({'data': [item]})), 1)[0])
+        results.append(record('knn_serve', f"{name} {kind}", latencies, rows=len(items), unit='requests/s'))
+    durations, _ = timed(lambda: module.main(Request({'data': payloads + unseen})), args.repeat)
+    results.append(record('knn_serve', f"{name} batch of {len(payloads + unseen)}", durations,
+                          rows=len(payloads + unseen), unit='titles/s'))
+    return results
+
+def run_streamlit_sql(args):
+    md = warehouse()
+    sample = md.sql("""
+        SELECT c.country_name, c.show_title
+        FROM ba882_project.stage.netflix_countries c
+        INNER JOIN ba882_project.stage.netflix_global g ON c.show_title = g.show_title
+        LIMIT 1
+    """).fetchone()
+    titles = [row[0] for row in md.sql("SELECT title FROM ba882_project.stage.netflix_api LIMIT 10").fetchall()]
+    params = {'selected_country': sample[0], 'selected_show': sample[1]}
+    namespace = {
+        'language_type': 'English',
+        'db_schema': 'ba882_project.stage',
+        'title_list_str': ", ".join(f"'{title}'" for title in titles)
+    }
+    results = []
+    for path in streamlit_apps:
+        for query in streamlit_queries(path, namespace):
+            values = [params[param] for param in query['params']]
+            durations, result = timed(lambda: md.execute(query['sql'], values).df(), args.repeat)
+            results.append(record('streamlit_sql', query['name'], durations, result_rows=len(result)))
+    md.close()
+    return results
+
+stage_runners = {
+    'schema': run_schema,
+    'process_dataset': run_process_dataset,
+    'ml_view': run_ml_view,
+    'trainers': run_trainers,
+    'knn_train': run_knn_train,
+    'knn_serve': run_knn_serve,
+    'streamlit_sql': run_streamlit_sql
+}
+
+def run_stage(args):
+    """Child process: run one stage and print its results as the last line of output"""
+    print(json.dumps(stage_runners[args.stage](args)))
+
+##################################################### suite
+
+def spawn(stage, workdir, args, dataset=None):
+    command = [sys.executable, os.path.abspath(__file__), '--stage', stage, '--workdir', workdir,
+               '--repeat', str(args.repeat), '--queries', str(args.queries)]
+    if dataset:
+        command += ['--dataset', dataset]
+    env = dict(os.environ,
+               DUCKDB_PATH=os.path.join(workdir, 'ba882_project.duckdb'),
+               LOCAL_BUCKET_DIR=os.path.join(workdir, 'gcs'))
+    lines, peak_rss_mb = run_measured(command, env)
+    results = json.loads(lines[-1])
+    for result in results:
+        result['peak_rss_mb'] = peak_rss_mb
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(args):
+    import duckdb
+    import sklearn
+
+    workroot = args.workdir or tempfile.mkdtemp(prefix='ba882-bench-')
+    artifact = {
+        'commit': git_commit(),
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'duckdb': duckdb.__version__,
+            'numpy': np.__version__,
+            'sklearn': sklearn.__version__
+        },
+        'config': {'sizes': args.sizes, 'catalog_rows': args.catalog_rows, 'format': args.format,
+                   'repeat': args.repeat, 'queries': args.queries, 'until': args.until},
+        'results': []
+    }
+
+    for size in args.sizes:
+        workdir = os.path.join(workroot, str(size))
+        os.makedirs(os.path.join(workdir, 'gcs'), exist_ok=True)
+
+        start = time.perf_counter()
+        fixtures, rows = generate_all(os.path.join(workdir, 'fixtures'), size, args.format, args.catalog_rows)
+        stage_fixtures(os.path.join(workdir, 'fixtures'), os.path.join(workdir, 'gcs', bucket_name))
+        artifact['results'].append(dict(record('generate', 'synthetic_data', [time.perf_counter() - start],
+                                               rows=sum(rows.values())), size=size, dataset_rows=rows))
+
+        # every stage needs the ones before it
+        for stage in stages[:stages.index(args.until) + 1]:
+            if stage == 'process_dataset':
+                runs = [spawn(stage, workdir, args, dataset) for dataset in loaded_datasets]
+            elif stage == 'knn_serve':
+                runs = [spawn(stage, workdir, args, dataset) for dataset in ('movies', 'shows')]
+            else:
+                runs = [spawn(stage, workdir, args)]
+            for results in runs:
+                for result in results:
+                    result['size'] = size
+                    artifact['results'].append(result)
+                    print(f"[{size}] {result['stage']} {result['name']}: p50 {result['latency_ms']['p50']}ms"
+                          + (f", {result['throughput']} {result['throughput_unit']}" if 'throughput' in result else '')
+                          + f", peak {result['peak_rss_mb']}MB")
+
+    with open(args.output, 'w') as f:
+        json.dump(artifact, f, indent=2)
+    print(f"Wrote {args.output}")
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark suite on synthetic data")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000], help="rows per dataset (10k-10M)")
+    parser.add_argument('--catalog-rows', type=int, default=20000, help="cap on the netflix_api catalog (trainers are quadratic in it)")
+    parser.add_argument('--format', choices=['parquet', 'ndjson'], default='parquet', help="job file format")
+    parser.add_argument('--repeat', type=int, default=3, help="repetitions per measurement")
+    parser.add_argument('--queries', type=int, default=100, help="serving requests per kind")
+    parser.add_argument('--until', choices=stages, default=stages[-1], help="last stage to run")
+    parser.add_argument('--workdir', help="keeps the generated data (default: a temporary directory)")
+    parser.add_argument('--output', default='pipeline_suite.json')
+    # child process mode
+    parser.add_argument('--stage', choices=stages, help=argparse.SUPPRESS)
+    parser.add_argument('--dataset', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        run_stage(args)
+    else:
+        run_suite(args)
+
+if __name__ == "__main__":
+    main()
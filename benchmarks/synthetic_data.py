@@ -0,0 +1,159 @@
+# Synthetic job files in the schemas the extractors write
+#
+# netflix_api, netflix_global, netflix_countries, netflix_most_popular and youtube_api rows at any
+# size, generated by DuckDB straight into Parquet or NDJSON (no rows in Python, so 10M-row files stay
+# cheap). The Top 10 files reference titles of the generated catalog, so the dashboard joins match.
+#
+#   python benchmarks/synthetic_data.py --rows 100000 --out /tmp/fixtures
+#   python benchmarks/local_pipeline.py --fixtures /tmp/fixtures
+
+import argparse
+import os
+
+import duckdb
+
+# Top 10 lists: every week has 10 ranks for each category (and country)
+categories = ['Films (English)', 'Films (Non-English)', 'TV (English)', 'TV (Non-English)']
+n_countries = 94
+words = ['dark', 'family', 'crime', 'love', 'war', 'space', 'comedy', 'secret', 'city', 'island', 'murder', 'school',
+         'royal', 'heist', 'ghost', 'king', 'ocean', 'future', 'small', 'town', 'detective', 'dragon', 'music', 'sport']
+genres = ['Drama', 'Comedy', 'Action', 'Thriller', 'Documentary', 'Horror', 'Romance', 'Animation', 'Crime', 'Sci-Fi']
+
+def pick(values, hash_sql):
+    """SQL expression picking one of values by a hash"""
+    return "[" + ", ".join(f"'{value}'" for value in values) + f"][1 + ({hash_sql} % {len(values)})::BIGINT]"
+
+# One SELECT per dataset over range(n) AS t(i), in the column order and types of the job files;
+# {catalog} is the number of netflix_api titles the Top 10 rows pick from
+dataset_sql = {
+    'netflix_api': f"""
+        SELECT
+            'show' AS itemType
+            ,CASE WHEN i % 2 = 0 THEN 'movie' ELSE 'series' END AS showType
+            ,i + 1 AS id
+            ,'tt' || (1000000 + i) AS imdbId
+            ,CASE WHEN i % 2 = 0 THEN 'movie/' ELSE 'tv/' END || i AS tmdbId
+            ,'Title ' || i AS title
+            ,array_to_string(list_transform(range(15), x -> {pick(words, 'hash(i, x)')}), ' ') AS overview
+            ,(1980 + i % 45)::DOUBLE AS releaseYear
+            ,'Title ' || i AS originalTitle
+            ,list_transform(range(1 + i % 3), x -> struct_pack(id := lower({pick(genres, "hash(i, x, 'g')")}),
+                                                               name := {pick(genres, "hash(i, x, 'g')")})) AS genres
+            ,['Director ' || (hash(i, 'd') % 2000)] AS directors
+            ,list_transform(range(4), x -> 'Actor ' || (hash(i, x, 'c') % 20000)) AS "cast"
+            ,(30 + hash(i, 'r') % 70)::BIGINT AS rating
+            ,CASE WHEN i % 2 = 0 THEN (80 + hash(i, 'rt') % 80)::DOUBLE END AS runtime
+            ,(1980 + i % 45)::BIGINT AS year
+            ,CASE WHEN i % 2 = 1 THEN (1990 + i % 35)::DOUBLE END AS firstAirYear
+            ,CASE WHEN i % 2 = 1 THEN (1990 + i % 35 + hash(i, 'l') % 6)::DOUBLE END AS lastAirYear
+            ,CASE WHEN i % 2 = 1 THEN ['Creator ' || (hash(i, 'cr') % 1000)] END AS creators
+            ,CASE WHEN i % 2 = 1 THEN (1 + hash(i, 's') % 8)::DOUBLE END AS seasonCount
+            ,CASE WHEN i % 2 = 1 THEN (6 + hash(i, 'e') % 90)::DOUBLE END AS episodeCount
+        FROM range({{n}}) AS t(i)
+    """,
+    'netflix_global': f"""
+        SELECT
+            TIMESTAMP '2021-07-04' + INTERVAL (i // 40 * 7) DAY AS week
+            ,{pick(categories, 'i // 10')} AS category
+            ,(i % 10 + 1)::BIGINT AS weekly_rank
+            ,'Title ' || (hash(i // 40, i % 40) % {{catalog}}) AS show_title
+            ,CASE WHEN (i // 10) % 4 >= 2 THEN 'Season ' || (1 + hash(i, 's') % 5) END AS season_title
+            ,(100000 + hash(i, 'h') % 50000000)::BIGINT AS weekly_hours_viewed
+            ,(1 + hash(i, 'rt') % 30) / 10.0 AS runtime
+            ,(10000 + hash(i, 'v') % 20000000)::DOUBLE AS weekly_views
+            ,(1 + hash(i, 'w') % 30)::BIGINT AS cumulative_weeks_in_top_10
+            ,hash(i, 'st') % 10 = 0 AS is_staggered_launch
+            ,NULL::VARCHAR AS episode_launch_details
+        FROM range({{n}}) AS t(i)
+    """,
+    # the country lists only have the Films and TV categories: 20 rows per country and week
+    'netflix_countries': f"""
+        SELECT
+            'Country ' || ((i // 20) % {n_countries}) AS country_name
+            ,'C' || lpad(((i // 20) % {n_countries})::VARCHAR, 2, '0') AS country_iso2
+            ,TIMESTAMP '2021-07-04' + INTERVAL (i // {20 * n_countries} * 7) DAY AS week
+            ,CASE WHEN (i // 10) % 2 = 0 THEN 'Films' ELSE 'TV' END AS category
+            ,(i % 10 + 1)::INTEGER AS weekly_rank
+            ,'Title ' || (hash(i // 20, i % 20) % {{catalog}}) AS show_title
+            ,CASE WHEN (i // 10) % 2 = 1 THEN 'Season ' || (1 + hash(i, 's') % 5) END AS season_title
+            ,(1 + hash(i, 'w') % 30)::INTEGER AS cumulative_weeks_in_top_10
+        FROM range({{n}}) AS t(i)
+    """,
+    'netflix_most_popular': f"""
+        SELECT
+            {pick(categories, 'i // 10')} AS category
+            ,(i % 10 + 1)::INTEGER AS rank
+            ,'Title ' || (hash(i, 'p') % {{catalog}}) AS show_title
+            ,CASE WHEN (i // 10) % 4 >= 2 THEN 'Season ' || (1 + hash(i, 's') % 5) END AS season_title
+            ,(1000000 + hash(i, 'h') % 900000000)::BIGINT AS hours_viewed_first_91_days
+            ,(1 + hash(i, 'rt') % 30) / 10.0 AS runtime
+            ,(100000 + hash(i, 'v') % 300000000)::BIGINT AS views_first_91_days
+            ,DATE '2024-01-02' AS extraction_date
+        FROM range({{n}}) AS t(i)
+    """,
+    'youtube_api': f"""
+        SELECT
+            'vid' || lpad(i::VARCHAR, 8, '0') AS video_id
+            ,'Title ' || (hash(i, 't') % {{catalog}}) || ' | Official Trailer | Netflix' AS title
+            ,'Title ' || (hash(i, 't') % {{catalog}}) AS extracted_title
+            ,array_to_string(list_transform(range(30), x -> {pick(words, 'hash(i, x)')}), ' ') AS description
+            ,'Film & Animation' AS category
+            ,TIMESTAMP '2015-01-01' + INTERVAL (i * 37) MINUTE AS published_at
+            ,(hash(i, 'v') % 50000000)::BIGINT AS views
+            ,(hash(i, 'l') % 500000)::BIGINT AS likes
+            ,0::BIGINT AS favorites
+            ,(hash(i, 'c') % 20000)::BIGINT AS comments_count
+            ,list_transform(range(3), x -> 'comment ' || hash(i, x, 'cm') % 1000) AS comments
+            ,'https://i.ytimg.com/vi/vid' || lpad(i::VARCHAR, 8, '0') || '/hqdefault.jpg' AS thumbnail_url
+            ,TIMESTAMP '1970-01-01' + INTERVAL (30 + hash(i, 'd') % 300) SECOND AS overall_time
+            ,0::BIGINT AS hours
+            ,((30 + hash(i, 'd') % 300) // 60)::BIGINT AS minutes
+            ,((30 + hash(i, 'd') % 300) % 60)::BIGINT AS seconds
+        FROM range({{n}}) AS t(i)
+    """
+}
+
+def generate(dataset, n_rows, path, file_format='parquet', catalog=None):
+    """Write n_rows synthetic rows of a dataset to path as Parquet (zstd) or NDJSON; returns path"""
+    sql = dataset_sql[dataset].format(n=int(n_rows), catalog=int(catalog or n_rows))
+    options = "FORMAT PARQUET, COMPRESSION ZSTD" if file_format == 'parquet' else "FORMAT JSON"
+    con = duckdb.connect()
+    con.sql("SET TimeZone = 'UTC'")
+    con.sql(f"COPY ({sql}) TO '{path}' ({options})")
+    con.close()
+    return path
+
+def generate_all(directory, n_rows, file_format='parquet', catalog_rows=None, most_popular_rows=40):
+    """
+    One job file per dataset in a directory, named like the extractors name them. netflix_api gets
+    catalog_rows rows (the trainers' metrics are quadratic in the catalog), the weekly files n_rows.
+    """
+    catalog_rows = min(n_rows, catalog_rows or n_rows)
+    sizes = {
+        'netflix_api': catalog_rows,
+        'netflix_global': n_rows,
+        'netflix_countries': n_rows,
+        'netflix_most_popular': most_popular_rows,
+        'youtube_api': n_rows
+    }
+    extension = 'parquet' if file_format == 'parquet' else 'json'
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for dataset, rows in sizes.items():
+        paths[dataset] = generate(dataset, rows, os.path.join(directory, f"{dataset}.{extension}"), file_format, catalog=catalog_rows)
+    return paths, sizes
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic job files in the extractor schemas")
+    parser.add_argument('--rows', type=int, default=100000, help="rows of the weekly and youtube files")
+    parser.add_argument('--catalog-rows', type=int, default=None, help="rows of netflix_api (default: --rows)")
+    parser.add_argument('--format', choices=['parquet', 'ndjson'], default='parquet')
+    parser.add_argument('--out', required=True)
+    args = parser.parse_args()
+
+    paths, sizes = generate_all(args.out, args.rows, args.format, args.catalog_rows)
+    for dataset, path in paths.items():
+        print(f"{dataset}: {sizes[dataset]} rows, {os.path.getsize(path) / 2**20:.1f}MB -> {path}")
+
+if __name__ == "__main__":
+    main()
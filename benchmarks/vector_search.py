@@ -0,0 +1,127 @@
+# Query latency and recall of the local vector index (genai/pipeline/functions/ingestor/vector_store.py)
+#
+# Fills a LocalVectorIndex with synthetic 768-d chunk embeddings (clustered like text embeddings are:
+# every title's chunks sit around the title's direction, titles around a few topics) and measures
+# exact search against the IVF index at several n_probe values: single-query and batched latency
+# percentiles, and recall@k of the ANN results against the exact ones. Results go to a JSON artifact.
+#
+#   python benchmarks/vector_search.py --sizes 20000 100000 --output vector_search.json
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from pipeline_suite import git_commit, summarize
+from local_pipeline import ROOT
+
+spec = importlib.util.spec_from_file_location('vector_store', os.path.join(ROOT, 'genai/pipeline/functions/ingestor/vector_store.py'))
+vector_store = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(vector_store)
+
+DIMENSION = 768
+
+def synthetic_chunks(n_chunks, n_topics=50, chunks_per_title=3, seed=42):
+    """Unit vectors of n_chunks chunks: topic + title + chunk noise, with their metadata"""
+    rng = np.random.default_rng(seed)
+    n_titles = -(-n_chunks // chunks_per_title)
+    topics = vector_store.normalize(rng.normal(size=(n_topics, DIMENSION)))
+    titles = vector_store.normalize(topics[rng.integers(n_topics, size=n_titles)] + 0.8 * vector_store.normalize(rng.normal(size=(n_titles, DIMENSION))))
+    title_of = np.arange(n_chunks) // chunks_per_title
+    vectors = vector_store.normalize(titles[title_of] + 0.5 * vector_store.normalize(rng.normal(size=(n_chunks, DIMENSION))))
+    metadata = [{'title': f"Title {t}", 'content_id': str(t), 'chunk_index': int(i % chunks_per_title),
+                 'content_type': 'movie' if t % 2 == 0 else 'show', 'chunk_text': ''} for i, t in enumerate(title_of)]
+    return vectors, metadata, titles
+
+def fill_index(directory, vectors, metadata, batch_size=5000):
+    index = vector_store.LocalVectorIndex(directory, dimension=DIMENSION)
+    for start in range(0, len(vectors), batch_size):
+        index.upsert([{'id': f"{m['content_id']}_{m['chunk_index']}", 'values': v, 'metadata': m}
+                      for v, m in zip(vectors[start:start + batch_size], metadata[start:start + batch_size])])
+    return index
+
+def timed_queries(index, queries, top_k, batch, **kwargs):
+    """Latency of every call (one query or one batch per call) and the matches of every query"""
+    durations, results = [], []
+    for start in range(0, len(queries), batch):
+        t = time.perf_counter()
+        results.extend(index.query_batch(queries[start:start + batch], top_k, **kwargs))
+        durations.append(time.perf_counter() - t)
+    return durations, results
+
+def recall(results, truth):
+    ids = [[match['id'] for match in result['matches']] for result in results]
+    true_ids = [[match['id'] for match in result['matches']] for result in truth]
+    return round(float(np.mean([len(set(a) & set(b)) / max(1, len(b)) for a, b in zip(ids, true_ids)])), 4)
+
+def run_size(size, args, workdir):
+    vectors, metadata, titles = synthetic_chunks(size)
+    # queries: a title's direction plus noise (a free-text query close to some titles)
+    rng = np.random.default_rng(7)
+    queries = vector_store.normalize(titles[rng.integers(len(titles), size=args.queries)] + 0.7 * vector_store.normalize(rng.normal(size=(args.queries, DIMENSION))))
+
+    directory = os.path.join(workdir, str(size))
+    shutil.rmtree(directory, ignore_errors=True)
+    start = time.perf_counter()
+    index = fill_index(directory, vectors, metadata)
+    results = [{'size': size, 'name': 'upsert', 'seconds': round(time.perf_counter() - start, 3),
+                'vectors_per_second': round(size / (time.perf_counter() - start), 1)}]
+
+    def record(name, durations, batch, matches, truth, **extra):
+        results.append(dict({'size': size, 'name': name, 'batch': batch, 'latency_ms': summarize(durations),
+                             'queries_per_second': round(len(matches) / sum(durations), 1),
+                             'recall_at_k': recall(matches, truth)}, **extra))
+        print(f"[{size}] {name} batch {batch}: p50 {results[-1]['latency_ms']['p50']}ms, "
+              f"recall@{args.top_k} {results[-1]['recall_at_k']}")
+
+    # exact search is the ground truth
+    exact_durations, truth = timed_queries(index, queries, args.top_k, 1, exact=True)
+    record('exact', exact_durations, 1, truth, truth)
+    durations, matches = timed_queries(index, queries, args.top_k, args.batch, exact=True)
+    record('exact', durations, args.batch, matches, truth)
+    durations, matches = timed_queries(index, queries, args.top_k, 1, exact=True, filter={'content_type': 'movie'})
+    record('exact filtered', durations, 1, matches, matches)
+
+    start = time.perf_counter()
+    n_lists = index.build_ann_index()
+    results.append({'size': size, 'name': 'build_ann_index', 'seconds': round(time.perf_counter() - start, 3), 'n_lists': n_lists})
+    for n_probe in args.n_probe:
+        index.n_probe = n_probe
+        durations, matches = timed_queries(index, queries, args.top_k, 1)
+        record(f"ivf n_probe={n_probe}", durations, 1, matches, truth, n_lists=n_lists, n_probe=n_probe)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency and recall of the local vector index, exact vs IVF")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20000, 100000], help="number of chunk vectors")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=32, help="queries per batched call")
+    parser.add_argument('--n-probe', type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument('--workdir', help="keeps the indexes (default: a temporary directory)")
+    parser.add_argument('--output', default='vector_search.json')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ba882-vectors-')
+    artifact = {
+        'commit': git_commit(),
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count(), 'numpy': np.__version__},
+        'config': {'sizes': args.sizes, 'queries': args.queries, 'top_k': args.top_k,
+                   'batch': args.batch, 'n_probe': args.n_probe},
+        'results': [result for size in args.sizes for result in run_size(size, args, workdir)]
+    }
+    with open(args.output, 'w') as f:
+        json.dump(artifact, f, indent=2)
+    print(f"Wrote {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,98 @@
 import requests
-import pandas as pd
 import time
 from datetime import datetime
+import datetime as dt
 import uuid
 from google.cloud import storage
+from google.api_core.exceptions import NotFound
 import json
-from io import BytesIO
+import gzip
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
 import functions_framework
 
 # Storage client
-storage_client = storage.Client()
+# Local mode for offline runs: LOCAL_BUCKET_DIR is a directory standing in for GCS, every bucket is
+# a sub-directory and every blob a file under it
+LOCAL_BUCKET_DIR = os.environ.get('LOCAL_BUCKET_DIR')
+
+class LocalBlob:
+    """A file standing in for a GCS blob (the part of the Blob API the functions use)"""
+    def __init__(self, bucket_dir, name):
+        self.name = name
+        self.path = os.path.join(bucket_dir, name)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def delete(self):
+        if not self.exists():
+            raise NotFound(f"No such object: {self.name}")
+        os.remove(self.path)
+
+    def open(self, mode, **kwargs):
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return open(self.path, mode)
+
+    def upload_from_string(self, data, content_type=None):
+        with self.open('wb') as f:
+            f.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+    def download_as_bytes(self):
+        if not self.exists():
+            raise NotFound(f"No such object: {self.name}")
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def download_as_text(self):
+        return self.download_as_bytes().decode('utf-8')
+
+    def download_to_filename(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.download_as_bytes())
+
+class LocalBucket:
+    def __init__(self, bucket_dir):
+        self.bucket_dir = bucket_dir
+
+    def blob(self, name):
+        return LocalBlob(self.bucket_dir, name)
+
+    def list_blobs(self, prefix=''):
+        names = []
+        for root, _, files in os.walk(self.bucket_dir):
+            for file in files:
+                name = os.path.relpath(os.path.join(root, file), self.bucket_dir).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    names.append(name)
+        return [self.blob(name) for name in sorted(names)]
+
+class LocalStorageClient:
+    def bucket(self, bucket_name):
+        return LocalBucket(os.path.join(LOCAL_BUCKET_DIR, bucket_name))
+
+# storage client
+storage_client = LocalStorageClient() if LOCAL_BUCKET_DIR else storage.Client()
 
 # Storage bucket
 bucket_name = "ba882-team05"
 
+# Backfill checkpoints: gs://{bucket_name}/{CHECKPOINT_PREFIX}/{backfill_id}/{year}/ holds one
+# page-NNNNN.json per fetched page and cursor.json with the cursor to resume from
+CHECKPOINT_PREFIX = "checkpoints/netflix_api"
+
+# Stop starting new pages after this many seconds, so the function returns (and can be resumed)
+# before its 540s timeout
+TIME_BUDGET_SECONDS = 480
+
+# Pacing between requests, adapted from the rate limit headers of each response
+MIN_DELAY_SECONDS = 0.2
+MAX_DELAY_SECONDS = 30
+MAX_RETRIES = 5
+
 # API endpoints and headers
 url = "https://streaming-availability.p.rapidapi.com/shows/search/filters"
 
@@ -63,7 +142,243 @@ columns_to_include = [
     'creators', 'seasonCount', 'episodeCount'
 ]
 
-def fetch_data(year, headers):
+# Parquet schema of the job file (the stage.netflix_api DDL; list columns keep their structure and
+# are cast to VARCHAR by the stage insert, like the JSON path)
+netflix_api_schema = pa.schema([
+    ('itemType', pa.string()), ('showType', pa.string()), ('id', pa.int64()),
+    ('imdbId', pa.string()), ('tmdbId', pa.string()), ('title', pa.string()),
+    ('overview', pa.string()), ('releaseYear', pa.float64()), ('originalTitle', pa.string()),
+    ('genres', pa.list_(pa.struct([('id', pa.string()), ('name', pa.string())]))),
+    ('directors', pa.list_(pa.string())), ('cast', pa.list_(pa.string())),
+    ('rating', pa.int64()), ('runtime', pa.float64()), ('year', pa.int64()),
+    ('firstAirYear', pa.float64()), ('lastAirYear', pa.float64()), ('creators', pa.list_(pa.string())),
+    ('seasonCount', pa.float64()), ('episodeCount', pa.float64())
+])
+
+def delete_blob(blob_name):
+    try:
+        storage_client.bucket(bucket_name).blob(blob_name).delete()
+    except NotFound:
+        pass
+
+# Streaming NDJSON writer: records are uploaded to GCS in resumable chunks as they are written,
+# so memory stays flat and the first chunks land in the bucket while the crawl is still running
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # must be a multiple of 256 KiB
+
+class NDJSONWriter:
+    def __init__(self, blob_name, compress=False):
+        self.blob_name = f"{blob_name}.gz" if compress else blob_name
+        self.compress = compress
+        self.records = 0
+        self.raw = None
+        self.stream = None
+
+    def _open(self):
+        # The upload only starts with the first record, so an empty crawl leaves no file behind
+        blob = storage_client.bucket(bucket_name).blob(self.blob_name)
+        content_type = "application/gzip" if self.compress else "application/json"
+        self.raw = blob.open("wb", chunk_size=UPLOAD_CHUNK_SIZE, content_type=content_type, ignore_flush=True)
+        self.stream = gzip.GzipFile(fileobj=self.raw, mode="wb") if self.compress else self.raw
+
+    def write(self, record):
+        if self.stream is None:
+            self._open()
+        self.stream.write((json.dumps(record) + "\n").encode('utf-8'))
+        self.records += 1
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        if self.stream is None:
+            return
+        if self.compress:
+            self.stream.close()
+        self.raw.close()
+
+    def abort(self):
+        # An open upload is not discarded: the BlobWriter finalizer closes it and publishes whatever was
+        # written. So finish the upload here and delete the blob, leaving no truncated file behind
+        if self.stream is None:
+            return
+        try:
+            self.close()
+        except Exception as e:
+            print(f"Could not finalize {self.blob_name} before deleting it: {e}")
+        self.stream = None
+        delete_blob(self.blob_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+# Typed Parquet job files: explicit schemas matching the stage DDL, so the loader can hand the
+# file straight to DuckDB; rows are buffered into row groups and streamed like the NDJSON files
+PARQUET_ROW_GROUP_SIZE = 50000
+
+def to_arrow_value(value, arrow_type):
+    """Coerce a raw record value to the Python value pyarrow expects for a column type"""
+    if value is None or value == '':
+        return None
+    if pa.types.is_integer(arrow_type):
+        return int(float(value))
+    if pa.types.is_floating(arrow_type):
+        return float(value)
+    if pa.types.is_boolean(arrow_type):
+        return value if isinstance(value, bool) else str(value).strip().lower() == 'true'
+    if pa.types.is_timestamp(arrow_type):
+        if isinstance(value, dt.datetime):
+            return value
+        if str(value).count(':') == 2 and '-' not in str(value):
+            # a duration (HH:MM:SS) is stored on 1970-01-01
+            hours, minutes, seconds = (int(part) for part in str(value).split(':'))
+            return dt.datetime(1970, 1, 1) + dt.timedelta(hours=hours, minutes=minutes, seconds=seconds)
+        parsed = dt.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        return parsed.astimezone(dt.timezone.utc).replace(tzinfo=None) if parsed.tzinfo else parsed
+    if pa.types.is_date(arrow_type):
+        return value if isinstance(value, dt.date) else dt.date.fromisoformat(str(value))
+    if pa.types.is_string(arrow_type):
+        return str(value)
+    return value
+
+class ParquetJobWriter:
+    def __init__(self, blob_name, schema):
+        self.blob_name = blob_name
+        self.schema = schema
+        self.records = 0
+        self.rows = []
+        self.raw = None
+        self.writer = None
+
+    def _flush(self):
+        if not self.rows:
+            return
+        if self.writer is None:
+            # The upload only starts with the first row group, so an empty crawl leaves no file behind
+            blob = storage_client.bucket(bucket_name).blob(self.blob_name)
+            self.raw = blob.open("wb", chunk_size=UPLOAD_CHUNK_SIZE, content_type="application/vnd.apache.parquet", ignore_flush=True)
+            self.writer = pq.ParquetWriter(self.raw, self.schema, compression="zstd")
+        self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.schema))
+        self.rows = []
+
+    def write(self, record):
+        self.rows.append({field.name: to_arrow_value(record.get(field.name), field.type) for field in self.schema})
+        self.records += 1
+        if len(self.rows) >= PARQUET_ROW_GROUP_SIZE:
+            self._flush()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        self._flush()
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.raw.close()
+
+    def abort(self):
+        # Same as NDJSONWriter.abort: the buffered rows are dropped and the partial upload is deleted
+        self.rows = []
+        if self.writer is None:
+            return
+        try:
+            self.writer.close()
+            self.raw.close()
+        except Exception as e:
+            print(f"Could not finalize {self.blob_name} before deleting it: {e}")
+        self.writer = None
+        delete_blob(self.blob_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+def job_writer(blob_stem, file_format='ndjson', compress=False, schema=None):
+    """Writer for a job file: typed Parquet, or NDJSON (optionally gzip-compressed)"""
+    if file_format == 'parquet':
+        return ParquetJobWriter(f"{blob_stem}.parquet", schema)
+    return NDJSONWriter(f"{blob_stem}.json", compress=compress)
+
+# The latest successful job of each dataset is recorded in jobs/<dataset>/{MANIFEST_NAME},
+# so the loader resolves it with one read instead of listing the whole job history
+MANIFEST_NAME = "latest.json"
+
+def write_manifest(dataset, job_id, writer):
+    """Point the dataset's manifest at a finished job file (nothing to record when it has no records)"""
+    if not writer.records:
+        return
+    manifest = {
+        'dataset': dataset,
+        'job_id': job_id,
+        'blob_name': writer.blob_name,
+        'filepath': f"gs://{bucket_name}/{writer.blob_name}",
+        'records': writer.records,
+        'created_at': datetime.now().isoformat()
+    }
+    blob = storage_client.bucket(bucket_name).blob(f"jobs/{dataset}/{MANIFEST_NAME}")
+    blob.upload_from_string(json.dumps(manifest), content_type="application/json")
+
+def next_delay(response, delay):
+    """
+    Seconds to wait before the next request of a crawl: honor Retry-After on 429, otherwise spread the
+    remaining requests over the time until the rate limit resets, and speed up when no limit is reported
+    """
+    if response.status_code == 429:
+        retry_after = response.headers.get('Retry-After')
+        return float(retry_after) if retry_after else min(max(delay, MIN_DELAY_SECONDS) * 2, MAX_DELAY_SECONDS)
+
+    remaining = response.headers.get('X-RateLimit-Requests-Remaining')
+    reset = response.headers.get('X-RateLimit-Requests-Reset')
+    if remaining is not None and reset is not None:
+        return min(max(float(reset) / max(int(remaining), 1), MIN_DELAY_SECONDS), MAX_DELAY_SECONDS)
+    return max(delay / 2, MIN_DELAY_SECONDS)
+
+def checkpoint_path(backfill_id, year, name):
+    return f"{CHECKPOINT_PREFIX}/{backfill_id}/{year}/{name}"
+
+def load_checkpoint(backfill_id, year):
+    """Cursor state of a year's crawl ({'cursor', 'pages', 'done'}), a fresh one when there is none"""
+    blob = storage_client.bucket(bucket_name).blob(checkpoint_path(backfill_id, year, "cursor.json"))
+    if not blob.exists():
+        return {'cursor': "", 'pages': 0, 'done': False}
+    return json.loads(blob.download_as_text())
+
+def save_checkpoint(backfill_id, year, shows, state):
+    """Save a fetched page, then the cursor that follows it (so a saved cursor never skips a page)"""
+    bucket = storage_client.bucket(bucket_name)
+    if shows is not None:
+        page_blob = bucket.blob(checkpoint_path(backfill_id, year, f"page-{state['pages']:05d}.json"))
+        page_blob.upload_from_string(json.dumps(shows), content_type="application/json")
+    cursor_blob = bucket.blob(checkpoint_path(backfill_id, year, "cursor.json"))
+    cursor_blob.upload_from_string(json.dumps(state), content_type="application/json")
+
+def load_pages(backfill_id, year):
+    """The pages checkpointed for a year, in page order, one page at a time"""
+    blobs = storage_client.bucket(bucket_name).list_blobs(prefix=checkpoint_path(backfill_id, year, "page-"))
+    for blob in sorted(blobs, key=lambda blob: blob.name):
+        yield json.loads(blob.download_as_text())
+
+def fetch_data(year, headers, on_page=None, backfill_id=None, deadline=None):
+    """
+    Crawl the catalog of one year, handing each page of shows to on_page as it arrives. With a backfill_id
+    every page is checkpointed to GCS and the crawl resumes from the last saved cursor. Returns the number
+    of shows fetched by this call and whether the crawl reached the last page.
+    """
     querystring = {
         "series_granularity": "show",
         "order_direction": "asc",
@@ -77,16 +392,42 @@ def fetch_data(year, headers):
         "cursor": ""
     }
     
-    all_results = []
-    page_count = 0
+    state = {'cursor': "", 'pages': 0, 'done': False}
+    if backfill_id:
+        state = load_checkpoint(backfill_id, year)
+        if state['done']:
+            print(f"Year {year} already fetched ({state['pages']} pages)")
+            return 0, True
+        querystring['cursor'] = state['cursor']
+        if state['pages']:
+            print(f"Resuming year {year} after page {state['pages']}")
+
+    total_shows = 0
+    page_count = state['pages']
+    delay = MIN_DELAY_SECONDS
+    retries = 0
     
     while True:
+        if deadline and time.monotonic() > deadline:
+            print(f"Time budget reached for year {year} after page {page_count}")
+            return total_shows, False
+
         response = requests.get(url, headers=headers, params=querystring)
+        delay = next_delay(response, delay)
+
+        # Rate limited: wait and retry the same cursor
+        if response.status_code == 429 and retries < MAX_RETRIES:
+            retries += 1
+            print(f"Rate limited on year {year}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        retries = 0
+
         data = response.json()
         
         if 'message' in data:
             print(f"Error fetching data: {data['message']}")
-            break
+            return total_shows, False
         
         shows = data.get('shows', [])
         
@@ -94,72 +435,94 @@ def fetch_data(year, headers):
         filtered_shows = []
         for show in shows:
             filtered_show = {k: v for k, v in show.items() if k in columns_to_include}
+            filtered_show['year'] = year  # Add year information to each show
             filtered_shows.append(filtered_show)
         
-        all_results.extend(filtered_shows)
+        if on_page:
+            on_page(filtered_shows)
+        total_shows += len(filtered_shows)
         page_count += 1
-        print(f"Fetched page {page_count}. Total shows: {len(all_results)}")
+        print(f"Fetched page {page_count} for year {year}. Total shows: {total_shows}")
         
         next_cursor = data.get('nextCursor')
+        if backfill_id:
+            state = {'cursor': next_cursor or "", 'pages': page_count, 'done': not next_cursor}
+            save_checkpoint(backfill_id, year, filtered_shows, state)
         if not next_cursor:
-            break
+            return total_shows, True
         
         querystring['cursor'] = next_cursor
-        time.sleep(1)  # Add a small delay between requests
-    
-    return all_results
+        time.sleep(delay)  # Adaptive delay between requests
+
+def backfill(years, backfill_id):
+    """Crawl several years concurrently (each year has its own API key), checkpointing every page"""
+    deadline = time.monotonic() + TIME_BUDGET_SECONDS
+    with ThreadPoolExecutor(max_workers=len(years)) as executor:
+        futures = {year: executor.submit(fetch_data, year, headers[year], None, backfill_id, deadline) for year in years}
+        complete = {year: future.result()[1] for year, future in futures.items()}
+
+    return [year for year in years if not complete[year]]
 
 @functions_framework.http
 def main(request):
     
-    # ### Only for first load (one-time load)
-    # all_data = []
-    # for year in [2020, 2021, 2022, 2023]:
-    #     print(f"Fetching data for year {year}")
-    #     year_data = fetch_data(year, headers[year])
-    #     for show in year_data:
-    #         show['year'] = year  # Add year information to each show
-    #     all_data.extend(year_data)
-    #     print(f"Total shows for {year}: {len(year_data)}")
-    #     time.sleep(2)  # Pause between years to avoid rate limits
+    # Parse the request data
+    request_json = request.get_json(silent=True) or {}
 
-    ### For daily loads - getting latest data
-    current_year = datetime.now().year
-    print(f"Fetching data for the current year")
-    all_data = fetch_data(current_year, headers[current_year])
-    for show in all_data:
-        show['year'] = current_year  # Add year information to each show 
-    print(f"Total shows for {current_year}: {len(all_data)}")
-
-    # Convert to DataFrame
-    df = pd.json_normalize(all_data)
-    
     # Generate job ID
     JOB_ID = datetime.now().strftime("%Y%m%d%H%M") + "-" + str(uuid.uuid4())
 
-    # Prepare data for GCS
-    blob_name = f"jobs/netflix_api/{JOB_ID}/netflix_api.json"
+    # The job file is streamed to GCS page by page, as NDJSON (gzip-compressed when requested) or typed Parquet
+    file_format = request_json.get('format', 'ndjson')
+    if file_format not in ('ndjson', 'parquet'):
+        return {'error': f"Invalid format '{file_format}'"}, 400
+    writer = job_writer(f"jobs/netflix_api/{JOB_ID}/netflix_api", file_format, bool(request_json.get('compress')), netflix_api_schema)
 
-    # Save the data as a json file in memory
-    json_buffer = BytesIO()
-    for record in all_data:
-        json_buffer.write((json.dumps(record) + "\n").encode('utf-8'))
-    json_buffer.seek(0)
+    ### Backfill (first load): the years are crawled concurrently and checkpointed, so an invocation
+    ### that runs out of time can be called again with the same backfill_id to resume
+    if request_json.get('mode') == 'backfill':
+        years = [int(year) for year in request_json.get('years', [2020, 2021, 2022, 2023])]
+        unknown = [year for year in years if year not in headers]
+        if unknown:
+            return {'error': f"No API key for years {unknown}"}, 400
+        backfill_id = request_json.get('backfill_id') or f"backfill-{'-'.join(map(str, years))}"
 
-    # Upload the JSON file to GCS
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    blob.upload_from_file(json_buffer, content_type="application/json")
+        print(f"Backfilling years {years} ({backfill_id})")
+        pending = backfill(years, backfill_id)
+        if pending:
+            results = {'status': 'incomplete', 'backfill_id': backfill_id, 'pending_years': pending}
+            print(results)
+            return results
+
+        # Every year is complete: stream the checkpointed pages into the job file
+        with writer:
+            for year in years:
+                year_start = writer.records
+                for page in load_pages(backfill_id, year):
+                    writer.write_all(page)
+                print(f"Total shows for {year}: {writer.records - year_start}")
+
+    ### For daily loads - getting latest data
+    else:
+        current_year = datetime.now().year
+        print(f"Fetching data for the current year")
+        with writer:
+            total_shows, _ = fetch_data(current_year, headers[current_year], on_page=writer.write_all)
+        print(f"Total shows for {current_year}: {total_shows}")
+
+    write_manifest('netflix_api', JOB_ID, writer)
 
-    # Prepare results
-    file_path = f"gs://{bucket_name}/{blob_name}"
+    # Prepare results (no file is written when the crawl returned nothing)
+    blob_name = writer.blob_name if writer.records else None
+    file_path = f"gs://{bucket_name}/{blob_name}" if blob_name else None
     results = {
         'filepath': file_path,
         'jobid': JOB_ID,
         'bucket_id': bucket_name,
         'blob_name': blob_name,
-        'total_shows': len(all_data)
+        'total_shows': writer.records,
+        'status': 'complete'
     }
     
     print(results)
-    return results
\ No newline at end of file
+    return results
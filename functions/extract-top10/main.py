@@ -1,60 +1,460 @@
-import pandas as pd
 from google.cloud import storage
+from google.cloud import secretmanager
+from google.api_core.exceptions import NotFound
 import datetime
 import uuid
-from io import BytesIO
+import csv
+import io
+import gzip
+import os
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+import duckdb
+from concurrent.futures import ThreadPoolExecutor
 import functions_framework
 import requests
 
+# Local mode for offline runs: LOCAL_BUCKET_DIR is a directory standing in for GCS, every bucket is
+# a sub-directory and every blob a file under it
+LOCAL_BUCKET_DIR = os.environ.get('LOCAL_BUCKET_DIR')
+
+class LocalBlob:
+    """A file standing in for a GCS blob (the part of the Blob API the functions use)"""
+    def __init__(self, bucket_dir, name):
+        self.name = name
+        self.path = os.path.join(bucket_dir, name)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def delete(self):
+        if not self.exists():
+            raise NotFound(f"No such object: {self.name}")
+        os.remove(self.path)
+
+    def open(self, mode, **kwargs):
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return open(self.path, mode)
+
+    def upload_from_string(self, data, content_type=None):
+        with self.open('wb') as f:
+            f.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+    def download_as_bytes(self):
+        if not self.exists():
+            raise NotFound(f"No such object: {self.name}")
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def download_as_text(self):
+        return self.download_as_bytes().decode('utf-8')
+
+    def download_to_filename(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.download_as_bytes())
+
+class LocalBucket:
+    def __init__(self, bucket_dir):
+        self.bucket_dir = bucket_dir
+
+    def blob(self, name):
+        return LocalBlob(self.bucket_dir, name)
+
+    def list_blobs(self, prefix=''):
+        names = []
+        for root, _, files in os.walk(self.bucket_dir):
+            for file in files:
+                name = os.path.relpath(os.path.join(root, file), self.bucket_dir).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    names.append(name)
+        return [self.blob(name) for name in sorted(names)]
+
+class LocalStorageClient:
+    def bucket(self, bucket_name):
+        return LocalBucket(os.path.join(LOCAL_BUCKET_DIR, bucket_name))
+
 # storage client
-storage_client = storage.Client()
+storage_client = LocalStorageClient() if LOCAL_BUCKET_DIR else storage.Client()
 
 # storage bucket
 bucket_name = "ba882-team05"
 
+# settings
+project_id = 'ba882-inclass-project'
+secret_id = 'duckdb-token'
+version_id = 'latest'
+
+# stage tables of the weekly files: the latest week loaded into them is where the next delta starts
+stage_tables = {
+    'netflix_countries': 'ba882_project.stage.netflix_countries',
+    'netflix_global': 'ba882_project.stage.netflix_global'
+}
+
 # file URLs
 netflix_countries_url = "https://www.netflix.com/tudum/top10/data/all-weeks-countries.tsv"
 netflix_global_url = "https://www.netflix.com/tudum/top10/data/all-weeks-global.tsv"
 netflix_most_popular_url = "https://www.netflix.com/tudum/top10/data/most-popular.tsv"
 
-def process_dataset(url, dataset_name, job_id):
-    response = requests.get(url)
+# Download state of each file (ETag, Last-Modified and the latest week written to a job file), used
+# for conditional requests
+state_prefix = "state/top10"
+
+# Column types of each file in file order (the schema-top10 DDL). The job files keep the column names
+# of the TSV header (e.g. country_iso2, runtime), the stage load maps the columns by position
+column_types = {
+    'netflix_countries': [
+        pa.string(), pa.string(), pa.timestamp('us'), pa.string(), pa.int32(), pa.string(), pa.string(), pa.int32()
+    ],
+    'netflix_global': [
+        pa.timestamp('us'), pa.string(), pa.int64(), pa.string(), pa.string(), pa.int64(), pa.float64(),
+        pa.float64(), pa.int64(), pa.bool_(), pa.string()
+    ],
+    'netflix_most_popular': [
+        pa.string(), pa.int32(), pa.string(), pa.string(), pa.int64(), pa.float64(), pa.int64(),
+        pa.date32()  # extraction_date, added by the extractor
+    ]
+}
+
+def delete_blob(blob_name):
+    try:
+        storage_client.bucket(bucket_name).blob(blob_name).delete()
+    except NotFound:
+        pass
+
+# Streaming NDJSON writer: records are uploaded to GCS in resumable chunks as they are written,
+# so memory stays flat and the first chunks land in the bucket while the crawl is still running
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # must be a multiple of 256 KiB
+
+class NDJSONWriter:
+    def __init__(self, blob_name, compress=False):
+        self.blob_name = f"{blob_name}.gz" if compress else blob_name
+        self.compress = compress
+        self.records = 0
+        self.raw = None
+        self.stream = None
+
+    def _open(self):
+        # The upload only starts with the first record, so an empty crawl leaves no file behind
+        blob = storage_client.bucket(bucket_name).blob(self.blob_name)
+        content_type = "application/gzip" if self.compress else "application/json"
+        self.raw = blob.open("wb", chunk_size=UPLOAD_CHUNK_SIZE, content_type=content_type, ignore_flush=True)
+        self.stream = gzip.GzipFile(fileobj=self.raw, mode="wb") if self.compress else self.raw
+
+    def write(self, record):
+        if self.stream is None:
+            self._open()
+        self.stream.write((json.dumps(record) + "\n").encode('utf-8'))
+        self.records += 1
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        if self.stream is None:
+            return
+        if self.compress:
+            self.stream.close()
+        self.raw.close()
+
+    def abort(self):
+        # An open upload is not discarded: the BlobWriter finalizer closes it and publishes whatever was
+        # written. So finish the upload here and delete the blob, leaving no truncated file behind
+        if self.stream is None:
+            return
+        try:
+            self.close()
+        except Exception as e:
+            print(f"Could not finalize {self.blob_name} before deleting it: {e}")
+        self.stream = None
+        delete_blob(self.blob_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+# Typed Parquet job files: explicit schemas matching the stage DDL, so the loader can hand the
+# file straight to DuckDB; rows are buffered into row groups and streamed like the NDJSON files
+PARQUET_ROW_GROUP_SIZE = 50000
+
+def to_arrow_value(value, arrow_type):
+    """Coerce a raw record value to the Python value pyarrow expects for a column type"""
+    if value is None or value == '':
+        return None
+    if pa.types.is_integer(arrow_type):
+        return int(float(value))
+    if pa.types.is_floating(arrow_type):
+        return float(value)
+    if pa.types.is_boolean(arrow_type):
+        return value if isinstance(value, bool) else str(value).strip().lower() == 'true'
+    if pa.types.is_timestamp(arrow_type):
+        if isinstance(value, datetime.datetime):
+            return value
+        if str(value).count(':') == 2 and '-' not in str(value):
+            # a duration (HH:MM:SS) is stored on 1970-01-01
+            hours, minutes, seconds = (int(part) for part in str(value).split(':'))
+            return datetime.datetime(1970, 1, 1) + datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds)
+        parsed = datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        return parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None) if parsed.tzinfo else parsed
+    if pa.types.is_date(arrow_type):
+        return value if isinstance(value, datetime.date) else datetime.date.fromisoformat(str(value))
+    if pa.types.is_string(arrow_type):
+        return str(value)
+    return value
+
+class ParquetJobWriter:
+    def __init__(self, blob_name, schema):
+        self.blob_name = blob_name
+        self.schema = schema
+        self.records = 0
+        self.rows = []
+        self.raw = None
+        self.writer = None
+
+    def _flush(self):
+        if not self.rows:
+            return
+        if self.writer is None:
+            # The upload only starts with the first row group, so an empty crawl leaves no file behind
+            blob = storage_client.bucket(bucket_name).blob(self.blob_name)
+            self.raw = blob.open("wb", chunk_size=UPLOAD_CHUNK_SIZE, content_type="application/vnd.apache.parquet", ignore_flush=True)
+            self.writer = pq.ParquetWriter(self.raw, self.schema, compression="zstd")
+        self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.schema))
+        self.rows = []
+
+    def write(self, record):
+        self.rows.append({field.name: to_arrow_value(record.get(field.name), field.type) for field in self.schema})
+        self.records += 1
+        if len(self.rows) >= PARQUET_ROW_GROUP_SIZE:
+            self._flush()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        self._flush()
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.raw.close()
+
+    def abort(self):
+        # Same as NDJSONWriter.abort: the buffered rows are dropped and the partial upload is deleted
+        self.rows = []
+        if self.writer is None:
+            return
+        try:
+            self.writer.close()
+            self.raw.close()
+        except Exception as e:
+            print(f"Could not finalize {self.blob_name} before deleting it: {e}")
+        self.writer = None
+        delete_blob(self.blob_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+def job_writer(blob_stem, file_format='ndjson', compress=False, schema=None):
+    """Writer for a job file: typed Parquet, or NDJSON (optionally gzip-compressed)"""
+    if file_format == 'parquet':
+        return ParquetJobWriter(f"{blob_stem}.parquet", schema)
+    return NDJSONWriter(f"{blob_stem}.json", compress=compress)
+
+def convert_value(value, arrow_type):
+    """NDJSON value of a TSV cell: numbers and booleans are typed, everything else stays a string"""
+    if pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type) or pa.types.is_boolean(arrow_type):
+        return to_arrow_value(value, arrow_type)
+    return value if value != '' else None
+
+# The latest successful job of each dataset is recorded in jobs/<dataset>/{MANIFEST_NAME},
+# so the loader resolves it with one read instead of listing the whole job history
+MANIFEST_NAME = "latest.json"
+
+def write_manifest(dataset, job_id, writer):
+    """Point the dataset's manifest at a finished job file (nothing to record when it has no records)"""
+    if not writer.records:
+        return
+    manifest = {
+        'dataset': dataset,
+        'job_id': job_id,
+        'blob_name': writer.blob_name,
+        'filepath': f"gs://{bucket_name}/{writer.blob_name}",
+        'records': writer.records,
+        'created_at': datetime.datetime.now().isoformat()
+    }
+    blob = storage_client.bucket(bucket_name).blob(f"jobs/{dataset}/{MANIFEST_NAME}")
+    blob.upload_from_string(json.dumps(manifest), content_type="application/json")
+
+# Local mode for offline runs: DUCKDB_PATH points at a local DuckDB file named after the database
+# (e.g. /data/ba882_project.duckdb) that stands in for MotherDuck
+DUCKDB_PATH = os.environ.get('DUCKDB_PATH')
+
+def connect_warehouse():
+    """DuckDB connection to the warehouse: the local file in local mode, else MotherDuck"""
+    if DUCKDB_PATH:
+        if os.path.splitext(os.path.basename(DUCKDB_PATH))[0] != 'ba882_project':
+            raise ValueError("DUCKDB_PATH must point at a file named ba882_project.duckdb")
+        return duckdb.connect(DUCKDB_PATH)
+
+    # Access the MotherDuck token in Secret Manager
+    sm = secretmanager.SecretManagerServiceClient()
+    name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
+    response = sm.access_secret_version(request={"name": name})
+    md_token = response.payload.data.decode("UTF-8")
+
+    # initiate the MotherDuck connection through an access token
+    return duckdb.connect(f'md:?motherduck_token={md_token}')
+
+# Function to read the latest week already loaded
+def get_loaded_week(md, dataset_name):
+    """
+    Latest week in the dataset's stage table, as the YYYY-MM-DD string used by the TSV files.
+    Returns None (extract every week) when the table does not exist yet or is empty.
+    """
+    try:
+        loaded_week = md.sql(f"SELECT MAX(week) FROM {stage_tables[dataset_name]}").fetchone()[0]
+    except duckdb.Error as e:
+        print(f"Could not read the latest loaded week from {stage_tables[dataset_name]}: {e}")
+        return None
+
+    if loaded_week is None:
+        return None
+    return loaded_week.strftime('%Y-%m-%d')
+
+def load_state(dataset_name):
+    blob = storage_client.bucket(bucket_name).blob(f"{state_prefix}/{dataset_name}.json")
+    if not blob.exists():
+        return {}
+    return json.loads(blob.download_as_text())
+
+def save_state(dataset_name, state):
+    blob = storage_client.bucket(bucket_name).blob(f"{state_prefix}/{dataset_name}.json")
+    blob.upload_from_string(json.dumps(state), content_type='application/json')
+
+def process_dataset(url, dataset_name, job_id, compress=False, full=False, file_format='ndjson', loaded_week=None):
+    state = {} if full else load_state(dataset_name)
+
+    # Conditional request: the server answers 304 when the file did not change since the last run.
+    # A weekly file whose last delta has not reached the stage table yet (its load failed) is
+    # fetched again, so those weeks go into the next job file
+    if dataset_name in stage_tables and state.get('last_week') != loaded_week:
+        print(f"{dataset_name}: weeks up to {state.get('last_week')} were extracted but only {loaded_week} is loaded, re-fetching")
+        state = {}
+    request_headers = {}
+    if state.get('etag'):
+        request_headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        request_headers['If-Modified-Since'] = state['last_modified']
+
+    response = requests.get(url, headers=request_headers, stream=True)
+    if response.status_code == 304:
+        response.close()
+        return {'status': 'unchanged', 'blob_name': None, 'filepath': None, 'records': 0}
+
     if response.status_code == 200:
-        blob_name = f"jobs/{dataset_name}/{job_id}/{dataset_name}.json"
-        df = pd.read_csv(BytesIO(response.content), sep='\t')
+        response.raw.decode_content = True
+        rows = csv.DictReader(io.TextIOWrapper(response.raw, encoding='utf-8', newline=''), delimiter='\t')
+
+        # Pair the header with the expected column types
+        columns = list(rows.fieldnames or [])
+        if dataset_name == "netflix_most_popular":
+            columns.append('extraction_date')
+        types = column_types[dataset_name]
+        if len(columns) != len(types):
+            response.close()
+            return {'status': 'error', 'message': f"Unexpected columns in {url}: {columns}"}
+        schema = pa.schema(list(zip(columns, types)))
+
+        # Weekly files only emit the weeks after the latest one already loaded (a delta file)
+        last_week = loaded_week
+        max_week = last_week
         
         if dataset_name == "netflix_most_popular":
             # Add the date column for the Tuesday of the current week
             tuesday_date = (datetime.datetime.now() - datetime.timedelta(days=datetime.datetime.now().weekday()) + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-            df['extraction_date'] = tuesday_date
         
-        json_data = df.to_json(orient='records', lines=True)
-        
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-        blob.upload_from_string(json_data, content_type='application/json')
+        # Stream the TSV row by row straight into the job file
+        with job_writer(f"jobs/{dataset_name}/{job_id}/{dataset_name}", file_format, compress, schema) as writer:
+            for row in rows:
+                week = row.get('week')
+                if week:
+                    if last_week and week <= last_week:
+                        continue
+                    max_week = max(max_week or week, week)
+                if dataset_name == "netflix_most_popular":
+                    row['extraction_date'] = tuesday_date
+                record = {column: convert_value(row.get(column), arrow_type) for column, arrow_type in zip(columns, types)}
+                writer.write(record)
+
+        write_manifest(dataset_name, job_id, writer)
+
+        # Remember the validators only once the job file is written
+        save_state(dataset_name, {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'last_week': max_week
+        })
         
-        return {'status': 'success', 'blob_name': blob_name}
+        return {
+            'status': 'success' if writer.records else 'no_new_rows',
+            'blob_name': writer.blob_name if writer.records else None,
+            'filepath': f"gs://{bucket_name}/{writer.blob_name}" if writer.records else None,
+            'records': writer.records,
+            'since_week': last_week
+        }
     else:
         return {'status': 'error', 'message': f'Failed to fetch data for {dataset_name}', 'status_code': response.status_code}
 
 @functions_framework.http
 def main(request):
+    # Parse the request data (job files are NDJSON, gzip-compressed when requested, or typed Parquet)
+    request_json = request.get_json(silent=True) or {}
+    compress = bool(request_json.get('compress'))
+    file_format = request_json.get('format', 'ndjson')
+    if file_format not in ('ndjson', 'parquet'):
+        return {'error': f"Invalid format '{file_format}'"}, 400
+
     JOB_ID = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + "-" + str(uuid.uuid4())
     
-    results = {}
-    
-    # Process Netflix Countries dataset
-    results['netflix_countries'] = process_dataset(netflix_countries_url, 'netflix_countries', JOB_ID)
-    
-    # Process Netflix Global dataset
-    results['netflix_global'] = process_dataset(netflix_global_url, 'netflix_global', JOB_ID)
-    
-    # Process Netflix Most Popular dataset
-    results['netflix_most_popular'] = process_dataset(netflix_most_popular_url, 'netflix_most_popular', JOB_ID)
+    # Fetch the three files concurrently ('full' ignores the saved state and re-extracts everything)
+    full = bool(request_json.get('full'))
+
+    # The weekly deltas start after the latest week in the stage tables, so weeks of a job file
+    # that failed to load are extracted again
+    loaded_weeks = {}
+    if not full:
+        md = connect_warehouse()
+        loaded_weeks = {name: get_loaded_week(md, name) for name in stage_tables}
+        md.close()
+        print(f"Latest loaded weeks: {loaded_weeks}")
+
+    datasets = {
+        'netflix_countries': netflix_countries_url,
+        'netflix_global': netflix_global_url,
+        'netflix_most_popular': netflix_most_popular_url
+    }
+    with ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+        futures = {name: executor.submit(process_dataset, url, name, JOB_ID, compress, full, file_format, loaded_weeks.get(name)) for name, url in datasets.items()}
+        results = {name: future.result() for name, future in futures.items()}
     
     # Check if all datasets were processed successfully
-    if all(result['status'] == 'success' for result in results.values()):
+    if all(result['status'] != 'error' for result in results.values()):
         return {
             'message': 'All datasets processed successfully',
             'job_id': JOB_ID,
@@ -2,13 +2,20 @@
 import functions_framework
 from google.cloud import storage
 from google.cloud import secretmanager
+from google.api_core.exceptions import NotFound
 import duckdb
 import pandas as pd
 import datetime
 from dateutil import parser
 import json   
 import io
+import os
+import gzip
 import re
+import time
+import queue
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 # from io import BytesIO						
 
 # setup
@@ -22,13 +29,170 @@ db = 'ba882_project'
 raw_db_schema = f"{db}.raw"
 stage_db_schema = f"{db}.stage"
 
+# Concurrent loading: every chain of datasets runs in its own thread, the warehouse writes go through a
+# small pool of connections so downloads keep overlapping the writes of the other datasets
+LOAD_CONNECTIONS = 3
+# datasets writing the same stage table run one after the other in the same chain
+dataset_chains = [
+    ['netflix_api'],
+    ['youtube_api', 'youtube_stats'],
+    ['netflix_global'],
+    ['netflix_countries'],
+    ['netflix_most_popular']
+]
+
+# Natural key of each stage table (the grain a row is unique at). Top 10 files are unique per week
+# (or extraction date), list and rank; the first column of those keys bounds the stage rows probed
+stage_keys = {
+    'netflix_api': ['id'],
+    'youtube_api': ['video_id'],
+    'netflix_global': ['week', 'category', 'weekly_rank'],
+    'netflix_countries': ['week', 'country_code', 'category', 'weekly_rank'],
+    'netflix_most_popular': ['extraction_date', 'category', 'rank']
+}
+time_keyed = ['netflix_global', 'netflix_countries', 'netflix_most_popular']
+
+# Local mode for offline runs: DUCKDB_PATH points at a local DuckDB file named after the database
+# (e.g. /data/ba882_project.duckdb) that stands in for MotherDuck
+DUCKDB_PATH = os.environ.get('DUCKDB_PATH')
+
+def connect_warehouse():
+    """DuckDB connection to the warehouse: the local file in local mode, else MotherDuck"""
+    if DUCKDB_PATH:
+        if os.path.splitext(os.path.basename(DUCKDB_PATH))[0] != db:
+            raise ValueError(f"DUCKDB_PATH must point at a file named {db}.duckdb")
+        return duckdb.connect(DUCKDB_PATH)
+
+    # Access the MotherDuck token in Secret Manager
+    sm = secretmanager.SecretManagerServiceClient()
+    name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
+    response = sm.access_secret_version(request={"name": name})
+    md_token = response.payload.data.decode("UTF-8")
+
+    # initiate the MotherDuck connection through an access token
+    return duckdb.connect(f'md:?motherduck_token={md_token}')
+
+# Local mode for offline runs: LOCAL_BUCKET_DIR is a directory standing in for GCS, every bucket is
+# a sub-directory and every blob a file under it
+LOCAL_BUCKET_DIR = os.environ.get('LOCAL_BUCKET_DIR')
+
+class LocalBlob:
+    """A file standing in for a GCS blob (the part of the Blob API the functions use)"""
+    def __init__(self, bucket_dir, name):
+        self.name = name
+        self.path = os.path.join(bucket_dir, name)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def open(self, mode, **kwargs):
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return open(self.path, mode)
+
+    def upload_from_string(self, data, content_type=None):
+        with self.open('wb') as f:
+            f.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+    def download_as_bytes(self):
+        if not self.exists():
+            raise NotFound(f"No such object: {self.name}")
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def download_as_text(self):
+        return self.download_as_bytes().decode('utf-8')
+
+    def download_to_filename(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.download_as_bytes())
+
+class LocalBucket:
+    def __init__(self, bucket_dir):
+        self.bucket_dir = bucket_dir
+
+    def blob(self, name):
+        return LocalBlob(self.bucket_dir, name)
+
+    def list_blobs(self, prefix=''):
+        names = []
+        for root, _, files in os.walk(self.bucket_dir):
+            for file in files:
+                name = os.path.relpath(os.path.join(root, file), self.bucket_dir).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    names.append(name)
+        return [self.blob(name) for name in sorted(names)]
+
+class LocalStorageClient:
+    def bucket(self, bucket_name):
+        return LocalBucket(os.path.join(LOCAL_BUCKET_DIR, bucket_name))
+
 # instantiate the services
-sm = secretmanager.SecretManagerServiceClient()
-storage_client = storage.Client()
+storage_client = LocalStorageClient() if LOCAL_BUCKET_DIR else storage.Client()
+
+def insert_new_rows_sql(md, dataset, stage_tbl_name, raw_tbl_name, columns=None):
+    """
+    Keyed insert of the raw rows whose key is not in the stage table yet (deduplicated within the batch).
+    The keys are compared in the stage table's native types, casting only the raw side, so DuckDB runs a
+    hash anti-join instead of a VARCHAR NOT IN over the whole stage table.
+    columns picks the raw columns by name; without it the raw columns map to the stage columns by position.
+    """
+    column_types = {row[0]: row[1] for row in md.sql(f"DESCRIBE {stage_tbl_name}").fetchall()}
+    keys = stage_keys[dataset]
+
+    if columns is None:
+        aliases = ', '.join(f'"{column}"' for column in column_types)
+        source = f"{raw_tbl_name} AS r({aliases})"
+        select_list = "r.*"
+    else:
+        source = f"{raw_tbl_name} AS r"
+        select_list = "\n        ,".join(f'r."{column}"' for column in columns)
+
+    raw_keys = [f'CAST(r."{key}" AS {column_types[key]})' for key in keys]
+    key_match = " AND ".join(f's."{key}" = {raw_key}' for key, raw_key in zip(keys, raw_keys))
+    if dataset in time_keyed:
+        # only the stage rows from the earliest period of the batch can collide
+        key_match += f' AND s."{keys[0]}" >= (SELECT MIN({raw_keys[0]}) FROM {source})'
+
+    return f"""
+        INSERT INTO {stage_tbl_name}
+        SELECT
+        {select_list}
+        FROM {source}
+        WHERE NOT EXISTS (SELECT 1 FROM {stage_tbl_name} AS s WHERE {key_match})
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY {', '.join(raw_keys)}) = 1;
+        """
+
+def update_existing_rows_sql(md, dataset, stage_tbl_name, raw_tbl_name, columns):
+    """
+    Keyed update of the stage rows whose key is in the raw batch, so a re-extracted row (e.g. a title with
+    a new overview) replaces the stored one; the raw side is deduplicated and cast like the insert's.
+    """
+    column_types = {row[0]: row[1] for row in md.sql(f"DESCRIBE {stage_tbl_name}").fetchall()}
+    keys = stage_keys[dataset]
+
+    raw_keys = [f'CAST("{key}" AS {column_types[key]})' for key in keys]
+    set_list = "\n        ,".join(f'"{column}" = CAST(r."{column}" AS {column_types[column]})'
+                                   for column in columns if column not in keys)
+    key_match = " AND ".join(f's."{key}" = CAST(r."{key}" AS {column_types[key]})' for key in keys)
+
+    return f"""
+        UPDATE {stage_tbl_name} AS s
+        SET {set_list}
+        FROM (SELECT * FROM {raw_tbl_name} QUALIFY ROW_NUMBER() OVER (PARTITION BY {', '.join(raw_keys)}) = 1) AS r
+        WHERE {key_match};
+        """
 
 def get_latest_job_file(bucket_name, dataset, prefix='jobs'):
     # storage_client = storage.Client()
     bucket = storage_client.bucket(bucket_name)
+
+    # One read: the manifest the extractors keep for the latest successful job
+    try:
+        manifest = json.loads(bucket.blob(f"{prefix}/{dataset}/latest.json").download_as_text())
+        return manifest['filepath']
+    except NotFound:
+        print(f'No manifest for {dataset}, listing the job history')
     
 	# List all blobs in the dataset folder									  
     blobs = list(bucket.list_blobs(prefix=f"{prefix}/{dataset}/"))
@@ -50,8 +214,9 @@ def get_latest_job_file(bucket_name, dataset, prefix='jobs'):
     
     latest_job_id = max(job_ids)
     
-	# Find the specific JSON file in the latest job folder													  
-    target_blob = next((blob for blob in blobs if f"{latest_job_id}/{dataset}.json" in blob.name), None)
+	# Find the specific job file (JSON, gzip-compressed JSON or Parquet) in the latest job folder
+    job_files = [f"{latest_job_id}/{dataset}.{extension}" for extension in ('json', 'json.gz', 'parquet')]
+    target_blob = next((blob for blob in blobs if any(blob.name.endswith(job_file) for job_file in job_files)), None)
     
     if target_blob:
         return f"gs://{bucket_name}/{target_blob.name}"
@@ -59,82 +224,139 @@ def get_latest_job_file(bucket_name, dataset, prefix='jobs'):
         print('Latest JOB folder unavailable')
         return None
 
-def process_dataset(md, dataset, json_path, request_json):
+def connection_pool(md, size):
+    """A pool of cursors on one warehouse connection (each cursor can run queries in its own thread)"""
+    pool = queue.Queue()
+    for _ in range(size):
+        pool.put(md.cursor())
+    return pool
+
+@contextmanager
+def pooled_connection(pool):
+    md = pool.get()
+    try:
+        yield md
+    finally:
+        pool.put(md)
+
+def process_dataset(pool, dataset, json_path, request_json):
+    """Download a job file, then stage it through a pooled connection; returns the timings of the load"""
+    start = time.perf_counter()
     print(f"Processing {dataset} from {json_path}")
     
     bucket = storage_client.bucket(bucket_name)
     blob_name = '/'.join(json_path.split('/')[3:])
     blob = bucket.blob(blob_name)
-    json_data = blob.download_as_text()
-    
-    json_file = io.StringIO(json_data)
-    json_df = pd.read_json(json_file, lines=True)
-    # print("Before adding columns", json_df.columns)
-    # json_df['job_id'] = request_json.get('jobid')
-    # json_df['ingest_timestamp'] = datetime.datetime.now().isoformat()
-    # print("After adding columns", json_df.columns)
-    
     raw_tbl_name = f"{raw_db_schema}.{dataset}"
-    raw_tbl_sql = f"""
-    DROP TABLE IF EXISTS {raw_tbl_name};
-    CREATE TABLE {raw_tbl_name} AS SELECT * FROM json_df;
-    """
-    print(f"Executing SQL: {raw_tbl_sql}")
-    md.sql(raw_tbl_sql)
-    
-    stage_tbl_name = f"{stage_db_schema}.{dataset}"
-    
-    if dataset == 'netflix_api':
-        insert_sql = f"""
-        INSERT INTO {stage_tbl_name}
-        SELECT 
-        itemType			 
-        ,showType
-        ,id
-        ,imdbId
-        ,tmdbId
-        ,title
-        ,overview
-        ,releaseYear
-        ,originalTitle
-        ,genres
-        ,directors
-        ,"cast"
-        ,rating
-        ,runtime
-        ,year
-        ,firstAirYear
-        ,lastAirYear
-        ,creators
-        ,seasonCount 
-        ,episodeCount
-        FROM {raw_tbl_name}
-        WHERE CAST(id as VARCHAR) NOT IN (SELECT CAST(id as VARCHAR) FROM {stage_tbl_name});
-        """
-    elif dataset == 'youtube_api':
-        insert_sql = f"""
-        INSERT INTO {stage_tbl_name}
-        SELECT * FROM {raw_tbl_name}
-        WHERE CAST(video_id as VARCHAR) NOT IN (SELECT CAST(video_id as VARCHAR) FROM {stage_tbl_name});
-        """
-    elif dataset in ['netflix_global', 'netflix_countries']:
-        insert_sql = f"""
-        INSERT INTO {stage_tbl_name}
-        SELECT * FROM {raw_tbl_name}
-        WHERE CAST(week as VARCHAR) NOT IN (SELECT CAST(week as VARCHAR) FROM {stage_tbl_name});
+
+    if blob_name.endswith('.parquet'):
+        # typed Parquet: DuckDB reads the file directly, no pandas in between
+        local_path = f"/tmp/{dataset}.parquet"
+        blob.download_to_filename(local_path)
+        raw_tbl_sql = f"""
+        CREATE OR REPLACE TABLE {raw_tbl_name} AS SELECT * FROM read_parquet('{local_path}');
         """
-    elif dataset == 'netflix_most_popular':
-        insert_sql = f"""
-        INSERT INTO {stage_tbl_name}
-        SELECT * FROM {raw_tbl_name}
-        WHERE CAST(extraction_date as VARCHAR) NOT IN (SELECT CAST(extraction_date as VARCHAR) FROM {stage_tbl_name});
+    else:
+        if blob_name.endswith('.gz'):
+            # gzip-compressed job file
+            json_data = gzip.decompress(blob.download_as_bytes()).decode('utf-8')
+        else:
+            json_data = blob.download_as_text()
+        
+        json_file = io.StringIO(json_data)
+        json_df = pd.read_json(json_file, lines=True)
+        # print("Before adding columns", json_df.columns)
+        # json_df['job_id'] = request_json.get('jobid')
+        # json_df['ingest_timestamp'] = datetime.datetime.now().isoformat()
+        # print("After adding columns", json_df.columns)
+        
+        raw_tbl_sql = f"""
+        CREATE OR REPLACE TABLE {raw_tbl_name} AS SELECT * FROM json_df;
         """
+    downloaded = time.perf_counter()
+
+    # The warehouse part holds a connection from the pool
+    with pooled_connection(pool) as md:
+        connected = time.perf_counter()
+        print(f"Executing SQL: {raw_tbl_sql}")
+        md.sql(raw_tbl_sql)
+        if blob_name.endswith('.parquet'):
+            os.remove(local_path)
+        
+        stage_tbl_name = f"{stage_db_schema}.{dataset}"
+        if dataset == 'youtube_stats':
+            # the refreshed statistics update the videos in the youtube_api stage table
+            stage_tbl_name = f"{stage_db_schema}.youtube_api"
+        
+        if dataset == 'youtube_stats':
+            insert_sql = f"""
+            UPDATE {stage_tbl_name} AS s
+            SET views = CAST(r.views AS BIGINT)
+            ,likes = CAST(r.likes AS BIGINT)
+            ,favorites = CAST(r.favorites AS BIGINT)
+            ,comments_count = CAST(r.comments_count AS BIGINT)
+            FROM {raw_tbl_name} AS r
+            WHERE s.video_id = CAST(r.video_id AS VARCHAR);
+            """
+        elif dataset == 'netflix_api':
+            # the catalog accumulates across runs: titles extracted again are refreshed in place
+            # (a changed overview is what the GenAI collector re-embeds), new titles are added
+            columns = [
+                'itemType', 'showType', 'id', 'imdbId', 'tmdbId', 'title', 'overview', 'releaseYear',
+                'originalTitle', 'genres', 'directors', 'cast', 'rating', 'runtime', 'year', 'firstAirYear',
+                'lastAirYear', 'creators', 'seasonCount', 'episodeCount'
+            ]
+            insert_sql = (update_existing_rows_sql(md, dataset, stage_tbl_name, raw_tbl_name, columns) +
+                          insert_new_rows_sql(md, dataset, stage_tbl_name, raw_tbl_name, columns=columns))
+        else:
+            insert_sql = insert_new_rows_sql(md, dataset, stage_tbl_name, raw_tbl_name)
     
-    print(f"Executing SQL: {insert_sql}")
-    md.sql(insert_sql)
-    
-    print(f"Rows in {raw_tbl_name}: {md.sql(f'SELECT COUNT(*) FROM {raw_tbl_name}').fetchone()[0]}")
-    print(f"Rows in {stage_tbl_name}: {md.sql(f'SELECT COUNT(*) FROM {stage_tbl_name}').fetchone()[0]}")
+        print(f"Executing SQL: {insert_sql}")
+        md.sql(insert_sql)
+        
+        raw_rows = md.sql(f'SELECT COUNT(*) FROM {raw_tbl_name}').fetchone()[0]
+        stage_rows = md.sql(f'SELECT COUNT(*) FROM {stage_tbl_name}').fetchone()[0]
+    print(f"Rows in {raw_tbl_name}: {raw_rows}")
+    print(f"Rows in {stage_tbl_name}: {stage_rows}")
+
+    done = time.perf_counter()
+    return {
+        'status': 'success',
+        'filepath': json_path,
+        'raw_rows': raw_rows,
+        'stage_rows': stage_rows,
+        'download_s': round(downloaded - start, 3),
+        'connection_wait_s': round(connected - downloaded, 3),
+        'load_s': round(done - connected, 3),
+        'total_s': round(done - start, 3)
+    }
+
+def load_chain(pool, chain, paths, request_json):
+    """Load the datasets of a chain in order; a failed dataset skips the rest of its chain"""
+    timings = {}
+    for dataset in chain:
+        if dataset in paths:
+            json_path = paths[dataset]
+            if not json_path:
+                print(f"No new job file for {dataset}, skipping")
+                timings[dataset] = {'status': 'no_new_file'}
+                continue
+        else:
+            json_path = get_latest_job_file(bucket_name, dataset)
+        print("JSON path retrived:", json_path)
+        if not json_path:
+            print(f"No file found for {dataset}")
+            timings[dataset] = {'status': 'no_file'}
+            continue
+        try:
+            timings[dataset] = process_dataset(pool, dataset, json_path, request_json)
+        except Exception as e:
+            print(f"Loading {dataset} failed: {e}")
+            timings[dataset] = {'status': 'error', 'filepath': json_path, 'message': str(e)}
+            for skipped in chain[chain.index(dataset) + 1:]:
+                timings[skipped] = {'status': 'skipped', 'message': f"{dataset} failed"}
+            break
+    return timings
 
 @functions_framework.http
 def main(request):
@@ -144,21 +366,16 @@ def main(request):
     # sm = secretmanager.SecretManagerServiceClient()
     # storage_client = storage.Client()
     
-    # Build the resource name of the secret version
-    name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
-    # Access the secret version
-    response = sm.access_secret_version(request={"name": name})
-    md_token = response.payload.data.decode("UTF-8")
-
-	# initiate the MotherDuck connection through an access token through
-    md = duckdb.connect(f'md:?motherduck_token={md_token}')
+    # initiate the warehouse connection (MotherDuck, or the local DuckDB file in local mode)
+    md = connect_warehouse()
     
     # create db if not exists
     create_db_sql = f"CREATE DATABASE IF NOT EXISTS {db};"
-    md.sql(create_db_sql)
+    if not DUCKDB_PATH:
+        md.sql(create_db_sql)
     
-    # drop if exists and create the raw schema
-    create_schema = f"DROP SCHEMA IF EXISTS {raw_db_schema} CASCADE; CREATE SCHEMA IF NOT EXISTS {raw_db_schema};"
+    # create the raw schema; every dataset replaces only its own raw table
+    create_schema = f"CREATE SCHEMA IF NOT EXISTS {raw_db_schema};"
     md.sql(create_schema)
     
     # create stage schema if first time running function
@@ -167,15 +384,22 @@ def main(request):
     
     print(md.sql("SHOW DATABASES;").show())
     
-    # List of tables to process
-    datasets = ['netflix_api', 'youtube_api', 'netflix_global', 'netflix_countries', 'netflix_most_popular']
-    
-    for dataset in datasets:
-        json_path = get_latest_job_file(bucket_name, dataset)
-        print("JSON path retrived:", json_path)
-        if json_path:
-            process_dataset(md, dataset, json_path, request_json)
-        else:
-            print(f"No file found for {dataset}")
+    # Exact job files passed by the flow; a dataset passed as null has no new job file this run
+    paths = (request_json or {}).get('paths', {})
+
+    # Load the dataset chains concurrently
+    start = time.perf_counter()
+    pool = connection_pool(md, LOAD_CONNECTIONS)
+    datasets = {}
+    with ThreadPoolExecutor(max_workers=len(dataset_chains)) as executor:
+        futures = [executor.submit(load_chain, pool, chain, paths, request_json) for chain in dataset_chains]
+        for future in futures:
+            datasets.update(future.result())
     
-    return {"message": "Data loading process completed"}, 200
\ No newline at end of file
+    failed = [dataset for dataset, result in datasets.items() if result['status'] == 'error']
+    response = {
+        "message": "Data loading process completed" if not failed else f"Loading failed for {', '.join(failed)}",
+        "datasets": datasets,
+        "elapsed_s": round(time.perf_counter() - start, 3)
+    }
+    return response, 200 if not failed else 500
@@ -1,6 +1,7 @@
 # TASK:  Create the schema to ensure it exists.
 
 import functions_framework
+import os
 from google.cloud import secretmanager
 import duckdb
 
@@ -14,29 +15,40 @@ db = 'ba882_project'
 schema = "stage"
 db_schema = f"{db}.{schema}"
 
-@functions_framework.http
-def task(request):
+# Local mode for offline runs: DUCKDB_PATH points at a local DuckDB file named after the database
+# (e.g. /data/ba882_project.duckdb) that stands in for MotherDuck
+DUCKDB_PATH = os.environ.get('DUCKDB_PATH')
 
-    # instantiate the services 
-    sm = secretmanager.SecretManagerServiceClient()
+def connect_warehouse():
+    """DuckDB connection to the warehouse: the local file in local mode, else MotherDuck"""
+    if DUCKDB_PATH:
+        if os.path.splitext(os.path.basename(DUCKDB_PATH))[0] != db:
+            raise ValueError(f"DUCKDB_PATH must point at a file named {db}.duckdb")
+        return duckdb.connect(DUCKDB_PATH)
 
-    # Build the resource name of the secret version
+    # Access the MotherDuck token in Secret Manager
+    sm = secretmanager.SecretManagerServiceClient()
     name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
-
-    # Access the secret version
     response = sm.access_secret_version(request={"name": name})
     md_token = response.payload.data.decode("UTF-8")
 
-    # initiate the MotherDuck connection through an access token through
-    md = duckdb.connect(f'md:?motherduck_token={md_token}') 
+    # initiate the MotherDuck connection through an access token
+    return duckdb.connect(f'md:?motherduck_token={md_token}')
+
+@functions_framework.http
+def task(request):
+
+    # warehouse connection (MotherDuck, or the local DuckDB file in local mode)
+    md = connect_warehouse()
 
     ##################################################### create the schema
 
     # define the DDL statement with an f string
     create_db_sql = f"CREATE DATABASE IF NOT EXISTS {db};"   
 
-    # execute the command to create the database
-    md.sql(create_db_sql)
+    # execute the command to create the database (in local mode the DuckDB file is the database)
+    if not DUCKDB_PATH:
+        md.sql(create_db_sql)
 
     # confirm it exists
     print(md.sql("SHOW DATABASES").show())
@@ -48,8 +60,8 @@ def task(request):
 
     # Netflix Top 10 Country List
     raw_tbl_name = f"{db_schema}.netflix_countries"
+    # kept across runs: extract-top10 only extracts the weeks after the latest week in this table
     raw_tbl_sql = f"""
-    DROP TABLE IF EXISTS {raw_tbl_name};
     CREATE TABLE IF NOT EXISTS {raw_tbl_name} (
         country_name VARCHAR
         ,country_code VARCHAR
@@ -66,8 +78,8 @@ def task(request):
 	
 	# Netflix Top 10 Global List
     raw_tbl_name = f"{db_schema}.netflix_global"
+    # kept across runs: extract-top10 only extracts the weeks after the latest week in this table
     raw_tbl_sql = f"""
-    DROP TABLE IF EXISTS {raw_tbl_name};
     CREATE TABLE IF NOT EXISTS {raw_tbl_name} (
         week TIMESTAMP
         ,category VARCHAR
@@ -87,8 +99,8 @@ def task(request):
 	
 	# Netflix Top 10 Most Popular
     raw_tbl_name = f"{db_schema}.netflix_most_popular"
+    # kept across runs: every extraction_date is appended, and a 304 from Netflix loads nothing new
     raw_tbl_sql = f"""
-    DROP TABLE IF EXISTS {raw_tbl_name};
     CREATE TABLE IF NOT EXISTS {raw_tbl_name} (
         category VARCHAR
         ,rank INT
@@ -40,7 +40,7 @@ gcloud functions deploy genai-schema-collector \
     --allow-unauthenticated \
     --memory 512MB 
 
-# a function that will parse a single post passed to it
+# a function that will embed a batch of content ids passed to it
 echo "======================================================"
 echo "deploying the record ingestor"
 echo "======================================================"
@@ -55,4 +55,27 @@ gcloud functions deploy genai-schema-ingestor \
     --service-account id-82-group-project@ba882-inclass-project.iam.gserviceaccount.com \
     --region us-central1 \
     --allow-unauthenticated \
-    --memory 1GB
\ No newline at end of file
+    --memory 1GB \
+    --timeout 540s
+
+# semantic search over the embedded overview chunks
+echo "======================================================"
+echo "deploying the retriever"
+echo "======================================================"
+
+# the local vector index module is kept once, with the ingestor; ship a copy with the retriever
+cp /home/sekka/BA882-Team05-Project/genai/pipeline/functions/ingestor/vector_store.py \
+    /home/sekka/BA882-Team05-Project/genai/pipeline/functions/retriever/vector_store.py
+
+gcloud functions deploy genai-retriever \
+    --gen2 \
+    --runtime python311 \
+    --trigger-http \
+    --entry-point task \
+    --source /home/sekka/BA882-Team05-Project/genai/pipeline/functions/retriever \
+    --stage-bucket ba882-team05 \
+    --service-account id-82-group-project@ba882-inclass-project.iam.gserviceaccount.com \
+    --region us-central1 \
+    --allow-unauthenticated \
+    --memory 1GB \
+    --min-instances 1
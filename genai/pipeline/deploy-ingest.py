@@ -8,7 +8,7 @@ if __name__ == "__main__":
         name="genai-overview-ingestion",
         work_pool_name="ba882-05-pool",
         job_variables={"env": {"Team-05": "loves-to-code"},
-                       "pip_packages": ["pandas", "requests"]},
+                       "pip_packages": ["pandas", "requests", "httpx"]},
         cron="15 1 * * *",
         tags=["prod"],
         description="The pipeline to grab unprocessed posts and process to store in the vector database",
@@ -1,8 +1,18 @@
 # imports
+import asyncio
+import random
+import time
+import httpx
 import requests
 from prefect import flow, task
-from prefect.futures import wait
-from prefect.task_runners import ThreadPoolTaskRunner
+
+# ingestion settings
+BATCH_SIZE = 100            # content ids per ingestor call
+MAX_CONCURRENCY = 8         # ceiling of concurrent ingestor calls
+MIN_CONCURRENCY = 1
+MAX_ATTEMPTS = 5            # per batch, including the first try
+REQUEST_TIMEOUT = 600       # seconds, a bit over the ingestor's 540s timeout
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 # helper function - generic invoker
 def invoke_gcf(url:str, payload:dict):
@@ -10,6 +20,92 @@ def invoke_gcf(url:str, payload:dict):
     response.raise_for_status()
     return response.json()
 
+# helper - split the collected ids into size-bounded batches of one content type
+# (key 'content_ids' to embed them, 'deleted_ids' to delete their vectors)
+def make_batches(ids, content_type, key="content_ids", batch_size=BATCH_SIZE):
+    return [{key: ids[i:i + batch_size], "content_type": content_type} for i in range(0, len(ids), batch_size)]
+
+# helper - number of ids in a batch
+def batch_items(batch):
+    return len(batch.get("content_ids") or batch.get("deleted_ids") or [])
+
+# helper - latency percentiles of the batches
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit that adapts to the ingestor: halved when it answers 429/5xx, grown by one
+    after a run of successes (additive increase, multiplicative decrease)
+    """
+    def __init__(self, initial, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self.successes = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self, throttled):
+        async with self.condition:
+            self.active -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+async def post_batch(client, limiter, url, batch):
+    """Send one batch, retrying throttled / failed calls with jittered exponential backoff"""
+    start = time.perf_counter()
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        await limiter.acquire()
+        throttled = True
+        try:
+            response = await client.post(url, json=batch)
+            throttled = response.status_code in RETRY_STATUSES
+            if not throttled:
+                response.raise_for_status()
+                return {"ok": True, "items": batch_items(batch), "attempts": attempt,
+                        "latency_s": time.perf_counter() - start, "result": response.json()}
+            retry_after = response.headers.get("retry-after")
+            error = f"HTTP {response.status_code}"
+        except httpx.TransportError as e:
+            retry_after = None
+            error = repr(e)
+        except httpx.HTTPStatusError as e:
+            # other 4xx: the batch itself is bad, retrying will not help
+            throttled = False
+            return {"ok": False, "items": batch_items(batch), "attempts": attempt,
+                    "latency_s": time.perf_counter() - start, "error": str(e)}
+        finally:
+            await limiter.release(throttled)
+
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else min(60, 2 ** attempt) * random.uniform(0.5, 1)
+        print(f"{batch['content_type']} batch of {batch_items(batch)} got {error}, "
+              f"retrying in {delay:.1f}s (concurrency now {limiter.limit})")
+        await asyncio.sleep(delay)
+
+    return {"ok": False, "items": batch_items(batch), "attempts": MAX_ATTEMPTS,
+            "latency_s": time.perf_counter() - start, "error": error}
+
+async def dispatch(url, batches, concurrency):
+    """Fan the batches out over one pooled keep-alive client"""
+    limiter = AdaptiveLimiter(concurrency)
+    limits = httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY)
+    async with httpx.AsyncClient(limits=limits, timeout=REQUEST_TIMEOUT) as client:
+        return await asyncio.gather(*[post_batch(client, limiter, url, batch) for batch in batches])
+
 # setup the schema in the warehouse and vector store (index)
 @task(retries=2)
 def schema_setup():
@@ -26,17 +122,46 @@ def collect():
     resp = invoke_gcf(url, payload={})
     return resp
 
-# process a content item passed to it from an upstream task
-@task(retries=3)
-def ingest(payload):
-    """For a given content id and type, embed the chunks to support GenAI workflows"""
+# process all the batches with one task; retries happen per batch inside it
+@task
+def ingest(batches, concurrency=4):
+    """For batches of content ids, embed the chunks to support GenAI workflows"""
     url = "https://us-central1-ba882-inclass-project.cloudfunctions.net/genai-schema-ingestor"
-    print(f"Processing {payload['content_type']} id: {payload['content_id']}")
-    resp = invoke_gcf(url, payload=payload)
-    return resp
+    start = time.perf_counter()
+    results = asyncio.run(dispatch(url, batches, concurrency))
+    elapsed = time.perf_counter() - start
+
+    for batch, result in zip(batches, results):
+        print(f"{batch['content_type']} {'delete ' if 'deleted_ids' in batch else ''}batch of {result['items']}: {'ok' if result['ok'] else 'failed'} "
+              f"in {result['latency_s']:.2f}s ({result['attempts']} attempts)")
+
+    items = sum(result["items"] for result in results if result["ok"])
+    latencies = [result["latency_s"] for result in results]
 
-# job that uses the threadpool to process content in blocks
-@flow(task_runner=ThreadPoolTaskRunner(max_workers=5), log_prints=True)
+    # embedding cache use over the run
+    embedded = [result["result"] for result in results if result["ok"] and "cache_hits" in result["result"]]
+    cache_hits = sum(result["cache_hits"] for result in embedded)
+    chunks = cache_hits + sum(result["cache_misses"] for result in embedded)
+    stats = {
+        "batches": len(batches),
+        "failed_batches": sum(not result["ok"] for result in results),
+        "items": items,
+        "elapsed_s": round(elapsed, 2),
+        "items_per_second": round(items / elapsed, 1) if elapsed > 0 else None,
+        "batch_latency_s": {"p50": round(percentile(latencies, 50), 2), "p95": round(percentile(latencies, 95), 2),
+                            "p99": round(percentile(latencies, 99), 2), "max": round(max(latencies), 2)},
+        "embedding_calls": sum(result["embedding_calls"] for result in embedded),
+        "embedding_cache_hit_rate": round(cache_hits / chunks, 3) if chunks else None,
+        "embedding_calls_saved": sum(result["saved_calls"] for result in embedded)
+    }
+    print(f"Ingestion stats: {stats}")
+    if stats["failed_batches"]:
+        raise RuntimeError(f"{stats['failed_batches']} of {len(batches)} batches failed: "
+                           f"{[result['error'] for result in results if not result['ok']]}")
+    return stats
+
+# job that fans the content out in batches
+@flow(log_prints=True)
 def job():
 
     result = schema_setup()
@@ -45,25 +170,24 @@ def job():
     collect_result = collect()
     movie_ids = collect_result.get("movies", {}).get("ids", [])
     show_ids = collect_result.get("shows", {}).get("ids", [])
-    print(f"Movies to process: {len(movie_ids)}")
-    print(f"Shows to process: {len(show_ids)}")
-
-    processed_content = []
-
-    if movie_ids or show_ids:
-        print("Starting map operation over the identified content")
-
-        for movie_id in movie_ids:
-            processed_content.append(ingest.submit({"content_id": movie_id, "content_type": "movie"}))
+    deleted_movie_ids = collect_result.get("movies", {}).get("deleted_ids", [])
+    deleted_show_ids = collect_result.get("shows", {}).get("deleted_ids", [])
+    print(f"Movies to process: {len(movie_ids)} ({len(collect_result.get('movies', {}).get('changed_ids', []))} changed), to delete: {len(deleted_movie_ids)}")
+    print(f"Shows to process: {len(show_ids)} ({len(collect_result.get('shows', {}).get('changed_ids', []))} changed), to delete: {len(deleted_show_ids)}")
+    for kind in ("movies", "shows"):
+        if collect_result.get(kind, {}).get("deletes_skipped"):
+            print(f"The collector held back the {kind} deletes: {collect_result[kind]['deletes_skipped']}")
 
-        for show_id in show_ids:
-            processed_content.append(ingest.submit({"content_id": show_id, "content_type": "show"}))
+    if movie_ids or show_ids or deleted_movie_ids or deleted_show_ids:
+        batches = (make_batches(movie_ids, "movie") + make_batches(show_ids, "show") +
+                   make_batches(deleted_movie_ids, "movie", key="deleted_ids") +
+                   make_batches(deleted_show_ids, "show", key="deleted_ids"))
+        print(f"Starting the fan-out over {len(batches)} batches")
+        ingest(batches)
 
-        wait(processed_content)
-    
     else:
         print("No content to process, exiting now.")
 
 # the job
 if __name__ == "__main__":
-    job()
\ No newline at end of file
+    job()
@@ -16,9 +16,79 @@ show_schema = "genai_shows"
 movie_db_schema = f"{db}.{movie_schema}"
 show_db_schema = f"{db}.{show_schema}"
 
+# chunker settings of the ingestor, part of the content hash so a settings change re-embeds everything
+CHUNK_SIZE = 350
+CHUNK_OVERLAP = 75
+CHUNKER_SETTINGS = f"recursive-character:{CHUNK_SIZE}:{CHUNK_OVERLAP}"
+
+# safety net for deletes: a showType whose catalog is empty, or whose deletes would remove more than
+# this share of the tracked ids, keeps its vectors (a partial or in-flight load looks like mass deletion)
+MAX_DELETE_FRACTION = 0.05
+
+# hash of the normalized overview (nbsp -> space, whitespace collapsed) and the chunker settings,
+# computed the same way by the ingestor when it records what it embedded
+content_hash_sql = f"md5(trim(regexp_replace(replace(coalesce(overview, ''), chr(160), ' '), '\\s+', ' ', 'g')) || '|{CHUNKER_SETTINGS}')"
+
+def collect_delta(md, show_type, tbl_name, force_deletes=False):
+    """
+    The ids of one showType to (re-)embed and to delete: new ids are not tracked yet, changed ids were
+    embedded from a different overview or chunker (or before hashes were tracked), deleted ids are
+    tracked but gone from the (cumulative) catalog. Suspiciously large deletes are held back unless forced.
+    """
+    delta_sql = f"""
+    WITH current AS (
+        SELECT CAST(id AS VARCHAR) AS id, {content_hash_sql} AS content_hash
+        FROM {db}.stage.netflix_api
+        WHERE showType = '{show_type}'
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY id ORDER BY overview) = 1
+    )
+    SELECT c.id, t.id IS NULL AS is_new
+    FROM current c
+    LEFT JOIN {tbl_name} t ON t.id = c.id
+    WHERE t.id IS NULL OR t.content_hash IS DISTINCT FROM c.content_hash
+    """
+    delta = md.sql(delta_sql).fetchall()
+    new_ids = [id for id, is_new in delta if is_new]
+    changed_ids = [id for id, is_new in delta if not is_new]
+
+    deleted_sql = f"""
+    SELECT t.id
+    FROM {tbl_name} t
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {db}.stage.netflix_api s
+        WHERE s.showType = '{show_type}' AND CAST(s.id AS VARCHAR) = t.id
+    )
+    """
+    deleted_ids = [row[0] for row in md.sql(deleted_sql).fetchall()]
+
+    deletes_skipped = None
+    if deleted_ids and not force_deletes:
+        catalog_count = md.sql(f"SELECT COUNT(*) FROM {db}.stage.netflix_api WHERE showType = '{show_type}'").fetchone()[0]
+        tracked_count = md.sql(f"SELECT COUNT(*) FROM {tbl_name}").fetchone()[0]
+        if catalog_count == 0:
+            deletes_skipped = f"the {show_type} catalog is empty"
+        elif len(deleted_ids) > MAX_DELETE_FRACTION * tracked_count:
+            deletes_skipped = f"{len(deleted_ids)} of {tracked_count} tracked ids would be deleted"
+        if deletes_skipped:
+            print(f"Skipping the {show_type} deletes: {deletes_skipped} (pass force_deletes to apply them)")
+            deleted_ids = []
+
+    return {
+        "num_entries": len(new_ids) + len(changed_ids),
+        "ids": new_ids + changed_ids,
+        "new_ids": new_ids,
+        "changed_ids": changed_ids,
+        "deleted_ids": deleted_ids,
+        "deletes_skipped": deletes_skipped
+    }
+
 @functions_framework.http
 def task(request):
 
+    # {"force_deletes": true} applies deletes even past the safety net
+    request_json = request.get_json(silent=True) or {}
+    force_deletes = bool(request_json.get('force_deletes'))
+
     # job_id
     job_id = datetime.datetime.now().strftime("%Y%m%d%H%M") + "-" + str(uuid.uuid4())
 
@@ -37,46 +107,16 @@ def task(request):
 
     ##################################################### get the records delta for movies
 
-    movie_sql = f"""
-    SELECT 
-        m.id 
-    FROM 
-        {db}.stage.netflix_api m
-    WHERE
-        m.showType = 'movie' AND
-        CAST(m.id AS VARCHAR) NOT IN (SELECT CAST(id AS VARCHAR) FROM {movie_db_schema}.pinecone_movies)
-    """
-    
-    movie_df = md.sql(movie_sql).df()
-    print(f"New movies: {movie_df.shape[0]}")
-
-    movie_ids = movie_df.id.to_list()
+    movie_delta = collect_delta(md, 'movie', f"{movie_db_schema}.pinecone_movies", force_deletes)
+    print(f"New movies: {len(movie_delta['new_ids'])}, changed: {len(movie_delta['changed_ids'])}, deleted: {len(movie_delta['deleted_ids'])}")
 
     ##################################################### get the records delta for shows
 
-    show_sql = f"""
-    SELECT 
-        s.id 
-    FROM 
-        {db}.stage.netflix_api s
-    WHERE
-        s.showType = 'series' AND 
-        CAST(s.id AS VARCHAR) NOT IN (SELECT CAST(id AS VARCHAR) FROM {show_db_schema}.pinecone_shows)
-    """
-    
-    show_df = md.sql(show_sql).df()
-    print(f"New shows: {show_df.shape[0]}")
-
-    show_ids = show_df.id.to_list()
+    show_delta = collect_delta(md, 'series', f"{show_db_schema}.pinecone_shows", force_deletes)
+    print(f"New shows: {len(show_delta['new_ids'])}, changed: {len(show_delta['changed_ids'])}, deleted: {len(show_delta['deleted_ids'])}")
 
     return {
-        "movies": {
-            "num_entries": len(movie_ids),
-            "ids": movie_ids
-        },
-        "shows": {
-            "num_entries": len(show_ids),
-            "ids": show_ids
-        },
+        "movies": movie_delta,
+        "shows": show_delta,
         "job_id": job_id
     }, 200
\ No newline at end of file
@@ -5,119 +5,335 @@ import duckdb
 import pandas as pd
 from pinecone import Pinecone, ServerlessSpec
 import json
+import os
+import time
+import hashlib
 
 import vertexai
 from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from vector_store import LocalVectorIndex
+
 # settings
-project_id = 'ba882-sekka'
+project_id = 'ba882-inclass-project'
 region_id = 'us-central1'
 secret_id = 'duckdb-token'
 version_id = 'latest'
 vector_secret = "pinecone"
 
 # db setup
-db = 'entertainment'
-movie_schema = "movie_embeddings"
-show_schema = "show_embeddings"
+db = 'ba882_project'
+movie_schema = "genai_movies"
+show_schema = "genai_shows"
 movie_db_schema = f"{db}.{movie_schema}"
 show_db_schema = f"{db}.{show_schema}"
+cache_tbl_name = f"{db}.genai_cache.chunk_embeddings"
 vector_index = "overview-content"
 
-vertexai.init(project=project_id, location=region_id)
+# Local vector index for offline runs: LOCAL_VECTOR_DIR holds a LocalVectorIndex (vector_store.py)
+# standing in for the Pinecone index, with the same upsert / delete / list calls
+LOCAL_VECTOR_DIR = os.environ.get('LOCAL_VECTOR_DIR')
 
-@functions_framework.http
-def task(request):
-    # Parse the request data
-    request_json = request.get_json(silent=True)
-    print(f"request: {json.dumps(request_json)}")
+# warehouse tracking table and netflix_api showType of each content type
+content_tables = {
+    'movie': (f"{movie_db_schema}.pinecone_movies", 'movie'),
+    'show': (f"{show_db_schema}.pinecone_shows", 'series')
+}
 
-    # read in from request
-    content_id = request_json.get('content_id')
-    content_type = request_json.get('content_type')  # 'movie' or 'show'
+# embedding model
+MODEL_NAME = "text-embedding-005"
+DIMENSIONALITY = 768
+TASK_TYPE = "RETRIEVAL_DOCUMENT"
+
+# chunker settings, part of the content hash so a settings change re-embeds everything
+CHUNK_SIZE = 350
+CHUNK_OVERLAP = 75
+CHUNKER_SETTINGS = f"recursive-character:{CHUNK_SIZE}:{CHUNK_OVERLAP}"
 
-    # instantiate the services 
-    sm = secretmanager.SecretManagerServiceClient()
+# hash of the normalized overview (nbsp -> space, whitespace collapsed) and the chunker settings,
+# the same expression the collector compares against to find changed overviews
+content_hash_sql = f"md5(trim(regexp_replace(replace(coalesce(overview, ''), chr(160), ' '), '\\s+', ' ', 'g')) || '|{CHUNKER_SETTINGS}')"
 
-    # Build the resource name of the secret version
-    name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
+# batch limits
+EMBEDDING_BATCH_SIZE = 250         # max inputs per get_embeddings request
+EMBEDDING_BATCH_MAX_CHARS = 60000  # keeps a request under the 20k token limit (~4 chars per token)
+UPSERT_BATCH_SIZE = 200            # vectors per upsert request (768 floats each, well under the 2MB request limit)
+DELETE_BATCH_SIZE = 1000           # max ids per delete request
 
-    # Access the secret version
-    response = sm.access_secret_version(request={"name": name})
-    md_token = response.payload.data.decode("UTF-8")
+vertexai.init(project=project_id, location=region_id)
 
-    # initiate the MotherDuck connection through an access token
-    md = duckdb.connect(f'md:?motherduck_token={md_token}')
+# Instantiate the services once per instance, every request reuses them
+sm = secretmanager.SecretManagerServiceClient()
 
-    # get the content
-    if content_type == 'movie':
-        content_df = md.sql(f"SELECT * FROM {db}.stage.netflix_api WHERE id = '{content_id}' AND showType = 'movie' LIMIT 1;").df()
-        db_schema = movie_db_schema
-        table_name = 'pinecone_movies'
-    else:
-        content_df = md.sql(f"SELECT * FROM {db}.stage.netflix_api WHERE id = '{content_id}' AND showType = 'series' LIMIT 1;").df()
-        db_schema = show_db_schema
-        table_name = 'pinecone_shows'
-
-    # content_df['timestamp'] = pd.to_datetime(content_df['release_year'], format='%Y').astype('int64') // 10**9
-
-    # connect to pinecone
+# Build the resource name of the secret version
+name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
+
+# Access the secret version
+response = sm.access_secret_version(request={"name": name})
+md_token = response.payload.data.decode("UTF-8")
+
+# initiate the MotherDuck connection through an access token
+md = duckdb.connect(f'md:?motherduck_token={md_token}')
+
+# connect to the vector index
+if LOCAL_VECTOR_DIR:
+    index = LocalVectorIndex(LOCAL_VECTOR_DIR, dimension=DIMENSIONALITY)
+else:
     vector_name = f"projects/{project_id}/secrets/{vector_secret}/versions/{version_id}"
     response = sm.access_secret_version(request={"name": vector_name})
     pinecone_token = response.payload.data.decode("UTF-8")
     pc = Pinecone(api_key=pinecone_token)
     index = pc.Index(vector_index)
-    print(f"index stats: {index.describe_index_stats()}")
 
-    # setup the embedding model
-    MODEL_NAME = "text-embedding-005"
-    DIMENSIONALITY = 768
-    task = "RETRIEVAL_DOCUMENT"
-    model = TextEmbeddingModel.from_pretrained(MODEL_NAME)
+# setup the embedding model
+model = TextEmbeddingModel.from_pretrained(MODEL_NAME)
+
+# setup the splitter
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
+    length_function=len,
+    is_separator_regex=False,
+)
+
+##################################################### helpers
+
+def fetch_contents(content_ids, content_type):
+    """Fetch the overviews of many content ids of one type with one query (ids missing from the catalog are left out)"""
+    _, show_type = content_tables[content_type]
+    query = f"""
+    SELECT CAST(id AS VARCHAR) AS id, title, overview, {content_hash_sql} AS content_hash
+    FROM {db}.stage.netflix_api
+    WHERE showType = '{show_type}' AND CAST(id AS VARCHAR) IN (SELECT UNNEST(?))
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY id ORDER BY overview) = 1
+    """
+    rows = md.execute(query, [[str(content_id) for content_id in content_ids]]).fetchall()
+    return [dict(zip(('id', 'title', 'overview', 'content_hash'), row)) for row in rows]
+
+def tracked_chunk_counts(tbl_name, content_ids):
+    """{id: chunk_count} of the ids already in the tracking table (None when tracked before chunk counts were)"""
+    query = f"SELECT id, chunk_count FROM {tbl_name} WHERE id IN (SELECT UNNEST(?))"
+    return dict(md.execute(query, [[str(content_id) for content_id in content_ids]]).fetchall())
 
-    # setup the splitter
+def chunk_vector_ids(content_id, start, chunk_count):
+    """Vector ids of the chunks of a content from index start on; listed from the index when the count is unknown"""
+    if chunk_count is None:
+        return [vector_id for page in index.list(prefix=f"{content_id}_") for vector_id in page
+                if int(vector_id.rsplit('_', 1)[1]) >= start]
+    return [f"{content_id}_{cid}" for cid in range(start, chunk_count)]
+
+def delete_vectors(vector_ids):
+    """Delete vectors by id, in batches the index accepts"""
+    for i in range(0, len(vector_ids), DELETE_BATCH_SIZE):
+        index.delete(ids=vector_ids[i:i + DELETE_BATCH_SIZE])
+
+def chunk_contents(contents, content_type):
+    """Split every overview into chunks; returns the chunk docs (without values) in content order"""
     chunk_docs = []
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=350,
-        chunk_overlap=75,
-        length_function=len,
-        is_separator_regex=False,
-    )
-
-    # iterate over the row
-    content_data = content_df.to_dict(orient="records")[0]
-    text = content_data['overview'].replace('\xa0', ' ')
-    chunks = text_splitter.create_documents([text])
-    id = content_data['id']
-    for cid, chunk in enumerate(chunks):
-        chunk_text = chunk.page_content
-        input = TextEmbeddingInput(chunk_text, task)
-        embedding = model.get_embeddings([input])
-        chunk_doc = {
-            'id': id + '_' + str(cid),
-            'values': embedding[0].values,
-            'metadata': {
-                'title': content_data['title'],
-                'chunk_index': cid,
-                'content_id': id,
-                'chunk_text': chunk_text,
-                'content_type': content_type
-            }
-        }
-        chunk_docs.append(chunk_doc)
-    
-    # flatten to dataframe for the ingestion
-    chunk_df = pd.DataFrame(chunk_docs)
-    print(f"{content_type} id {id} has {len(chunk_df)} chunks")
+    for content_data in contents:
+        if not content_data['overview']:
+            continue
+        text = content_data['overview'].replace('\xa0', ' ')
+        id = content_data['id']
+        for cid, chunk_text in enumerate(text_splitter.split_text(text)):
+            chunk_docs.append({
+                'id': id + '_' + str(cid),
+                'metadata': {
+                    'title': content_data['title'],
+                    'chunk_index': cid,
+                    'content_id': id,
+                    'chunk_text': chunk_text,
+                    'content_type': content_type
+                }
+            })
+    return chunk_docs
+
+def embedding_batches(chunk_docs):
+    """Group the chunks into the largest requests the embedding API accepts (by count and by text size)"""
+    batch, batch_chars = [], 0
+    for doc in chunk_docs:
+        n_chars = len(doc['metadata']['chunk_text'])
+        if batch and (len(batch) == EMBEDDING_BATCH_SIZE or batch_chars + n_chars > EMBEDDING_BATCH_MAX_CHARS):
+            yield batch
+            batch, batch_chars = [], 0
+        batch.append(doc)
+        batch_chars += n_chars
+    if batch:
+        yield batch
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def cached_embeddings(text_hashes):
+    """{text_hash: embedding} of the chunk texts already embedded with this model and task"""
+    query = f"""
+    SELECT text_hash, embedding
+    FROM {cache_tbl_name}
+    WHERE model = ? AND task_type = ? AND text_hash IN (SELECT UNNEST(?))
+    """
+    rows = md.execute(query, [MODEL_NAME, TASK_TYPE, list(text_hashes)]).fetchall()
+    return {hash: list(embedding) for hash, embedding in rows}
+
+def cache_embeddings(embeddings):
+    """Add {text_hash: embedding} to the cache (hashes another run cached meanwhile are kept)"""
+    md.execute(f"""
+    INSERT OR IGNORE INTO {cache_tbl_name} (model, task_type, text_hash, embedding)
+    SELECT ?, ?, UNNEST(?), UNNEST(CAST(? AS FLOAT[{DIMENSIONALITY}][]));
+    """, [MODEL_NAME, TASK_TYPE, list(embeddings), list(embeddings.values())])
+
+def embed_chunks(chunk_docs):
+    """
+    Add the embedding values to every chunk doc. Chunk texts found in the embedding cache are not
+    embedded again; the rest are embedded once per distinct text, one get_embeddings call per batch.
+    """
+    hashes = [text_hash(doc['metadata']['chunk_text']) for doc in chunk_docs]
+    embeddings = cached_embeddings(set(hashes))
+    hits = sum(hash in embeddings for hash in hashes)
+
+    # one input per distinct text missing from the cache
+    misses = {}
+    for doc, hash in zip(chunk_docs, hashes):
+        if hash not in embeddings:
+            misses.setdefault(hash, doc)
+
+    calls = 0
+    new_embeddings = {}
+    for batch in embedding_batches(list(misses.values())):
+        inputs = [TextEmbeddingInput(doc['metadata']['chunk_text'], TASK_TYPE) for doc in batch]
+        for doc, embedding in zip(batch, model.get_embeddings(inputs)):
+            new_embeddings[text_hash(doc['metadata']['chunk_text'])] = embedding.values
+        calls += 1
+    if new_embeddings:
+        cache_embeddings(new_embeddings)
+    embeddings.update(new_embeddings)
+
+    for doc, hash in zip(chunk_docs, hashes):
+        doc['values'] = embeddings[hash]
+
+    # calls the batch would have needed without the cache
+    uncached_calls = sum(1 for _ in embedding_batches(chunk_docs))
+    return {
+        'embedding_calls': calls,
+        'cache_hits': hits,
+        'cache_misses': len(chunk_docs) - hits,
+        'embedded_texts': len(misses),
+        'cache_hit_rate': round(hits / len(chunk_docs), 3) if chunk_docs else None,
+        'saved_calls': uncached_calls - calls
+    }
+
+def ingest(content_ids, content_type):
+    """Embed and upsert the chunks of many content ids of one type, then record them in the warehouse"""
+    start = time.perf_counter()
+    tbl_name, _ = content_tables[content_type]
+
+    # get the content
+    contents = fetch_contents(content_ids, content_type)
+    found_ids = [content_data['id'] for content_data in contents]
+    missing_ids = sorted(set(map(str, content_ids)) - set(found_ids))
+    fetch_s = time.perf_counter() - start
+
+    # chunk and embed everything in as few requests as possible
+    chunk_docs = chunk_contents(contents, content_type)
+    embed_start = time.perf_counter()
+    embedding_stats = embed_chunks(chunk_docs)
+    embedding_calls = embedding_stats['embedding_calls']
+    embed_s = time.perf_counter() - embed_start
+    print(f"{len(found_ids)} {content_type} ids have {len(chunk_docs)} chunks, embedded in {embedding_calls} calls "
+          f"({embedding_stats['cache_hits']} cache hits, {embedding_stats['saved_calls']} calls saved)")
 
     # upsert to pinecone
-    index.upsert_from_dataframe(chunk_df, batch_size=100)
+    upsert_start = time.perf_counter()
+    if chunk_docs:
+        index.upsert(vectors=chunk_docs, batch_size=UPSERT_BATCH_SIZE)
+    upsert_s = time.perf_counter() - upsert_start
+
+    # re-embedded overviews that now have fewer chunks leave stale vectors behind
+    chunk_counts = {id: 0 for id in found_ids}
+    for doc in chunk_docs:
+        chunk_counts[doc['metadata']['content_id']] += 1
+    stale_ids = [vector_id
+                 for id, old_count in tracked_chunk_counts(tbl_name, found_ids).items()
+                 for vector_id in chunk_vector_ids(id, chunk_counts[id], old_count)]
+    delete_vectors(stale_ids)
+
+    # record the whole batch in the warehouse with the hash it was embedded from (a retried or
+    # re-embedded id replaces its earlier row)
+    if found_ids:
+        md.execute(f"""
+        INSERT OR REPLACE INTO {tbl_name} (id, parsed_timestamp, content_hash, chunk_count)
+        SELECT UNNEST(?), CURRENT_TIMESTAMP, UNNEST(?), UNNEST(?);
+        """, [found_ids, [content_data['content_hash'] for content_data in contents], [chunk_counts[id] for id in found_ids]])
+        print(f"{len(found_ids)} {content_type} ids added to the warehouse for job tracking")
+
+    elapsed = time.perf_counter() - start
+    return {
+        'content_type': content_type,
+        'ingested': len(found_ids),
+        'missing': missing_ids,
+        'chunks': len(chunk_docs),
+        'stale_vectors_deleted': len(stale_ids),
+        **embedding_stats,
+        'chunks_per_call': round(embedding_stats['embedded_texts'] / embedding_calls, 1) if embedding_calls else None,
+        'chunks_per_second': round(len(chunk_docs) / embed_s, 1) if embed_s > 0 else None,
+        'fetch_s': round(fetch_s, 3),
+        'embed_s': round(embed_s, 3),
+        'upsert_s': round(upsert_s, 3),
+        'elapsed_s': round(elapsed, 3)
+    }
+
+def delete_contents(content_ids, content_type):
+    """Delete the vectors of content gone from the catalog and stop tracking it"""
+    start = time.perf_counter()
+    tbl_name, _ = content_tables[content_type]
+    tracked = tracked_chunk_counts(tbl_name, content_ids)
+    vector_ids = [vector_id for id, chunk_count in tracked.items() for vector_id in chunk_vector_ids(id, 0, chunk_count)]
+    delete_vectors(vector_ids)
+    if tracked:
+        md.execute(f"DELETE FROM {tbl_name} WHERE id IN (SELECT UNNEST(?));", [list(tracked)])
+    print(f"{len(tracked)} {content_type} ids deleted with {len(vector_ids)} vectors")
+    return {
+        'content_type': content_type,
+        'deleted': len(tracked),
+        'vectors_deleted': len(vector_ids),
+        'elapsed_s': round(time.perf_counter() - start, 3)
+    }
+
+@functions_framework.http
+def task(request):
+    """
+    Embed the overview chunks of content into the vector index.
+    Takes one id ('content_id') or a batch of ids of the same type ('content_ids'), plus 'content_type'.
+    Ids under 'deleted_ids' have their vectors deleted instead.
+    """
+    # Parse the request data
+    request_json = request.get_json(silent=True)
+    print(f"request: {json.dumps(request_json)}")
+
+    if not request_json:
+        return {"error": "A JSON body is required."}, 400
+
+    # read in from request
+    content_type = request_json.get('content_type')  # 'movie' or 'show'
+    if content_type not in content_tables:
+        content_type = 'show'
+
+    # content gone from the catalog
+    if 'deleted_ids' in request_json:
+        deleted_ids = request_json['deleted_ids']
+        if not isinstance(deleted_ids, list):
+            return {"error": "'deleted_ids' must be a list."}, 400
+        return delete_contents(deleted_ids, content_type), 200
+
+    content_ids = request_json.get('content_ids')
+    if content_ids is None and request_json.get('content_id') is not None:
+        content_ids = [request_json['content_id']]
+    if not content_ids or not isinstance(content_ids, list):
+        return {"error": "A 'content_id' or a non-empty 'content_ids' list is required."}, 400
 
-    # add record to warehouse 
-    md.sql(f"INSERT INTO {db_schema}.{table_name} (id, parsed_timestamp) VALUES ('{id}');")
-    print(f"{content_type} {id} added to the warehouse for job tracking")
+    result = ingest(content_ids, content_type)
+    print(f"result: {json.dumps(result)}")
 
     # finish the job
-    return {}, 200
\ No newline at end of file
+    return result, 200
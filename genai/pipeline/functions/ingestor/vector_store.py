@@ -0,0 +1,445 @@
+# Local stand-in for the Pinecone index
+#
+# The same upsert / query / delete / list surface as the Pinecone Index the GenAI functions use, kept
+# in one directory so embeddings can be written and searched offline:
+#
+#   vectors.f32     memory-mapped float32 matrix, one L2-normalized row per vector (cosine = dot product)
+#   alive.u8        1 for rows holding a vector, 0 for free rows (deleted rows are reused)
+#   metadata.duckdb id -> row plus the chunk metadata (title, content_id, chunk_index, content_type, chunk_text)
+#   index.json      dimension, capacity, row count and IVF list count, with a version bumped by every write
+#   ivf.*           optional IVF index (k-means lists) for approximate search, see build_ann_index
+#
+# Search is exact (batched matrix products over the whole matrix) unless an IVF index was built.
+#
+# Several processes can share a directory (e.g. the ingestor writing while the retriever serves):
+# metadata.duckdb is only opened for the duration of a call (read-only for reads, whose results are
+# cached until the index changes), and every call first picks up index.json changes written by
+# another process.
+
+import json
+import os
+import time
+from contextlib import contextmanager
+import duckdb
+import numpy as np
+
+METADATA_COLUMNS = {
+    'title': 'VARCHAR',
+    'content_id': 'VARCHAR',
+    'chunk_index': 'INTEGER',
+    'content_type': 'VARCHAR',
+    'chunk_text': 'VARCHAR'
+}
+MIN_CAPACITY = 1024
+SEARCH_BLOCK_ROWS = 65536   # rows scored per matrix product, bounds the memory of a batched search
+LIST_PAGE_SIZE = 100        # ids per page of list(), like Pinecone
+META_LOCK_ATTEMPTS = 50     # tries to open metadata.duckdb while another process holds a conflicting lock
+META_LOCK_WAIT_S = 0.05     # base wait between those tries (grows linearly)
+
+def normalize(values):
+    """L2-normalize the rows of a float32 matrix (zero rows stay zero)"""
+    values = np.asarray(values, dtype=np.float32)
+    norms = np.linalg.norm(values, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return values / norms
+
+def top_k_rows(scores, k):
+    """Column indices of the k best scores of every row, best first"""
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1)
+
+class LocalVectorIndex:
+    """A Pinecone-like index over a memory-mapped float32 matrix (cosine metric)"""
+
+    def __init__(self, directory, dimension=768, n_probe=16):
+        self.directory = directory
+        self.n_probe = n_probe
+        os.makedirs(directory, exist_ok=True)
+
+        self.state_path = os.path.join(directory, 'index.json')
+        self.state_stamp = None
+        self.state = {'dimension': dimension, 'capacity': 0, 'n_rows': 0, 'n_lists': None, 'version': 0}
+        self.dimension = dimension
+
+        self.meta_path = os.path.join(directory, 'metadata.duckdb')
+        if not os.path.exists(self.meta_path):
+            with self._meta(read_only=False) as meta:
+                columns = ", ".join(f"{column} {column_type}" for column, column_type in METADATA_COLUMNS.items())
+                meta.sql(f"CREATE TABLE IF NOT EXISTS vectors (id VARCHAR PRIMARY KEY, row INTEGER, {columns})")
+
+        self._map_files()
+        self._load_ann()
+        self._invalidate()
+        self._refresh()
+
+    ##################################################### storage
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def _meta(self, read_only=True):
+        """A connection to metadata.duckdb for one call, retried while another process holds a conflicting lock"""
+        for attempt in range(1, META_LOCK_ATTEMPTS + 1):
+            try:
+                meta = duckdb.connect(self.meta_path, read_only=read_only)
+                break
+            except duckdb.IOException as e:
+                if 'lock' not in str(e) or attempt == META_LOCK_ATTEMPTS:
+                    raise
+                time.sleep(META_LOCK_WAIT_S * attempt)
+        try:
+            yield meta
+        finally:
+            meta.close()
+
+    def _refresh(self):
+        """Pick up index.json when another process changed it: remap the files and drop the derived caches"""
+        try:
+            stat = os.stat(self.state_path)
+        except FileNotFoundError:
+            return
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self.state_stamp:
+            return
+        with open(self.state_path) as f:
+            state = json.load(f)
+        self.state_stamp = stamp
+        if state['dimension'] != self.dimension:
+            raise ValueError(f"{self.directory} holds {state['dimension']}-d vectors, not {self.dimension}-d")
+        if state.get('version', 0) == self.state.get('version', 0) and state['capacity'] == self.state['capacity']:
+            return
+        remap = state['capacity'] != self.state['capacity']
+        self.state = state
+        if remap:
+            self._map_files()
+        self._load_ann()
+        self._invalidate()
+
+    def _map_files(self):
+        """(Re)map the matrix and the row flags at the current capacity"""
+        capacity = self.state['capacity']
+        for name, itemsize in (('vectors.f32', 4 * self.dimension), ('alive.u8', 1), ('ivf_lists.i32', 4)):
+            with open(self._path(name), 'ab') as f:
+                if f.tell() < capacity * itemsize:
+                    f.truncate(capacity * itemsize)
+        if capacity:
+            self.vectors = np.memmap(self._path('vectors.f32'), dtype=np.float32, mode='r+', shape=(capacity, self.dimension))
+            self.alive = np.memmap(self._path('alive.u8'), dtype=np.uint8, mode='r+', shape=(capacity,))
+            self.lists = np.memmap(self._path('ivf_lists.i32'), dtype=np.int32, mode='r+', shape=(capacity,))
+        else:
+            self.vectors = np.zeros((0, self.dimension), dtype=np.float32)
+            self.alive = np.zeros(0, dtype=np.uint8)
+            self.lists = np.zeros(0, dtype=np.int32)
+
+    def _grow(self, n_rows):
+        """Make room for n_rows rows, doubling the capacity"""
+        if n_rows <= self.state['capacity']:
+            return
+        old_capacity = self.state['capacity']
+        self.flush()
+        self.vectors = self.alive = self.lists = None
+        self.state['capacity'] = max(n_rows, 2 * old_capacity, MIN_CAPACITY)
+        self._map_files()
+        self.lists[old_capacity:] = -1
+
+    def _save_state(self):
+        # written to a temporary file and renamed, so a reader never sees half a file
+        self.state['version'] = self.state.get('version', 0) + 1
+        tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+        stat = os.stat(self.state_path)
+        self.state_stamp = (stat.st_mtime_ns, stat.st_size)
+
+    def flush(self):
+        for array in (self.vectors, self.alive, self.lists):
+            if isinstance(array, np.memmap):
+                array.flush()
+        self._save_state()
+
+    def _invalidate(self):
+        """Drop the caches derived from the rows (filter masks, IVF list order, row records)"""
+        self._filter_masks = {}
+        self._list_order = None
+        self._records = None
+
+    ##################################################### Pinecone surface
+
+    def upsert(self, vectors, batch_size=None, namespace=None, **kwargs):
+        """Insert or overwrite vectors given as {'id', 'values', 'metadata'} dicts or (id, values, metadata) tuples"""
+        records = [v if isinstance(v, dict) else dict(zip(('id', 'values', 'metadata'), v)) for v in vectors]
+        if not records:
+            return {'upserted_count': 0}
+        # the last write of an id wins, like repeated upserts
+        records = list({str(record['id']): record for record in records}.values())
+        ids = [str(record['id']) for record in records]
+
+        with self._meta(read_only=False) as meta:
+            # refreshed under the write lock, so another writer's rows are never overwritten
+            self._refresh()
+            self._upsert(meta, ids, records)
+        self._invalidate()
+        return {'upserted_count': len(ids)}
+
+    def _upsert(self, meta, ids, records):
+        existing = dict(meta.execute("SELECT id, row FROM vectors WHERE id IN (SELECT UNNEST(?))", [ids]).fetchall())
+        new_ids = [id for id in ids if id not in existing]
+        free_rows = np.flatnonzero(self.alive[:self.state['n_rows']] == 0)[:len(new_ids)].tolist()
+        n_appended = len(new_ids) - len(free_rows)
+        appended_rows = list(range(self.state['n_rows'], self.state['n_rows'] + n_appended))
+        self._grow(self.state['n_rows'] + n_appended)
+        self.state['n_rows'] += n_appended
+        existing.update(zip(new_ids, free_rows + appended_rows))
+
+        rows = np.array([existing[id] for id in ids], dtype=np.int64)
+        values = normalize([record['values'] for record in records])
+        if values.shape[1] != self.dimension:
+            raise ValueError(f"Vector dimension {values.shape[1]} does not match the index dimension {self.dimension}")
+        self.vectors[rows] = values
+        self.alive[rows] = 1
+        if self.state['n_lists']:
+            self.lists[rows] = top_k_rows(values @ self.centroids.T, 1)[:, 0]
+
+        metadata = [record.get('metadata') or {} for record in records]
+        columns = list(METADATA_COLUMNS)
+        meta.execute(f"""
+            INSERT OR REPLACE INTO vectors (id, row, {', '.join(columns)})
+            SELECT UNNEST(?), UNNEST(?), {', '.join('UNNEST(?)' for _ in columns)}
+        """, [ids, rows.tolist()] + [[m.get(column) for m in metadata] for column in columns])
+        self.flush()
+
+    def delete(self, ids=None, delete_all=False, filter=None, namespace=None, **kwargs):
+        """Delete vectors by id, by metadata filter or all of them (their rows are reused by later upserts)"""
+        with self._meta(read_only=False) as meta:
+            self._refresh()
+            if delete_all:
+                rows = [row for (row,) in meta.sql("SELECT row FROM vectors").fetchall()]
+                meta.sql("DELETE FROM vectors")
+            elif filter:
+                where, params = self._filter_sql(filter)
+                rows = [row for (row,) in meta.execute(f"SELECT row FROM vectors WHERE {where}", params).fetchall()]
+                meta.execute(f"DELETE FROM vectors WHERE {where}", params)
+            else:
+                ids = [str(id) for id in ids or []]
+                rows = [row for (row,) in meta.execute("SELECT row FROM vectors WHERE id IN (SELECT UNNEST(?))", [ids]).fetchall()]
+                meta.execute("DELETE FROM vectors WHERE id IN (SELECT UNNEST(?))", [ids])
+            if rows:
+                self.alive[rows] = 0
+                self.lists[rows] = -1
+                self.flush()
+        if rows:
+            self._invalidate()
+        return {}
+
+    def list(self, prefix=None, limit=LIST_PAGE_SIZE, namespace=None):
+        """Yield pages of vector ids starting with prefix"""
+        with self._meta() as meta:
+            ids = [id for (id,) in meta.execute(
+                "SELECT id FROM vectors WHERE starts_with(id, ?) ORDER BY id", [prefix or '']).fetchall()]
+        for i in range(0, len(ids), limit):
+            yield ids[i:i + limit]
+
+    def fetch(self, ids, namespace=None):
+        """{'vectors': {id: {'id', 'values', 'metadata'}}} of the ids found"""
+        self._refresh()
+        matches = self._matches([self._rows_of(ids)], include_metadata=True, include_values=True)[0]
+        return {'vectors': {match['id']: match for match in matches}}
+
+    def describe_index_stats(self, **kwargs):
+        self._refresh()
+        return {
+            'dimension': self.dimension,
+            'total_vector_count': int(self.alive[:self.state['n_rows']].sum()),
+            'metric': 'cosine',
+            'ann_lists': self.state['n_lists']
+        }
+
+    def query(self, vector=None, id=None, top_k=10, filter=None, include_metadata=False, include_values=False,
+              namespace=None, exact=False, **kwargs):
+        """Nearest vectors of one query vector (or of a stored vector's id), as {'matches': [...]}"""
+        self._refresh()
+        if vector is None:
+            rows, _ = self._rows_of([id])
+            if not rows:
+                return {'matches': []}
+            vector = self.vectors[rows[0]]
+        return self.query_batch([vector], top_k, filter, include_metadata, include_values, exact)[0]
+
+    ##################################################### search
+
+    def query_batch(self, vectors, top_k=10, filter=None, include_metadata=False, include_values=False, exact=False):
+        """Nearest vectors of many query vectors at once; one {'matches': [...]} per query"""
+        self._refresh()
+        queries = normalize(vectors)
+        mask = self._mask(filter)
+        if self.state['n_lists'] and not exact:
+            results = [self._ivf_search(query, top_k, mask) for query in queries]
+        else:
+            results = self._exact_search(queries, top_k, mask)
+        return [{'matches': matches} for matches in self._matches(results, include_metadata, include_values)]
+
+    def _exact_search(self, queries, top_k, mask):
+        """Exact cosine search of a batch of queries, block by block over the matrix"""
+        n_rows = self.state['n_rows']
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, n_rows, SEARCH_BLOCK_ROWS):
+            block_mask = mask[start:start + SEARCH_BLOCK_ROWS]
+            n_allowed = int(block_mask.sum())
+            if not n_allowed:
+                continue
+            # score the contiguous block in place (no copy of the mapped rows), then drop the masked rows
+            scores = queries @ self.vectors[start:start + len(block_mask)].T
+            scores[:, ~block_mask] = -np.inf
+            top = top_k_rows(scores, min(top_k, n_allowed))
+            rows = np.concatenate([best_rows, start + top], axis=1)
+            scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            top = top_k_rows(scores, top_k)
+            best_rows, best_scores = np.take_along_axis(rows, top, axis=1), np.take_along_axis(scores, top, axis=1)
+        return list(zip(best_rows, best_scores))
+
+    def _ivf_search(self, query, top_k, mask):
+        """
+        Approximate search: score the rows of the n_probe lists whose centroids are closest to the
+        query; falls back to the exact search when they hold fewer than top_k candidates
+        """
+        order, bounds = self._ivf_order()
+        probe = top_k_rows((self.centroids @ query)[None, :], self.n_probe)[0]
+        candidates = np.concatenate([order[bounds[c]:bounds[c + 1]] for c in probe])
+        candidates = candidates[mask[candidates]]
+        if len(candidates) < top_k:
+            return self._exact_search(query[None, :], top_k, mask)[0]
+        scores = self.vectors[candidates] @ query
+        top = top_k_rows(scores[None, :], top_k)[0]
+        return candidates[top], scores[top]
+
+    def _mask(self, filter):
+        """Boolean mask of the rows a query may return: alive and matching the metadata filter"""
+        key = json.dumps(filter, sort_keys=True)
+        if key not in self._filter_masks:
+            n_rows = self.state['n_rows']
+            mask = self.alive[:n_rows] == 1
+            if filter:
+                where, params = self._filter_sql(filter)
+                with self._meta() as meta:
+                    rows = [row for (row,) in meta.execute(f"SELECT row FROM vectors WHERE {where}", params).fetchall()]
+                allowed = np.zeros(n_rows, dtype=bool)
+                allowed[[row for row in rows if row < n_rows]] = True   # rows appended since the last refresh wait for it
+                mask &= allowed
+            self._filter_masks[key] = mask
+        return self._filter_masks[key]
+
+    def _filter_sql(self, filter):
+        """SQL for a Pinecone metadata filter on the metadata columns ({'col': v}, $eq, $ne, $in, $nin)"""
+        operators = {'$eq': '= ?', '$ne': '<> ?', '$in': 'IN (SELECT UNNEST(?))', '$nin': 'NOT IN (SELECT UNNEST(?))'}
+        clauses, params = [], []
+        for column, condition in filter.items():
+            if column not in METADATA_COLUMNS:
+                raise ValueError(f"Cannot filter on '{column}', only on {list(METADATA_COLUMNS)}")
+            for operator, value in (condition.items() if isinstance(condition, dict) else [('$eq', condition)]):
+                if operator not in operators:
+                    raise ValueError(f"Unsupported filter operator '{operator}'")
+                clauses.append(f"{column} {operators[operator]}")
+                params.append(value)
+        return " AND ".join(clauses) or "TRUE", params
+
+    def _rows_of(self, ids):
+        """Rows (and None scores) of the stored ids, in the given order"""
+        with self._meta() as meta:
+            found = dict(meta.execute("SELECT id, row FROM vectors WHERE id IN (SELECT UNNEST(?))",
+                                      [[str(id) for id in ids]]).fetchall())
+        rows = [found[str(id)] for id in ids if str(id) in found]
+        return rows, [None] * len(rows)
+
+    def _row_records(self):
+        """
+        (id, metadata values) of every stored row, read with one query and cached until the rows change,
+        so queries do not open metadata.duckdb at all
+        """
+        if self._records is None:
+            with self._meta() as meta:
+                self._records = {record[0]: record[1:] for record in meta.sql(
+                    f"SELECT row, id, {', '.join(METADATA_COLUMNS)} FROM vectors").fetchall()}
+        return self._records
+
+    def _matches(self, results, include_metadata=False, include_values=False):
+        """
+        Pinecone-style matches for a list of (rows, scores) results. Rows another process deleted (or
+        appended) since the last refresh are left out until its state change is picked up.
+        """
+        records = self._row_records()
+        matches = []
+        for rows, scores in results:
+            matches.append([])
+            for row, score in zip(rows, scores):
+                record = records.get(int(row))
+                if record is None:
+                    continue
+                match = {'id': record[0]}
+                if score is not None:
+                    match['score'] = float(score)
+                if include_metadata:
+                    match['metadata'] = {column: value for column, value in zip(METADATA_COLUMNS, record[1:]) if value is not None}
+                if include_values:
+                    match['values'] = self.vectors[row].tolist()
+                matches[-1].append(match)
+        return matches
+
+    ##################################################### ANN
+
+    def build_ann_index(self, n_lists=None, n_iter=10, sample_rows=100000, seed=42):
+        """
+        Build an IVF index: spherical k-means centroids fit on a sample of the vectors, every vector
+        assigned to its closest centroid's list. Later upserts are assigned to the existing lists.
+        """
+        self._refresh()
+        alive_rows = np.flatnonzero(self.alive[:self.state['n_rows']] == 1)
+        if len(alive_rows) == 0:
+            raise ValueError("Cannot build an ANN index over an empty index")
+        n_lists = n_lists or max(1, int(4 * np.sqrt(len(alive_rows))))
+        n_lists = min(n_lists, len(alive_rows))
+        rng = np.random.default_rng(seed)
+
+        sample = self.vectors[np.sort(rng.choice(alive_rows, min(sample_rows, len(alive_rows)), replace=False))]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = top_k_rows(sample @ centroids.T, 1)[:, 0]
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=n_lists) == 0
+            sums[empty] = centroids[empty]
+            centroids = normalize(sums)
+
+        self.centroids = centroids
+        np.save(self._path('ivf_centroids.npy'), centroids)
+        for start in range(0, len(alive_rows), SEARCH_BLOCK_ROWS):
+            rows = alive_rows[start:start + SEARCH_BLOCK_ROWS]
+            self.lists[rows] = top_k_rows(self.vectors[rows] @ centroids.T, 1)[:, 0]
+        self.state['n_lists'] = n_lists
+        self.flush()
+        self._invalidate()
+        return n_lists
+
+    def drop_ann_index(self):
+        """Go back to exact search only"""
+        self._refresh()
+        self.state['n_lists'] = None
+        self.lists[:] = -1
+        self.flush()
+        self._invalidate()
+
+    def _load_ann(self):
+        self.centroids = np.load(self._path('ivf_centroids.npy')) if self.state['n_lists'] else None
+
+    def _ivf_order(self):
+        """Rows grouped by list (order) and each list's slice bounds, cached until the rows change"""
+        if self._list_order is None:
+            lists = self.lists[:self.state['n_rows']]
+            order = np.argsort(lists, kind='stable')
+            bounds = np.searchsorted(lists[order], np.arange(self.state['n_lists'] + 1))
+            self._list_order = (order, bounds)
+        return self._list_order
@@ -0,0 +1,170 @@
+# imports
+import functions_framework
+from google.cloud import secretmanager
+from pinecone import Pinecone
+import json
+import os
+import re
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+import vertexai
+from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
+
+# vector_store.py lives with the ingestor; deploy-functions.sh copies it into this function's source
+try:
+    from vector_store import LocalVectorIndex
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ingestor'))
+    from vector_store import LocalVectorIndex
+
+# settings
+project_id = 'ba882-inclass-project'
+region_id = 'us-central1'
+version_id = 'latest'
+vector_secret = "pinecone"
+vector_index = "overview-content"
+
+# Local vector index for offline runs: LOCAL_VECTOR_DIR holds a LocalVectorIndex (vector_store.py)
+# standing in for the Pinecone index the ingestor writes
+LOCAL_VECTOR_DIR = os.environ.get('LOCAL_VECTOR_DIR')
+
+# embedding model (must match the ingestor's; queries use the query-side task type)
+MODEL_NAME = "text-embedding-005"
+DIMENSIONALITY = 768
+TASK_TYPE = "RETRIEVAL_QUERY"
+
+# retrieval settings
+DEFAULT_TOP_K = 10
+MAX_TOP_K = 100
+CHUNKS_PER_RESULT = 5       # chunks retrieved per requested title, so pooling has several chunks per title
+MAX_CHUNKS = 1000           # the most matches the index returns with metadata
+QUERY_CACHE_SIZE = 256      # recent query embeddings kept, least recently used evicted first
+POOLING = ('max', 'mean')
+
+vertexai.init(project=project_id, location=region_id)
+
+# Instantiate the services once per instance, every request reuses them
+if LOCAL_VECTOR_DIR:
+    index = LocalVectorIndex(LOCAL_VECTOR_DIR, dimension=DIMENSIONALITY)
+else:
+    sm = secretmanager.SecretManagerServiceClient()
+    vector_name = f"projects/{project_id}/secrets/{vector_secret}/versions/{version_id}"
+    response = sm.access_secret_version(request={"name": vector_name})
+    pinecone_token = response.payload.data.decode("UTF-8")
+    pc = Pinecone(api_key=pinecone_token)
+    index = pc.Index(vector_index)
+
+model = TextEmbeddingModel.from_pretrained(MODEL_NAME)
+
+##################################################### query embeddings
+
+# Process-level LRU of query embeddings, shared by every request served by this instance
+cache_lock = threading.Lock()
+query_cache = OrderedDict()   # normalized query text -> embedding, in LRU order
+
+def embed_query(query):
+    """Return the embedding of a query and whether it came from the cache; the model is called on a miss only"""
+    key = re.sub(r"\s+", " ", query).strip()
+    with cache_lock:
+        if key in query_cache:
+            query_cache.move_to_end(key)
+            return query_cache[key], True
+
+    embedding = model.get_embeddings([TextEmbeddingInput(key, TASK_TYPE)])[0].values
+
+    with cache_lock:
+        query_cache[key] = embedding
+        while len(query_cache) > QUERY_CACHE_SIZE:
+            query_cache.popitem(last=False)
+    return embedding, False
+
+##################################################### retrieval
+
+def pool_chunks(matches, pooling, top_k):
+    """
+    Aggregate chunk matches per content_id: the max or the mean of its retrieved chunks' scores
+    (chunks outside the retrieved set do not count). Returns the top_k titles, best first.
+    """
+    contents = {}
+    for match in matches:
+        metadata = match['metadata']
+        content = contents.setdefault(metadata['content_id'], {
+            'content_id': metadata['content_id'],
+            'title': metadata.get('title'),
+            'content_type': metadata.get('content_type'),
+            'scores': [],
+            'chunk_text': metadata.get('chunk_text')   # matches come best first, so this is the best chunk
+        })
+        content['scores'].append(match['score'])
+
+    results = []
+    for content in contents.values():
+        scores = content.pop('scores')
+        content['score'] = round(max(scores) if pooling == 'max' else sum(scores) / len(scores), 6)
+        content['matched_chunks'] = len(scores)
+        results.append(content)
+    results.sort(key=lambda content: content['score'], reverse=True)
+    return results[:top_k]
+
+def retrieve(query, top_k, content_type, pooling):
+    start = time.perf_counter()
+    embedding, cache_hit = embed_query(query)
+    embed_s = time.perf_counter() - start
+
+    search_start = time.perf_counter()
+    n_chunks = min(MAX_CHUNKS, top_k * CHUNKS_PER_RESULT)
+    vector_filter = {'content_type': {'$eq': content_type}} if content_type else None
+    response = index.query(vector=embedding, top_k=n_chunks, filter=vector_filter, include_metadata=True)
+    results = pool_chunks(response['matches'], pooling, top_k)
+    search_s = time.perf_counter() - search_start
+
+    elapsed = time.perf_counter() - start
+    print(f"Query retrieved {len(response['matches'])} chunks, {len(results)} titles in {elapsed * 1000:.1f}ms "
+          f"(query embedding cache {'hit' if cache_hit else 'miss'})")
+    return {
+        'query': query,
+        'results': results,
+        'content_type': content_type,
+        'pooling': pooling,
+        'chunks_retrieved': len(response['matches']),
+        'query_cache': 'hit' if cache_hit else 'miss',
+        'embed_ms': round(embed_s * 1000, 1),
+        'search_ms': round(search_s * 1000, 1),
+        'elapsed_ms': round(elapsed * 1000, 1)
+    }
+
+@functions_framework.http
+def task(request):
+    """
+    Semantic search over the overview chunk embeddings: the top_k titles for a free-text 'query',
+    optionally only of one 'content_type' ('movie' or 'show'), with chunk scores pooled per title
+    by 'max' (default) or 'mean'.
+    """
+    # Parse the request data
+    request_json = request.get_json(silent=True)
+    print(f"request: {json.dumps(request_json)}")
+
+    if not request_json or not isinstance(request_json.get('query'), str) or not request_json['query'].strip():
+        return {"error": "A non-empty 'query' is required."}, 400
+
+    try:
+        top_k = int(request_json.get('top_k', DEFAULT_TOP_K))
+    except (TypeError, ValueError):
+        return {"error": "'top_k' must be an integer."}, 400
+    if not 1 <= top_k <= MAX_TOP_K:
+        return {"error": f"'top_k' must be between 1 and {MAX_TOP_K}."}, 400
+
+    content_type = request_json.get('content_type')
+    if content_type == 'series':
+        content_type = 'show'
+    if content_type not in (None, 'movie', 'show'):
+        return {"error": "'content_type' must be 'movie' or 'show'."}, 400
+
+    pooling = request_json.get('pooling', 'max')
+    if pooling not in POOLING:
+        return {"error": f"'pooling' must be one of {list(POOLING)}."}, 400
+
+    return retrieve(request_json['query'], top_k, content_type, pooling), 200
@@ -2,6 +2,7 @@ import functions_framework
 from google.cloud import secretmanager
 import duckdb
 from pinecone import Pinecone, ServerlessSpec
+import os
 
 # settings
 project_id = 'ba882-inclass-project'
@@ -15,8 +16,22 @@ movie_schema = "genai_movies"
 show_schema = "genai_shows"
 movie_db_schema = f"{db}.{movie_schema}"
 show_db_schema = f"{db}.{show_schema}"
+cache_schema = "genai_cache"
+cache_db_schema = f"{db}.{cache_schema}"
 vector_index = "overview-content"
 
+# Local vector index for offline runs (see the ingestor's vector_store.py); it is created on first use
+LOCAL_VECTOR_DIR = os.environ.get('LOCAL_VECTOR_DIR')
+
+# change tracking columns: hash of the normalized overview + chunker settings the vectors were built from,
+# and the number of chunks (vector ids are <id>_<chunk index>)
+tracking_columns = {'content_hash': 'VARCHAR', 'chunk_count': 'INTEGER'}
+
+def add_tracking_columns(md, tbl_name):
+    """Add the change tracking columns to a tracking table created before they existed"""
+    for column, column_type in tracking_columns.items():
+        md.sql(f"ALTER TABLE {tbl_name} ADD COLUMN IF NOT EXISTS {column} {column_type};")
+
 @functions_framework.http
 def task(request):
 
@@ -38,6 +53,7 @@ def task(request):
     # create the schemas
     md.sql(f"CREATE SCHEMA IF NOT EXISTS {movie_db_schema};")
     md.sql(f"CREATE SCHEMA IF NOT EXISTS {show_db_schema};")
+    md.sql(f"CREATE SCHEMA IF NOT EXISTS {cache_db_schema};")
 
     ##################################################### create the tables
 
@@ -46,45 +62,69 @@ def task(request):
     movie_tbl_sql = f"""
     CREATE TABLE IF NOT EXISTS {movie_tbl_name} (
         id VARCHAR PRIMARY KEY,
-        parsed_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        parsed_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        content_hash VARCHAR,
+        chunk_count INTEGER
     )
     """
     print(f"Creating movie table: {movie_tbl_sql}")
     md.sql(movie_tbl_sql)
+    add_tracking_columns(md, movie_tbl_name)
 
     # shows table
     show_tbl_name = f"{show_db_schema}.pinecone_shows"
     show_tbl_sql = f"""
     CREATE TABLE IF NOT EXISTS {show_tbl_name} (
         id VARCHAR PRIMARY KEY,
-        parsed_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        parsed_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        content_hash VARCHAR,
+        chunk_count INTEGER
     )
     """
     print(f"Creating show table: {show_tbl_sql}")
     md.sql(show_tbl_sql)
-
+    add_tracking_columns(md, show_tbl_name)
+
+    # embedding cache, content-addressed: the same chunk text embedded by the same model for the same
+    # task always has the same embedding, whichever title it came from
+    cache_tbl_name = f"{cache_db_schema}.chunk_embeddings"
+    cache_tbl_sql = f"""
+    CREATE TABLE IF NOT EXISTS {cache_tbl_name} (
+        model VARCHAR,
+        task_type VARCHAR,
+        text_hash VARCHAR,
+        embedding FLOAT[768],
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (model, task_type, text_hash)
+    )
+    """
+    print(f"Creating embedding cache table: {cache_tbl_sql}")
+    md.sql(cache_tbl_sql)
 
     ##################################################### vectordb 
 
-    # Build the resource name of the secret version
-    vector_name = f"projects/{project_id}/secrets/{vector_secret}/versions/{version_id}"
-
-    # Access the secret version
-    response = sm.access_secret_version(request={"name": vector_name})
-    pinecone_token = response.payload.data.decode("UTF-8")
-
-    pc = Pinecone(api_key=pinecone_token)
-
-    if not pc.has_index(vector_index):
-        pc.create_index(
-            name=vector_index,
-            dimension=768,
-            metric="cosine",
-            spec=ServerlessSpec(
-                cloud='aws', # gcp <- not part of free
-                region='us-east-1' # us-central1 <- not part of free
+    if LOCAL_VECTOR_DIR:
+        print(f"Using the local vector index in {LOCAL_VECTOR_DIR}")
+    else:
+        # Build the resource name of the secret version
+        vector_name = f"projects/{project_id}/secrets/{vector_secret}/versions/{version_id}"
+
+        # Access the secret version
+        response = sm.access_secret_version(request={"name": vector_name})
+        pinecone_token = response.payload.data.decode("UTF-8")
+
+        pc = Pinecone(api_key=pinecone_token)
+
+        if not pc.has_index(vector_index):
+            pc.create_index(
+                name=vector_index,
+                dimension=768,
+                metric="cosine",
+                spec=ServerlessSpec(
+                    cloud='aws', # gcp <- not part of free
+                    region='us-east-1' # us-central1 <- not part of free
+                )
             )
-        )
     
     ## wrap up
     return {}, 200
\ No newline at end of file
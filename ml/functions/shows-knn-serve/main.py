@@ -1,56 +1,201 @@
+# imports
+import time
+cold_start_begin = time.perf_counter()
+
 import functions_framework
+import json
 import os
-import pandas as pd
+import re
+import resource
+from collections import Counter
 import numpy as np
-import joblib
-import json
-import io
-from flask import Response
+from scipy import sparse
 from gcsfs import GCSFileSystem
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.preprocessing import StandardScaler
-from sklearn.neighbors import NearestNeighbors
-import warnings
-warnings.filterwarnings("ignore", message="X does not have valid feature names")
 
-from google.cloud import storage
-from google.cloud import aiplatform
-
-# GCS paths for KNN, vectorizer, and movie metadata
+# the hardcoded model on GCS
 GCS_BUCKET = "ba882-team05-vertex-models"
 GCS_PATH = "models/netflix-shows/"
-KNN_FNAME = "knn_model.joblib"
-VECTORIZER_FNAME = "vectorizer.joblib"
-SCALER_FNAME = "scaler.joblib"
-SHOW_METADATA_FNAME = "show_metadata.json"
-
-GCS_KNN_PATH = f"gs://{GCS_BUCKET}/{GCS_PATH}{KNN_FNAME}"
-GCS_VECTORIZER_PATH = f"gs://{GCS_BUCKET}/{GCS_PATH}{VECTORIZER_FNAME}"
-GCS_SCALER_PATH = f"gs://{GCS_BUCKET}/{GCS_PATH}{SCALER_FNAME}"
-GCS_SHOW_METADATA_PATH = f"gs://{GCS_BUCKET}/{GCS_PATH}{SHOW_METADATA_FNAME}"
-
-# Load the trained KNN model from GCS
-with GCSFileSystem().open(GCS_KNN_PATH, 'rb') as f:
-    knn_model = joblib.load(f)
-print("Loaded the KNN model from GCS")
-
-# Load the vectorizer from GCS
-with GCSFileSystem().open(GCS_VECTORIZER_PATH, 'rb') as f:
-    vectorizer = joblib.load(f)
-print("Loaded the vectorizer from GCS")
-
-# Load the scaler from GCS
-with GCSFileSystem().open(GCS_SCALER_PATH, 'rb') as f:
-    scaler = joblib.load(f)
-print("Loaded the scaler from GCS")
-
-# Load the show metadata from GCS
-with GCSFileSystem().open(GCS_SHOW_METADATA_PATH, 'r') as f:
-    show_metadata = json.load(f)
-print("Loaded movie metadata from GCS")
-
-# Convert movie metadata to a dictionary for easier lookup by title
-show_metadata_dict = {show['title']: show for show in show_metadata}
+BUNDLE_FNAME = "model.bundle"
+
+# GCS path of the serving bundle (vectorizer, scaler, catalog vectors, neighbor table, ANN index and show metadata)
+GCS_BUNDLE_PATH = f"gs://{GCS_BUCKET}/{GCS_PATH}{BUNDLE_FNAME}"
+LOCAL_BUNDLE_PATH = f"/tmp/{BUNDLE_FNAME}"
+
+# bundle file layout (must match the training function)
+BUNDLE_MAGIC = b"NFXBNDL1"
+BUNDLE_ALIGN = 64
+BUNDLE_FORMAT_VERSION = 1
+
+# TfidfVectorizer's default tokenizer (stop words never make it into the vocabulary)
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+##################################################### bundle
+
+def read_bundle(path):
+    """Memory-map a bundle file: every array is a zero-copy view into one read-only mapping"""
+    with open(path, 'rb') as f:
+        if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+            raise ValueError(f"{path} is not a model bundle")
+        header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_len))
+    if header['meta']['format_version'] != BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported bundle format {header['meta']['format_version']}")
+
+    data_start = -(-(len(BUNDLE_MAGIC) + 8 + header_len) // BUNDLE_ALIGN) * BUNDLE_ALIGN
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        start = data_start + entry['offset']
+        count = int(np.prod(entry['shape']))
+        arrays[name] = buffer[start:start + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+    return header['meta'], arrays
+
+def unpack_strings(blob, offsets):
+    """Decode a packed string column (one utf-8 blob plus offsets) into a list"""
+    data = blob.tobytes()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+# Local mode for offline runs: LOCAL_BUCKET_DIR is a directory standing in for GCS, the bundle is
+# memory-mapped from there directly
+LOCAL_BUCKET_DIR = os.environ.get('LOCAL_BUCKET_DIR')
+
+# Download the bundle with a single read and memory-map it
+if LOCAL_BUCKET_DIR:
+    LOCAL_BUNDLE_PATH = os.path.join(LOCAL_BUCKET_DIR, GCS_BUCKET, GCS_PATH, BUNDLE_FNAME)
+else:
+    GCSFileSystem().get(GCS_BUNDLE_PATH, LOCAL_BUNDLE_PATH)
+bundle_meta, bundle = read_bundle(LOCAL_BUNDLE_PATH)
+print(f"Loaded model bundle version {bundle_meta['model_version']} from GCS")
+
+# Vectorizer: sorted vocabulary (column order) and idf weights
+vocabulary = {term: col for col, term in enumerate(unpack_strings(bundle['vocab_bytes'], bundle['vocab_offsets']))}
+idf = bundle['idf']
+
+# Scaler for episodeCount/seasonCount and the weight of that block relative to the TF-IDF columns
+scaler_mean = bundle['scaler_mean']
+scaler_scale = bundle['scaler_scale']
+numeric_weight = bundle_meta['numeric_weight']
+
+# L2-normalized feature vectors of every catalog row. The first n_indexed rows are the rows
+# the KNN model was fit on and have a neighbor table entry, the rest are held-out catalog titles
+n_indexed = bundle_meta['n_indexed']
+catalog_features = sparse.csr_matrix(
+    (bundle['catalog_data'], bundle['catalog_indices'], bundle['catalog_indptr']),
+    shape=tuple(bundle_meta['catalog_shape'])
+)
+indexed_features = catalog_features[:n_indexed]
+n_neighbors = bundle_meta['n_neighbors']
+
+# Precomputed neighbor table (row i holds the top-k neighbors of catalog row i)
+neighbor_indices = bundle['neighbor_indices']
+neighbor_similarities = bundle['neighbor_similarities']
+
+# Show metadata, stored column by column
+show_metadata = {col: unpack_strings(bundle[f'{col}_bytes'], bundle[f'{col}_offsets']) for col in bundle_meta['string_columns']}
+show_metadata['episodeCount'] = bundle['episodeCount']
+show_metadata['seasonCount'] = bundle['seasonCount']
+
+# Map each catalog title to its metadata row (first occurrence wins)
+title_to_row = {}
+for row, title in enumerate(show_metadata['title']):
+    title_to_row.setdefault(title, row)
+
+##################################################### search
+
+def normalize_rows(m):
+    """L2-normalize the rows of a CSR matrix"""
+    norms = np.sqrt(np.asarray(m.multiply(m).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(sparse.diags(1 / norms) @ m)
+
+def tfidf_transform(texts):
+    """Replicates the fitted TfidfVectorizer: token counts x idf, then L2 normalization"""
+    rows, cols, vals = [], [], []
+    for row, text in enumerate(texts):
+        counts = Counter(vocabulary[token] for token in TOKEN_PATTERN.findall(text.lower()) if token in vocabulary)
+        rows.extend([row] * len(counts))
+        cols.extend(counts.keys())
+        vals.extend(counts.values())
+    tf = sparse.csr_matrix((np.asarray(vals, dtype=np.float64), (rows, cols)), shape=(len(texts), len(vocabulary)))
+    tf.data *= idf[tf.indices]
+    return normalize_rows(tf)
+
+def vectorize(text_features, episode_count_data):
+    """Turn combined text features and [episodeCount, seasonCount] pairs into the model's feature space"""
+    # Step 1: Apply the TF-IDF weights on the processed text data
+    tfidf_matrix = tfidf_transform(text_features)
+
+    # Step 2: Scale the episodeCount and seasonCount like the fitted StandardScaler. Missing counts
+    # get the training mean (a neutral 0 after scaling) so they cannot turn the similarities into NaN
+    count_features = np.asarray(episode_count_data, dtype=np.float64).reshape(len(text_features), 2)
+    count_features = np.where(np.isfinite(count_features), count_features, scaler_mean)
+    scaled_count_features = (count_features - scaler_mean) / scaler_scale
+
+    # Step 3: Combine TF-IDF matrix and weighted numeric features as one L2-normalized sparse CSR matrix
+    count_block = sparse.csr_matrix(scaled_count_features * numeric_weight)
+    return normalize_rows(sparse.hstack((tfidf_matrix, count_block), format='csr'))
+
+def exact_kneighbors(queries, k):
+    """Brute-force cosine search over the indexed catalog rows (queries are L2-normalized)"""
+    sims = (indexed_features @ queries.T).toarray().T
+    top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(top, np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1, kind='stable'), axis=1)
+    return 1 - np.take_along_axis(sims, top, axis=1), top
+
+def lsh_codes(features, hyperplanes, n_bits):
+    """Hash rows to one integer bucket code per table with signed random projections, shape (tables, rows)"""
+    bits = np.asarray(features @ hyperplanes.T) > 0
+    bits = bits.reshape(features.shape[0], -1, n_bits)
+    return (bits * (1 << np.arange(n_bits))).sum(axis=2).T
+
+def lsh_kneighbors(queries, k):
+    """
+    Query the LSH index: candidates are the union of the query's buckets over all tables,
+    re-ranked by exact cosine distance; queries that collect fewer than k candidates fall
+    back to the exact search.
+    """
+    codes = lsh_codes(queries, bundle['lsh_hyperplanes'], bundle_meta['lsh_n_bits'])
+    order, sorted_codes = bundle['lsh_order'], bundle['lsh_sorted_codes']
+
+    distances = np.empty((queries.shape[0], k))
+    indices = np.empty((queries.shape[0], k), dtype=np.intp)
+    fallback = []
+    for i in range(queries.shape[0]):
+        buckets = []
+        for t in range(codes.shape[0]):
+            lo, hi = np.searchsorted(sorted_codes[t], [codes[t, i], codes[t, i] + 1])
+            buckets.append(order[t, lo:hi])
+        candidates = np.unique(np.concatenate(buckets))
+        if len(candidates) < k:
+            fallback.append(i)
+            continue
+        sims = (indexed_features[candidates] @ queries[i].T).toarray().ravel()
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top], kind='stable')]
+        indices[i] = candidates[top]
+        distances[i] = 1 - sims[top]
+
+    if fallback:
+        distances[fallback], indices[fallback] = exact_kneighbors(queries[fallback], k)
+    return distances, indices
+
+# Nearest neighbor search through the ANN index when one was trained, else exact search
+def search(queries):
+    if bundle_meta.get('ann') == 'lsh':
+        return lsh_kneighbors(queries, n_neighbors)
+    return exact_kneighbors(queries, n_neighbors)
+
+# Report what the cold start cost
+cold_start_stats = {
+    'model_version': bundle_meta['model_version'],
+    'bundle_mb': round(os.path.getsize(LOCAL_BUNDLE_PATH) / 2**20, 2),
+    'cold_start_ms': round((time.perf_counter() - cold_start_begin) * 1000, 1),
+    'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+}
+print(f"Cold start: {cold_start_stats}")
+
+##################################################### helpers
 
 # Preprocessing function for fields like genres, cast, directors
 def preprocess_field(field):
@@ -60,6 +205,13 @@ def preprocess_field(field):
         return ' '.join([item.split(':')[-1].strip().strip("'\"") for item in items])
     return ''
 
+# Convert a payload value to float (NaN when missing or not numeric, imputed in vectorize)
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
 # Preprocess the input data (similar to how we preprocess training data)
 def preprocess_input_data(data_list):
     """Preprocess the input data (similar to how we preprocess training data)"""
@@ -80,21 +232,32 @@ def preprocess_input_data(data_list):
         processed_data.append(text_features)
 
         # Convert episodeCount and seasonCount to numeric type
-        episodeCount = pd.to_numeric(data.get('episodeCount', ''), errors='coerce')
-        seasonCount = pd.to_numeric(data.get('seasonCount', ''), errors='coerce')
-
-        episode_count_data.append([episodeCount, seasonCount])
+        episode_count_data.append([to_float(data.get('episodeCount')), to_float(data.get('seasonCount'))])
 
-    # Step 1: Apply TF-IDF vectorizer on the processed text data
-    tfidf_matrix = vectorizer.transform(processed_data)
+    return vectorize(processed_data, episode_count_data)
 
-    # Step 2: Scale the episodeCount and seasonCount using the scaler
-    scaled_count_features = scaler.transform(episode_count_data)
-
-    # Step 3: Combine TF-IDF matrix and scaled numeric features
-    features = np.hstack((tfidf_matrix.toarray(), scaled_count_features))
-
-    return features
+# Build the recommendation list for one neighbor row
+def build_recommendations(indices, similarities, row=None):
+    """
+    Format a row of neighbor indices/similarities as the top k-1 recommendations. The first entry
+    is skipped only when it is the query's own catalog row (indexed titles find themselves first)
+    """
+    start = 1 if row is not None and indices[0] == row else 0
+    end = start + len(indices) - 1
+    show_recs = []
+    for show_idx, similarity in zip(indices[start:end], similarities[start:end]):
+        # Create the recommendation info from the metadata columns of the recommended show
+        show_recs.append({
+            'title': show_metadata['title'][show_idx],
+            'similarity': float(similarity),
+            'distance': 1 - float(similarity),
+            'overview': show_metadata['overview'][show_idx],
+            'genres': show_metadata['genres'][show_idx],
+            'cast': show_metadata['cast'][show_idx],
+            'episodeCount': float(show_metadata['episodeCount'][show_idx]),
+            'seasonCount': float(show_metadata['seasonCount'][show_idx])
+        })
+    return show_recs
 
 @functions_framework.http
 def main(request):
@@ -102,46 +265,39 @@ def main(request):
 
     # Parse the request data (assumes JSON format)
     request_json = request.get_json(silent=True)
-    
+
     if not request_json or 'data' not in request_json:
         return {'error': 'No input data provided'}, 400
 
-    # Load the data (a list of movie data dictionaries with 'genres', 'cast', 'directors', 'overview')
+    # Load the data (a list of show data dictionaries with 'genres', 'cast', 'directors', 'overview', 'episodeCount', 'seasonCount')
     data_list = request_json.get('data')
     print(f"Received data: {data_list}")
 
-    # Step 1: Preprocess input data (just like we did for training data)
-    preprocessed_data = preprocess_input_data(data_list)
+    # Step 1: Answer indexed catalog titles straight from the precomputed neighbor table
+    recommendations = [None] * len(data_list)
+    held_out = []
+    unseen = []
+    for i, show in enumerate(data_list):
+        row = title_to_row.get(show.get('title'))
+        if row is None:
+            unseen.append(i)
+        elif row >= n_indexed:
+            held_out.append((i, row))
+        else:
+            recommendations[i] = {show['title']: build_recommendations(neighbor_indices[row], neighbor_similarities[row], row)}
 
-    # Step 3: Get predictions using the KNN model (which will return indices and distances of the neighbors)
-    distances, indices = knn_model.kneighbors(preprocessed_data)
+    # Step 2: Other catalog titles reuse their stored feature vector (no re-tokenization of the payload)
+    if held_out:
+        distances, indices = search(catalog_features[[row for _, row in held_out]])
+        for pos, (i, _) in enumerate(held_out):
+            recommendations[i] = {data_list[i]['title']: build_recommendations(indices[pos], 1 - distances[pos])}
 
-    # Step 4: Collect recommendations for each show
-    recommendations = []
-    for i, show in enumerate(data_list):
-        show_recs = []
-        for j in range(1, len(distances[i])):  # Start from 1 to exclude the show itself
-            # Get the index of the recommended show
-            show_idx = indices[i][j]
-            # Retrieve the show title using the index from show_metadata_dict
-            recommended_show_title = show_metadata[show_idx]['title']
-            
-            # Retrieve additional details about the recommended show
-            recommended_show_info = show_metadata_dict.get(recommended_show_title, {})
-
-            # Create the recommendation info
-            show_info = {
-                'title': recommended_show_title,
-                'similarity': 1 - distances[i][j],  # Convert distance to similarity
-                'distance': distances[i][j],
-                'overview': recommended_show_info.get('overview', 'N/A'),
-                'genres': recommended_show_info.get('genres', 'N/A'),
-                'cast': recommended_show_info.get('cast', 'N/A'),
-                'episodeCount': recommended_show_info.get('episodeCount', 'N/A'),
-                'seasonCount': recommended_show_info.get('seasonCount', 'N/A')
-            }
-            show_recs.append(show_info)
-        recommendations.append({show['title']: show_recs})
+    # Step 3: Fall back to vectorizing the payload for titles that are not in the catalog
+    if unseen:
+        preprocessed_data = preprocess_input_data([data_list[i] for i in unseen])
+        distances, indices = search(preprocessed_data)
+        for pos, i in enumerate(unseen):
+            recommendations[i] = {data_list[i]['title']: build_recommendations(indices[pos], 1 - distances[pos])}
 
     # Return the recommendations as a JSON response
-    return json.dumps({'recommendations': recommendations}), 200
\ No newline at end of file
+    return json.dumps({'recommendations': recommendations, 'model': cold_start_stats}), 200
@@ -6,10 +6,13 @@ import pandas as pd
 import numpy as np
 import joblib
 import json
+import time
+import datetime
+from scipy import sparse
 from gcsfs import GCSFileSystem
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.neighbors import NearestNeighbors
-from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import StandardScaler, normalize
 from sklearn.model_selection import train_test_split
 import warnings
 warnings.filterwarnings("ignore", message="X does not have valid feature names")
@@ -23,17 +26,165 @@ from google.cloud import aiplatform
 project_id = 'ba882-inclass-project'  # <------- change this to your value
 project_region = 'us-central1'  #
 
+# weight of the scaled episodeCount/seasonCount block relative to the TF-IDF columns (stored in the serving bundle)
+NUMERIC_WEIGHT = 1.0
+
+##################################################### helpers
+
+# Local mode for offline runs: LOCAL_BUCKET_DIR is a directory standing in for GCS
+LOCAL_BUCKET_DIR = os.environ.get('LOCAL_BUCKET_DIR')
+
+def open_gcs_file(path, mode='rb'):
+    """Open a gs:// path, or the matching file under LOCAL_BUCKET_DIR in local mode"""
+    if LOCAL_BUCKET_DIR:
+        local_path = os.path.join(LOCAL_BUCKET_DIR, path.replace('gs://', '', 1))
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        return open(local_path, mode)
+    return GCSFileSystem().open(path, mode)
+
+def build_features(tfidf_matrix, count_features, numeric_weight=NUMERIC_WEIGHT):
+    """Append the scaled count columns to the TF-IDF matrix as a weighted sparse block (CSR)"""
+    count_block = sparse.csr_matrix(np.asarray(count_features, dtype=tfidf_matrix.dtype) * numeric_weight)
+    return sparse.hstack((tfidf_matrix, count_block), format='csr')
+
+BUNDLE_MAGIC = b"NFXBNDL1"
+BUNDLE_ALIGN = 64
+BUNDLE_FORMAT_VERSION = 1
+
+def pack_strings(values):
+    """Pack a string column into one utf-8 blob plus int64 offsets"""
+    encoded = [('' if pd.isna(v) else str(v)).encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+def write_bundle(f, arrays, meta):
+    """
+    Write named arrays to one file the serve function can memory-map: magic, header length,
+    JSON header (meta plus dtype/shape/offset of each array), then the raw 64-byte aligned buffers.
+    """
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+    entries, offset = {}, 0
+    for name, arr in arrays.items():
+        entries[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+        offset += -(-arr.nbytes // BUNDLE_ALIGN) * BUNDLE_ALIGN
+    header = json.dumps({'meta': dict(meta, format_version=BUNDLE_FORMAT_VERSION), 'arrays': entries}).encode('utf-8')
+    preamble = len(BUNDLE_MAGIC) + 8 + len(header)
+
+    f.write(BUNDLE_MAGIC)
+    f.write(np.uint64(len(header)).tobytes())
+    f.write(header)
+    f.write(b'\0' * (-(-preamble // BUNDLE_ALIGN) * BUNDLE_ALIGN - preamble))
+    for arr in arrays.values():
+        f.write(arr.tobytes())
+        f.write(b'\0' * (-(-arr.nbytes // BUNDLE_ALIGN) * BUNDLE_ALIGN - arr.nbytes))
+
+def lsh_codes(features, hyperplanes, n_bits):
+    """Hash rows to one integer bucket code per table with signed random projections, shape (tables, rows)"""
+    bits = np.asarray(features @ hyperplanes.T) > 0
+    bits = bits.reshape(features.shape[0], -1, n_bits)
+    return (bits * (1 << np.arange(n_bits))).sum(axis=2).T
+
+def build_lsh_index(features, n_tables=16, n_bits=8, seed=42):
+    """
+    Random-projection LSH index for cosine search, kept as plain arrays (no custom classes).
+    The pipeline trainers save it with np.savez next to the model; the knn-train functions
+    write its arrays into model.bundle, where the serve functions memory-map them.
+    """
+    rng = np.random.default_rng(seed)
+    hyperplanes = rng.standard_normal((n_tables * n_bits, features.shape[1])).astype(np.float32)
+    codes = lsh_codes(features, hyperplanes, n_bits)
+    order = np.argsort(codes, axis=1, kind='stable')
+    catalog = sparse.csr_matrix(normalize(features), dtype=np.float32)
+    return {
+        'hyperplanes': hyperplanes,
+        'n_bits': np.array(n_bits),
+        'order': order.astype(np.int32),
+        'sorted_codes': np.take_along_axis(codes, order, axis=1),
+        'data': catalog.data,
+        'indices': catalog.indices,
+        'indptr': catalog.indptr,
+        'shape': np.array(catalog.shape)
+    }
+
+def load_lsh_index(arrays):
+    """Rebuild the queryable index (with the normalized catalog matrix) from its saved arrays"""
+    ann_index = {name: arrays[name] for name in ('hyperplanes', 'order', 'sorted_codes')}
+    ann_index['n_bits'] = int(arrays['n_bits'])
+    ann_index['catalog'] = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(arrays['shape']))
+    return ann_index
+
+def lsh_kneighbors(ann_index, features, k, knn):
+    """
+    Drop-in for knn.kneighbors backed by the LSH index. Candidates are the union of the
+    query's buckets over all tables, re-ranked by exact cosine distance; queries that
+    collect fewer than k candidates fall back to the exact model.
+    """
+    n_queries = features.shape[0]
+    codes = lsh_codes(features, ann_index['hyperplanes'], ann_index['n_bits'])
+    queries = sparse.csr_matrix(normalize(features), dtype=np.float32)
+    order, sorted_codes, catalog = ann_index['order'], ann_index['sorted_codes'], ann_index['catalog']
+
+    distances = np.empty((n_queries, k))
+    indices = np.empty((n_queries, k), dtype=np.intp)
+    fallback = []
+    for i in range(n_queries):
+        buckets = []
+        for t in range(codes.shape[0]):
+            lo, hi = np.searchsorted(sorted_codes[t], [codes[t, i], codes[t, i] + 1])
+            buckets.append(order[t, lo:hi])
+        candidates = np.unique(np.concatenate(buckets))
+        if len(candidates) < k:
+            fallback.append(i)
+            continue
+        sims = (catalog[candidates] @ queries[i].T).toarray().ravel()
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top], kind='stable')]
+        indices[i] = candidates[top]
+        distances[i] = 1 - sims[top]
+
+    if fallback:
+        distances[fallback], indices[fallback] = knn.kneighbors(features[fallback], n_neighbors=k)
+    return distances, indices
+
+def ann_recall_at_k(knn, ann_index, features, k, sample_size=200, seed=42):
+    """Recall@K of the LSH index against brute force on a sample of rows, with single-query latency of both"""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(features.shape[0], size=min(sample_size, features.shape[0]), replace=False)
+    exact, approx = [], []
+
+    start = time.perf_counter()
+    for row in rows:
+        exact.append(knn.kneighbors(features[row:row + 1], n_neighbors=k)[1][0])
+    brute_ms = (time.perf_counter() - start) * 1000 / len(rows)
+
+    start = time.perf_counter()
+    for row in rows:
+        approx.append(lsh_kneighbors(ann_index, features[row:row + 1], k, knn)[1][0])
+    ann_ms = (time.perf_counter() - start) * 1000 / len(rows)
+
+    hits = sum(len(np.intersect1d(e, a)) for e, a in zip(exact, approx))
+    return {'recall_at_k': hits / (len(rows) * k), 'ann_ms_per_query': ann_ms, 'brute_ms_per_query': brute_ms}
+
 ##################################################### task
 
 @functions_framework.http
 def main(request):
     "Fit the model using a cloud function"
 
+    # optional ANN backend for the live KNN fallback: 'brute' (exact) or 'lsh' (approximate)
+    request_json = request.get_json(silent=True) or {}
+    ann = request_json.get('ann', 'brute')
+    if ann not in ('brute', 'lsh'):
+        return {'error': f"Unsupported ann backend '{ann}', expected 'brute' or 'lsh'"}, 400
+
     # we are hardcoding the dataset
     GCS_PATH = "gs://ba882-team05-vertex-models/training-data/netflix-api-recommendation/netflix_data.csv"
 
     # get the dataset
-    df = pd.read_csv(GCS_PATH)
+    with open_gcs_file(GCS_PATH) as f:
+        df = pd.read_csv(f)
     print(df.head())
 
     # Shows
@@ -76,14 +227,17 @@ def main(request):
     scaler = StandardScaler()
     count_features_train = scaler.fit_transform(train_set[['episodeCount', 'seasonCount']])
     
-    # Combine TF-IDF matrix with scaled count features
-    features_train = np.hstack((tfidf_matrix_train.toarray(), count_features_train))
+    # Combine TF-IDF matrix with scaled count features (stays sparse)
+    features_train = build_features(tfidf_matrix_train, count_features_train)
 
-    # Implement KNN model
+    # Implement KNN model (brute force cosine search works directly on CSR input)
     k = 10  # number of neighbors
-    knn = NearestNeighbors(n_neighbors=k, metric='cosine')
+    knn = NearestNeighbors(n_neighbors=k, metric='cosine', algorithm='brute')
     knn.fit(features_train)
 
+    # Precompute the top-k neighbors of every catalog row with one batched query
+    distances, indices = knn.kneighbors(features_train)
+
     # Save the KNN model and vectorizer to GCS
     GCS_BUCKET = "ba882-team05-vertex-models"
     GCS_PATH = "models/netflix-shows/"
@@ -91,29 +245,82 @@ def main(request):
     # Save KNN model
     knn_model_fname = "knn_model.joblib"
     knn_model_gcs_path = f"gs://{GCS_BUCKET}/{GCS_PATH}{knn_model_fname}"
-    with GCSFileSystem().open(knn_model_gcs_path, 'wb') as f:
+    with open_gcs_file(knn_model_gcs_path, 'wb') as f:
         joblib.dump(knn, f)  # Save the KNN model
 
     # Save Vectorizer model
     vectorizer_fname = "vectorizer.joblib"
     vectorizer_gcs_path = f"gs://{GCS_BUCKET}/{GCS_PATH}{vectorizer_fname}"
-    with GCSFileSystem().open(vectorizer_gcs_path, 'wb') as f:
+    with open_gcs_file(vectorizer_gcs_path, 'wb') as f:
         joblib.dump(vectorizer, f)  # Save the vectorizer
 
     # Save Scaler model
     scaler_fname = "scaler.joblib"
     scaler_gcs_path = f"gs://{GCS_BUCKET}/{GCS_PATH}{scaler_fname}"
-    with GCSFileSystem().open(scaler_gcs_path, 'wb') as f:
+    with open_gcs_file(scaler_gcs_path, 'wb') as f:
         joblib.dump(scaler, f)  # Save the scaler
 
-    # Save the complete show metadata
-    show_metadata = df_show[['genres', 'cast', 'directors', 'overview', 'title', 'episodeCount', 'seasonCount']].to_dict(orient='records')
+    # Save the show metadata. The fitted rows come first, in the order the KNN model was fit on,
+    # so neighbor indices map straight to metadata rows; the held-out rows follow so every
+    # catalog title can be looked up
+    catalog_df = pd.concat([train_set, test_set])
+    show_metadata = catalog_df[['genres', 'cast', 'directors', 'overview', 'title', 'episodeCount', 'seasonCount']].to_dict(orient='records')
     
     # Save as a JSON file in GCS
     show_metadata_fname = "show_metadata.json"
     show_metadata_gcs_path = f"gs://{GCS_BUCKET}/{GCS_PATH}{show_metadata_fname}"
     
-    with GCSFileSystem().open(show_metadata_gcs_path, 'w') as f:
+    with open_gcs_file(show_metadata_gcs_path, 'w') as f:
         json.dump(show_metadata, f)
 
-    return 'KNN model, vectorizer, scaler, and show metadata saved successfully to GCS', 200
\ No newline at end of file
+    # Build the serving bundle: everything the serve function needs in one memory-mappable file
+    model_version = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    catalog_features = normalize(build_features(
+        vectorizer.transform(catalog_df['text_features']),
+        scaler.transform(catalog_df[['episodeCount', 'seasonCount']])
+    ))
+    vocab_bytes, vocab_offsets = pack_strings(vectorizer.get_feature_names_out())
+    bundle_arrays = {
+        'vocab_bytes': vocab_bytes,
+        'vocab_offsets': vocab_offsets,
+        'idf': vectorizer.idf_,
+        'scaler_mean': scaler.mean_,
+        'scaler_scale': scaler.scale_,
+        'catalog_data': catalog_features.data.astype(np.float32),
+        'catalog_indices': catalog_features.indices.astype(np.int32),
+        'catalog_indptr': catalog_features.indptr.astype(np.int64),
+        'neighbor_indices': indices.astype(np.int32),
+        'neighbor_similarities': (1 - distances).astype(np.float32),
+        'episodeCount': catalog_df['episodeCount'].to_numpy(dtype=np.float64),
+        'seasonCount': catalog_df['seasonCount'].to_numpy(dtype=np.float64)
+    }
+    string_columns = ['title', 'overview', 'genres', 'cast']
+    for col in string_columns:
+        bundle_arrays[f'{col}_bytes'], bundle_arrays[f'{col}_offsets'] = pack_strings(catalog_df[col])
+    bundle_meta = {
+        'model_version': model_version,
+        'n_neighbors': k,
+        'n_indexed': features_train.shape[0],
+        'catalog_shape': list(catalog_features.shape),
+        'string_columns': string_columns,
+        'numeric_weight': NUMERIC_WEIGHT,
+        'ann': ann
+    }
+
+    # Optional ANN index, stored in the bundle next to the catalog vectors it indexes
+    if ann == 'lsh':
+        ann_arrays = build_lsh_index(features_train, n_tables=int(request_json.get('lsh_tables', 16)), n_bits=int(request_json.get('lsh_bits', 8)))
+        print(f"ANN metrics: {ann_recall_at_k(knn, load_lsh_index(ann_arrays), features_train, k=k)}")
+        bundle_arrays['lsh_hyperplanes'] = ann_arrays['hyperplanes']
+        bundle_arrays['lsh_order'] = ann_arrays['order']
+        bundle_arrays['lsh_sorted_codes'] = ann_arrays['sorted_codes']
+        bundle_meta['lsh_n_bits'] = int(ann_arrays['n_bits'])
+
+    # Save the bundle to GCS
+    bundle_fname = "model.bundle"
+    bundle_gcs_path = f"gs://{GCS_BUCKET}/{GCS_PATH}{bundle_fname}"
+    with open_gcs_file(bundle_gcs_path, 'wb') as f:
+        write_bundle(f, bundle_arrays, bundle_meta)
+    print(f"Saved model bundle version {model_version} to {bundle_gcs_path}")
+
+    return 'KNN model, vectorizer, scaler, show metadata, and serving bundle saved successfully to GCS', 200
\ No newline at end of file
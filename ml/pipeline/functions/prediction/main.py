@@ -2,6 +2,10 @@
 import functions_framework
 import joblib
 import json
+import io
+import time
+import threading
+from collections import OrderedDict
 from gcsfs import GCSFileSystem
 import pandas as pd
 from google.cloud import secretmanager
@@ -19,6 +23,17 @@ secret_id = 'duckdb-token'
 version_id = 'latest'
 gcp_region = 'us-central1'
 
+# cache settings
+METADATA_TTL_SECONDS = 300     # how long a showType lookup / best-model query is trusted before re-checking
+MODEL_CACHE_MAX_MB = 512       # memory budget for the loaded models (sized by their serialized bytes)
+MODEL_CACHE_MAX_ENTRIES = 4    # at most this many models are kept, least recently used evicted first
+
+# metrics and runs tables of the models for each showType
+MODEL_TABLES = {
+    'movie': (f"{db_schema}.movies_job_metrics", f"{db_schema}.movies_model_runs"),
+    'series': (f"{db_schema}.shows_job_metrics", f"{db_schema}.shows_model_runs")
+}
+
 # Instantiate services
 sm = secretmanager.SecretManagerServiceClient()
 storage_client = storage.Client()
@@ -33,44 +48,75 @@ md_token = response.payload.data.decode("UTF-8")
 # Initiate the MotherDuck connection through an access token
 md = duckdb.connect(f'md:?motherduck_token={md_token}')
 
-@functions_framework.http
-def task(request):
+##################################################### caches
+
+# Process-level caches, shared by every request served by this instance
+cache_lock = threading.Lock()
+show_type_cache = {}        # lower(title) -> (showType or None, expires_at)
+best_model_cache = {}       # showType -> {'model_info', 'latest_run', 'expires_at'}
+model_cache = OrderedDict() # (job_id, model_path) -> (model, size_bytes), in LRU order
+model_cache_bytes = 0
+model_load_locks = {}       # (job_id, model_path) -> lock held while that model is fetched from GCS
+
+def lookup_show_types(titles):
     """
-    Fetch model information and make predictions based on the title provided.
+    Return {lower(title): showType or None} for many titles, cached with a TTL.
+    Titles missing from the cache are resolved together with one query.
     """
+    now = time.monotonic()
+    show_types = {}
+    missing = []
+    with cache_lock:
+        for key in {title.lower() for title in titles}:
+            cached = show_type_cache.get(key)
+            if cached and cached[1] > now:
+                show_types[key] = cached[0]
+            else:
+                missing.append(key)
 
-    # Parse the request data
-    request_json = request.get_json(silent=True)
-    print(request_json)
+    if missing:
+        query = """
+        SELECT LOWER(title) AS title_key, showType
+        FROM ba882_project.stage.netflix_api
+        WHERE LOWER(title) IN (SELECT UNNEST(?))
+        """
+        result_df = md.execute(query, [missing]).df()
+        found = {}
+        for title_key, show_type in zip(result_df['title_key'], result_df['showType']):
+            found.setdefault(title_key, show_type)
 
-    # Extract the title from the input data
-    title = request_json.get('title')
-    if not title:
-        return {"error": "Title is required for prediction."}, 400
+        with cache_lock:
+            for key in missing:
+                show_types[key] = found.get(key)
+                show_type_cache[key] = (show_types[key], now + METADATA_TTL_SECONDS)
+    return show_types
 
-    # Query to determine if the title is a movie or a show
-    query = f"""
-    SELECT showType FROM ba882_project.stage.netflix_api WHERE LOWER(title) = LOWER('{title}')
-    """
-    result_df = md.sql(query).df()
+def lookup_show_type(title):
+    """Return the showType of a title (None when it is not in the catalog), cached with a TTL"""
+    return lookup_show_types([title])[title.lower()]
 
-    if result_df.empty:
-        return {"error": f"Title '{title}' not found in the database."}, 404
+def latest_run_id(runs_table):
+    """Lightweight version check: the job_id of the newest run in the runs table"""
+    result = md.sql(f"SELECT job_id FROM {runs_table} ORDER BY created_at DESC LIMIT 1").fetchone()
+    return result[0] if result else None
 
-    show_type = result_df['showType'][0]
-    print(f"Title '{title}' is identified as a '{show_type}'.")
+def best_model_info(show_type, metrics_table, runs_table):
+    """
+    Return the metrics row and model_path of the best model for a showType (None when no model is found).
+    The result is trusted for METADATA_TTL_SECONDS; after that only the newest job_id in the runs table is
+    checked, and the best-model query is re-run only when a newer run has appeared.
+    """
+    now = time.monotonic()
+    with cache_lock:
+        cached = best_model_cache.get(show_type)
+    if cached and cached['expires_at'] > now:
+        return cached['model_info']
 
-    # Determine the appropriate table and fetch the best model based on showType
-    if show_type == "movie":
-        metrics_table = f"{db_schema}.movies_job_metrics"
-        runs_table = f"{db_schema}.movies_model_runs"
-        # model_name_filter = "%movie%"
-    elif show_type == "series":
-        metrics_table = f"{db_schema}.shows_job_metrics"
-        runs_table = f"{db_schema}.shows_model_runs"
-        # model_name_filter = "%show%"
-    else:
-        return {"error": f"Invalid showType '{show_type}' for title '{title}'."}, 400
+    latest_run = latest_run_id(runs_table)
+    if cached and cached['latest_run'] is not None and cached['latest_run'] == latest_run:
+        with cache_lock:
+            cached['expires_at'] = now + METADATA_TTL_SECONDS
+        return cached['model_info']
 
     # Query to fetch the best model for the given type (movie or show)
     sql_query = f"""
@@ -84,20 +130,197 @@ def task(request):
     """
     
     results = md.sql(sql_query).df()
-
     if results.empty:
-        return {"error": f"No trained model found for {show_type}."}, 404
+        return None
 
-    model_path = results['model_path'][0]
-    print(f"Fetching model from: {model_path}")
+    # Flatten for inclusion in the result
+    model_info = results.iloc[0].to_dict()
+    model_info['created_at'] = model_info['created_at'].isoformat()
 
-    # Load the model pipeline from GCS
-    with GCSFileSystem().open(model_path, 'rb') as f:
-        model_pipeline = joblib.load(f)
+    # The trainer writes the run before its metrics, so only remember the run as seen once its
+    # metrics are in; otherwise the next check re-runs the query to pick the new model up
+    with cache_lock:
+        best_model_cache[show_type] = {
+            'model_info': model_info,
+            'latest_run': latest_run if model_info['job_id'] == latest_run else None,
+            'expires_at': now + METADATA_TTL_SECONDS
+        }
+    return model_info
 
-    # Flatten for inclusion in the result
-    json_output = results.iloc[0].to_dict()
-    json_output['created_at'] = json_output['created_at'].isoformat()
+def load_model(job_id, model_path):
+    """
+    Return the model for a run, loading it from GCS only on a cache miss (LRU eviction within the memory budget).
+    The download runs outside cache_lock, under a per-model lock, so a cold load only holds up the requests
+    that need that same model.
+    """
+    global model_cache_bytes
+    key = (job_id, model_path)
+    with cache_lock:
+        if key in model_cache:
+            model_cache.move_to_end(key)
+            return model_cache[key][0], True
+        load_lock = model_load_locks.setdefault(key, threading.Lock())
+
+    with load_lock:
+        # Another request may have loaded it while we waited for the lock
+        with cache_lock:
+            if key in model_cache:
+                model_cache.move_to_end(key)
+                return model_cache[key][0], True
+
+        try:
+            print(f"Fetching model from: {model_path}")
+
+            # Load the model pipeline from GCS
+            with GCSFileSystem().open(model_path, 'rb') as f:
+                payload = f.read()
+            model_pipeline = joblib.load(io.BytesIO(payload))
+
+            # Publish it, evicting the least recently used models until the new one fits
+            size_bytes = len(payload)
+            with cache_lock:
+                while model_cache and (len(model_cache) >= MODEL_CACHE_MAX_ENTRIES or
+                                       model_cache_bytes + size_bytes > MODEL_CACHE_MAX_MB * 2**20):
+                    evicted_key, (_, evicted_bytes) = model_cache.popitem(last=False)
+                    model_cache_bytes -= evicted_bytes
+                    print(f"Evicted model {evicted_key[0]} from the cache")
+
+                model_cache[key] = (model_pipeline, size_bytes)
+                model_cache_bytes += size_bytes
+        finally:
+            with cache_lock:
+                model_load_locks.pop(key, None)
+        return model_pipeline, False
+
+def predict_batch(items):
+    """
+    Batch mode: resolve the showTypes of all titles with one query, group the items by model and
+    run one predict call per model over the concatenated data of its items.
+    """
+    start = time.perf_counter()
+    results = [None] * len(items)
+
+    # Validate the items
+    valid = []
+    for i, item in enumerate(items):
+        title = item.get('title') if isinstance(item, dict) else None
+        data_list = item.get('data') if isinstance(item, dict) else None
+        if not title or not isinstance(title, str):
+            results[i] = {"error": "A non-empty string 'title' is required for prediction."}
+        elif not data_list or not isinstance(data_list, list):
+            results[i] = {"title": title, "error": "A valid 'data' list is required for prediction."}
+        else:
+            valid.append(i)
+
+    # Resolve every showType at once and group the items by showType
+    show_types = lookup_show_types([items[i]['title'] for i in valid])
+    groups = {}
+    for i in valid:
+        title = items[i]['title']
+        show_type = show_types[title.lower()]
+        if show_type is None:
+            results[i] = {"title": title, "error": f"Title '{title}' not found in the database."}
+        elif show_type not in MODEL_TABLES:
+            results[i] = {"title": title, "error": f"Invalid showType '{show_type}' for title '{title}'."}
+        else:
+            groups.setdefault(show_type, []).append(i)
+
+    # One vectorized inference per model
+    models = {}
+    for show_type, group in groups.items():
+        model_info = best_model_info(show_type, *MODEL_TABLES[show_type])
+        if model_info is None:
+            for i in group:
+                results[i] = {"title": items[i]['title'], "error": f"No trained model found for {show_type}."}
+            continue
+
+        model_pipeline, cache_hit = load_model(model_info['job_id'], model_info['model_path'])
+        models[show_type] = {'model_info': model_info, 'model_cache': 'hit' if cache_hit else 'miss', 'titles': len(group)}
+
+        batch = [row for i in group for row in items[i]['data']]
+        try:
+            preds_list = model_pipeline.predict(batch).tolist()
+        except Exception as e:
+            # Some item's data is malformed: predict the items one by one so only the bad ones fail
+            print(f"Batch predict for {show_type} failed ({e!r}), predicting the {len(group)} items one by one")
+            for i in group:
+                try:
+                    results[i] = {
+                        'title': items[i]['title'],
+                        'showType': show_type,
+                        'predictions': model_pipeline.predict(items[i]['data']).tolist()
+                    }
+                except Exception as e:
+                    results[i] = {"title": items[i]['title'], "error": f"Prediction failed: {e}"}
+            continue
+
+        # Split the predictions back per item
+        offset = 0
+        for i in group:
+            n = len(items[i]['data'])
+            results[i] = {
+                'title': items[i]['title'],
+                'showType': show_type,
+                'predictions': preds_list[offset:offset + n]
+            }
+            offset += n
+
+    elapsed = time.perf_counter() - start
+    print(f"Batch of {len(items)} titles predicted in {elapsed:.3f}s")
+
+    return {
+        'results': results,
+        'models': models,
+        'n_titles': len(items),
+        'elapsed_ms': round(elapsed * 1000, 1),
+        'titles_per_second': round(len(items) / elapsed, 1) if elapsed > 0 else None
+    }, 200
+
+@functions_framework.http
+def task(request):
+    """
+    Fetch model information and make predictions based on the title provided.
+    A list of {'title', 'data'} items under 'items' is predicted in batch mode.
+    """
+
+    # Parse the request data
+    request_json = request.get_json(silent=True)
+    print(request_json)
+
+    if not request_json:
+        return {"error": "A JSON body is required for prediction."}, 400
+
+    # Batch mode: many titles in one invocation
+    if 'items' in request_json:
+        items = request_json['items']
+        if not isinstance(items, list) or not items:
+            return {"error": "A non-empty 'items' list is required for batch prediction."}, 400
+        return predict_batch(items)
+
+    # Extract the title from the input data
+    title = request_json.get('title')
+    if not title or not isinstance(title, str):
+        return {"error": "A non-empty string 'title' is required for prediction."}, 400
+
+    # Determine if the title is a movie or a show
+    show_type = lookup_show_type(title)
+
+    if show_type is None:
+        return {"error": f"Title '{title}' not found in the database."}, 404
+
+    print(f"Title '{title}' is identified as a '{show_type}'.")
+
+    # Determine the appropriate table and fetch the best model based on showType
+    if show_type not in MODEL_TABLES:
+        return {"error": f"Invalid showType '{show_type}' for title '{title}'."}, 400
+
+    json_output = best_model_info(show_type, *MODEL_TABLES[show_type])
+
+    if json_output is None:
+        return {"error": f"No trained model found for {show_type}."}, 404
+
+    # Load the model pipeline (from the process cache when this run was already loaded)
+    model_pipeline, cache_hit = load_model(json_output['job_id'], json_output['model_path'])
 
     # Prepare data for prediction (based on input data key)
     data_list = request_json.get('data')
@@ -116,6 +339,7 @@ def task(request):
     return {
         'predictions': preds_list,
         'model_info': json_output,
+        'model_cache': 'hit' if cache_hit else 'miss',
         'title': title,
         'showType': show_type,
         'data': data_list
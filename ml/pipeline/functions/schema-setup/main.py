@@ -1,5 +1,6 @@
 # imports
 import functions_framework
+import os
 from google.cloud import secretmanager
 import duckdb
 import datetime
@@ -15,21 +16,33 @@ db = 'ba882_project'
 schema = "mlops"
 db_schema = f"{db}.{schema}"
 
-@functions_framework.http
-def task(request):
-    # Generate unique job ID
-    job_id = datetime.datetime.now().strftime("%Y%m%d%H%M") + "-" + str(uuid.uuid4())
+# Local mode for offline runs: DUCKDB_PATH points at a local DuckDB file named after the database
+# (e.g. /data/ba882_project.duckdb) that stands in for MotherDuck
+DUCKDB_PATH = os.environ.get('DUCKDB_PATH')
 
-    # Instantiate the Secret Manager client
-    sm = secretmanager.SecretManagerServiceClient()
+def connect_warehouse():
+    """DuckDB connection to the warehouse: the local file in local mode, else MotherDuck"""
+    if DUCKDB_PATH:
+        if os.path.splitext(os.path.basename(DUCKDB_PATH))[0] != db:
+            raise ValueError(f"DUCKDB_PATH must point at a file named {db}.duckdb")
+        return duckdb.connect(DUCKDB_PATH)
 
-    # Access secret for MotherDuck token
+    # Access the MotherDuck token in Secret Manager
+    sm = secretmanager.SecretManagerServiceClient()
     name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
     response = sm.access_secret_version(request={"name": name})
     md_token = response.payload.data.decode("UTF-8")
 
-    # Establish a connection to MotherDuck
-    md = duckdb.connect(f'md:?motherduck_token={md_token}')
+    # initiate the MotherDuck connection through an access token
+    return duckdb.connect(f'md:?motherduck_token={md_token}')
+
+@functions_framework.http
+def task(request):
+    # Generate unique job ID
+    job_id = datetime.datetime.now().strftime("%Y%m%d%H%M") + "-" + str(uuid.uuid4())
+
+    # Establish a connection to MotherDuck (or the local DuckDB file in local mode)
+    md = connect_warehouse()
 
     # Create the schema if it doesn’t exist
     md.sql(f"CREATE SCHEMA IF NOT EXISTS {db_schema};")
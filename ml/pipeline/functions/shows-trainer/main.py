@@ -9,14 +9,14 @@ import joblib
 import json
 import uuid
 import datetime
+import time
 from gcsfs import GCSFileSystem
-from sklearn.feature_extraction.text import TfidfVectorizer
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
 from sklearn.neighbors import NearestNeighbors
-from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import StandardScaler, normalize
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import average_precision_score
-from sklearn.metrics.pairwise import cosine_similarity
-from google.cloud import storage, secretmanager
+from google.cloud import secretmanager
 import duckdb
 
 # db setup
@@ -32,6 +32,38 @@ gcp_region = 'us-central1'
 
 ###################################################### helpers
 
+# Local mode for offline runs: DUCKDB_PATH points at a local DuckDB file named after the database
+# (e.g. /data/ba882_project.duckdb) that stands in for MotherDuck
+DUCKDB_PATH = os.environ.get('DUCKDB_PATH')
+
+def connect_warehouse():
+    """DuckDB connection to the warehouse: the local file in local mode, else MotherDuck"""
+    if DUCKDB_PATH:
+        if os.path.splitext(os.path.basename(DUCKDB_PATH))[0] != db:
+            raise ValueError(f"DUCKDB_PATH must point at a file named {db}.duckdb")
+        return duckdb.connect(DUCKDB_PATH)
+
+    # Access the MotherDuck token in Secret Manager
+    sm = secretmanager.SecretManagerServiceClient()
+    name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
+    response = sm.access_secret_version(request={"name": name})
+    md_token = response.payload.data.decode("UTF-8")
+
+    # initiate the MotherDuck connection through an access token
+    return duckdb.connect(f'md:?motherduck_token={md_token}')
+
+# Local mode for offline runs: LOCAL_BUCKET_DIR is a directory standing in for GCS
+LOCAL_BUCKET_DIR = os.environ.get('LOCAL_BUCKET_DIR')
+
+def open_gcs_file(path, mode='rb'):
+    """Open a gs:// path, or the matching file under LOCAL_BUCKET_DIR in local mode"""
+    if LOCAL_BUCKET_DIR:
+        local_path = os.path.join(LOCAL_BUCKET_DIR, path.replace('gs://', '', 1))
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        return open(local_path, mode)
+    return GCSFileSystem().open(path, mode)
+
 def load_sql(p):
     with open(p, "r") as f:
         sql = f.read()
@@ -42,6 +74,161 @@ def preprocess_field(field):
         return ' '.join([item.strip().strip("'\"") for item in field.strip('[]').split(',')])
     return ''
 
+def build_features(tfidf_matrix, count_features, numeric_weight=1.0):
+    """Append the scaled count columns to the TF-IDF matrix as a weighted sparse block (CSR)"""
+    count_block = sparse.csr_matrix(np.asarray(count_features, dtype=tfidf_matrix.dtype) * numeric_weight)
+    return sparse.hstack((tfidf_matrix, count_block), format='csr')
+
+def row_sq_norms(m):
+    """Row-wise squared L2 norms for dense or sparse matrices"""
+    sq = m.multiply(m).sum(axis=1) if sparse.issparse(m) else np.square(m).sum(axis=1)
+    return np.asarray(sq).ravel()
+
+def evaluate_recommendations(knn, features, genres, k, coverage_k=None):
+    """
+    Score MAP@K, Coverage and Intra-list Similarity from a single batched kneighbors call.
+    Every training row is queried at once and all three metrics are derived from the
+    shared neighbor index matrix (column 0 is the query item itself and is dropped).
+    """
+    coverage_k = coverage_k or k
+    n_samples = features.shape[0]
+    if n_samples == 0:
+        return {'map_at_k': 0, 'coverage': 0, 'intra_list_similarity': 0}
+
+    # One brute-force pass over the catalog for every row
+    _, indices = knn.kneighbors(features)
+    recs = indices[:, 1:k + 1]
+    n_recs = recs.shape[1]
+
+    # MAP@K: a neighbor is relevant when it shares at least one genre token with the query
+    try:
+        genre_matrix = CountVectorizer(binary=True, lowercase=False, tokenizer=str.split, token_pattern=None).fit_transform(genres)
+    except ValueError:
+        # empty vocabulary: no title has a genre, so nothing is relevant (MAP@K is 0)
+        genre_matrix = None
+    if genre_matrix is None:
+        relevance = np.zeros((n_samples, n_recs))
+    else:
+        query_rows = genre_matrix[np.repeat(np.arange(n_samples), n_recs)]
+        rec_rows = genre_matrix[recs.ravel()]
+        relevance = (np.asarray(query_rows.multiply(rec_rows).sum(axis=1)).reshape(n_samples, n_recs) > 0).astype(float)
+
+    # Average precision with rank-ordered scores = mean precision@i over the relevant positions
+    n_relevant = relevance.sum(axis=1)
+    precision_at_i = np.cumsum(relevance, axis=1) / np.arange(1, n_recs + 1)
+    ap = np.divide((precision_at_i * relevance).sum(axis=1), n_relevant, out=np.zeros(n_samples), where=n_relevant > 0)
+    map_at_k = ap.sum() / n_samples
+
+    # Coverage: share of the catalog that shows up in at least one recommendation list
+    coverage = len(np.unique(indices[:, 1:coverage_k + 1])) / n_samples
+
+    # Intra-list Similarity: with unit rows, the sum of a list's cosine matrix is ||sum of its rows||^2,
+    # so summing the recommended rows through a sparse selection matrix gives every list at once
+    intra_list_similarity = 0
+    if n_recs > 1:
+        unit_features = normalize(features)
+        selector = sparse.csr_matrix(
+            (np.ones(recs.size), recs.ravel(), np.arange(0, recs.size + 1, n_recs)),
+            shape=(n_samples, n_samples)
+        )
+        list_sums = selector @ unit_features
+        similarity_sum = (row_sq_norms(list_sums) - n_recs) / 2  # Exclude self-similarities
+        avg_similarity_within_list = similarity_sum / (n_recs * (n_recs - 1) / 2)
+        intra_list_similarity = avg_similarity_within_list.mean()
+
+    return {
+        'map_at_k': float(map_at_k),
+        'coverage': float(coverage),
+        'intra_list_similarity': float(intra_list_similarity)
+    }
+
+def lsh_codes(features, hyperplanes, n_bits):
+    """Hash rows to one integer bucket code per table with signed random projections, shape (tables, rows)"""
+    bits = np.asarray(features @ hyperplanes.T) > 0
+    bits = bits.reshape(features.shape[0], -1, n_bits)
+    return (bits * (1 << np.arange(n_bits))).sum(axis=2).T
+
+def build_lsh_index(features, n_tables=16, n_bits=8, seed=42):
+    """
+    Random-projection LSH index for cosine search, kept as plain arrays (no custom classes).
+    The pipeline trainers save it with np.savez next to the model; the knn-train functions
+    write its arrays into model.bundle, where the serve functions memory-map them.
+    """
+    rng = np.random.default_rng(seed)
+    hyperplanes = rng.standard_normal((n_tables * n_bits, features.shape[1])).astype(np.float32)
+    codes = lsh_codes(features, hyperplanes, n_bits)
+    order = np.argsort(codes, axis=1, kind='stable')
+    catalog = sparse.csr_matrix(normalize(features), dtype=np.float32)
+    return {
+        'hyperplanes': hyperplanes,
+        'n_bits': np.array(n_bits),
+        'order': order.astype(np.int32),
+        'sorted_codes': np.take_along_axis(codes, order, axis=1),
+        'data': catalog.data,
+        'indices': catalog.indices,
+        'indptr': catalog.indptr,
+        'shape': np.array(catalog.shape)
+    }
+
+def load_lsh_index(arrays):
+    """Rebuild the queryable index (with the normalized catalog matrix) from its saved arrays"""
+    ann_index = {name: arrays[name] for name in ('hyperplanes', 'order', 'sorted_codes')}
+    ann_index['n_bits'] = int(arrays['n_bits'])
+    ann_index['catalog'] = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(arrays['shape']))
+    return ann_index
+
+def lsh_kneighbors(ann_index, features, k, knn):
+    """
+    Drop-in for knn.kneighbors backed by the LSH index. Candidates are the union of the
+    query's buckets over all tables, re-ranked by exact cosine distance; queries that
+    collect fewer than k candidates fall back to the exact model.
+    """
+    n_queries = features.shape[0]
+    codes = lsh_codes(features, ann_index['hyperplanes'], ann_index['n_bits'])
+    queries = sparse.csr_matrix(normalize(features), dtype=np.float32)
+    order, sorted_codes, catalog = ann_index['order'], ann_index['sorted_codes'], ann_index['catalog']
+
+    distances = np.empty((n_queries, k))
+    indices = np.empty((n_queries, k), dtype=np.intp)
+    fallback = []
+    for i in range(n_queries):
+        buckets = []
+        for t in range(codes.shape[0]):
+            lo, hi = np.searchsorted(sorted_codes[t], [codes[t, i], codes[t, i] + 1])
+            buckets.append(order[t, lo:hi])
+        candidates = np.unique(np.concatenate(buckets))
+        if len(candidates) < k:
+            fallback.append(i)
+            continue
+        sims = (catalog[candidates] @ queries[i].T).toarray().ravel()
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top], kind='stable')]
+        indices[i] = candidates[top]
+        distances[i] = 1 - sims[top]
+
+    if fallback:
+        distances[fallback], indices[fallback] = knn.kneighbors(features[fallback], n_neighbors=k)
+    return distances, indices
+
+def ann_recall_at_k(knn, ann_index, features, k, sample_size=200, seed=42):
+    """Recall@K of the LSH index against brute force on a sample of rows, with single-query latency of both"""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(features.shape[0], size=min(sample_size, features.shape[0]), replace=False)
+    exact, approx = [], []
+
+    start = time.perf_counter()
+    for row in rows:
+        exact.append(knn.kneighbors(features[row:row + 1], n_neighbors=k)[1][0])
+    brute_ms = (time.perf_counter() - start) * 1000 / len(rows)
+
+    start = time.perf_counter()
+    for row in rows:
+        approx.append(lsh_kneighbors(ann_index, features[row:row + 1], k, knn)[1][0])
+    ann_ms = (time.perf_counter() - start) * 1000 / len(rows)
+
+    hits = sum(len(np.intersect1d(e, a)) for e, a in zip(exact, approx))
+    return {'recall_at_k': hits / (len(rows) * k), 'ann_ms_per_query': ann_ms, 'brute_ms_per_query': brute_ms}
+
 ###################################################### task
 
 @functions_framework.http
@@ -49,20 +236,11 @@ def task(request):
     # Job ID for tracking
     job_id = datetime.datetime.now().strftime("%Y%m%d%H%M") + "-" + str(uuid.uuid4())
 
-    # Instantiate services
-    sm = secretmanager.SecretManagerServiceClient()
-    storage_client = storage.Client()
-
-    # Secret token retrieval for DuckDB connection
-    name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
-    response = sm.access_secret_version(request={"name": name})
-    md_token = response.payload.data.decode("UTF-8")
-
-    # Database connection
-    md = duckdb.connect(f'md:?motherduck_token={md_token}')
+    # Database connection (MotherDuck, or the local DuckDB file in local mode)
+    md = connect_warehouse()
 
     # Dataset loading from GCS or SQL query
-    sql = load_sql("dataset.sql")
+    sql = load_sql(os.path.join(os.path.dirname(__file__), "dataset.sql"))
     df = md.sql(sql).df()
 
     # Model preprocessing: Filter shows and preprocess fields of interest
@@ -92,8 +270,17 @@ def task(request):
     # Model parameters with default values
     n_neighbors = request_json.get('n_neighbors', 10)
     metric = request_json.get('metric', 'cosine')
+    ann = request_json.get('ann', 'brute')  # 'brute' (exact) or 'lsh' (approximate, cosine only)
+    lsh_tables = int(request_json.get('lsh_tables', 16))
+    lsh_bits = int(request_json.get('lsh_bits', 8))
+    numeric_weight = float(request_json.get('numeric_weight', 1.0))
     model_name = 'KNearestNeighbors'
 
+    if ann not in ('brute', 'lsh'):
+        return {"error": f"Unsupported ann backend '{ann}', expected 'brute' or 'lsh'."}, 400
+    if ann == 'lsh' and metric != 'cosine':
+        return {"error": "The 'lsh' ann backend only supports the cosine metric."}, 400
+
     # Train/Test Split and Model Training
     train_set = df_show.copy()
 
@@ -107,12 +294,12 @@ def task(request):
     # Scale numeric features
     scaler = StandardScaler()
     count_features_train = scaler.fit_transform(train_set[['episodeCount', 'seasonCount']])
-    count_features_train_df = pd.DataFrame(count_features_train, columns=['episodeCount', 'seasonCount'])
 
-    features_train = np.hstack((tfidf_matrix_train.toarray(), count_features_train_df.values))
+    # Keep the feature matrix sparse end to end, the count columns are a small weighted block
+    features_train = build_features(tfidf_matrix_train, count_features_train, numeric_weight)
 
-    # KNN model training
-    knn = NearestNeighbors(n_neighbors=n_neighbors, metric=metric)
+    # KNN model training (brute force search runs directly on the CSR matrix)
+    knn = NearestNeighbors(n_neighbors=n_neighbors, metric=metric, algorithm='brute')
     knn.fit(features_train)
 
     # Save models to GCS
@@ -122,106 +309,34 @@ def task(request):
     V_GCS = f"gs://{GCS_BUCKET}/{GCS_PATH_MODEL}/model/vectorizer.joblib"
     S_GCS = f"gs://{GCS_BUCKET}/{GCS_PATH_MODEL}/model/scaler.joblib"
 
-    with GCSFileSystem().open(M_GCS, 'wb') as f:
+    with open_gcs_file(M_GCS, 'wb') as f:
         joblib.dump(knn, f)
-    with GCSFileSystem().open(V_GCS, 'wb') as f:
+    with open_gcs_file(V_GCS, 'wb') as f:
         joblib.dump(vectorizer, f)
-    with GCSFileSystem().open(S_GCS, 'wb') as f:
+    with open_gcs_file(S_GCS, 'wb') as f:
         joblib.dump(scaler, f)
 
+    # Optional ANN index, saved next to the KNN model
+    A_GCS = None
+    if ann == 'lsh':
+        A_GCS = f"gs://{GCS_BUCKET}/{GCS_PATH_MODEL}/model/ann_index.npz"
+        ann_arrays = build_lsh_index(features_train, n_tables=lsh_tables, n_bits=lsh_bits)
+        with open_gcs_file(A_GCS, 'wb') as f:
+            np.savez(f, **ann_arrays)
+
     ###################################################### Metrics Calculation
 
-    # Metric 1: MAP@K (Mean Average Precision at K)
-    def calculate_map_at_k(knn, vectorizer, scaler, train_set, k=n_neighbors):
-        total_ap = 0
-        n_samples = len(train_set)
-        for idx, row in train_set.iterrows():
-            # Combine text and numeric features
-            text_features = vectorizer.transform([row['text_features']])
-            count_features = scaler.transform(pd.DataFrame([[row['episodeCount'], row['seasonCount']]], columns=['episodeCount', 'seasonCount']))
-            input_features = np.hstack((text_features.toarray(), count_features))
-
-            # Get the distances and indices of the k-neighbors
-            distances, indices = knn.kneighbors(input_features)
-
-            # Get the genres of the current show and recommended shows
-            current_genres = set(row['genres'].split())
-            recommended_genres = [set(train_set.iloc[i]['genres'].split()) for i in indices.flatten()[1:k+1]]
-
-            # Calculate relevance scores (1 if genres overlap, 0 otherwise)
-            relevance = [1 if current_genres.intersection(rec_genres) else 0 for rec_genres in recommended_genres]
-
-            # Skip if there are no positive labels
-            if sum(relevance) == 0:
-                continue
-
-            # Calculate average precision for this sample
-            ap = average_precision_score(relevance, [1/(i+1) for i in range(len(relevance))])
-            total_ap += ap
-
-        # Avoid division by zero
-        map_at_k = total_ap / n_samples if n_samples > 0 else 0
-        return map_at_k
-
-    map_at_k = calculate_map_at_k(knn, vectorizer, scaler, train_set)
-
-    # Metric 2: Coverage Calculation
-    def calculate_coverage(knn, vectorizer, scaler, train_set, k=10):
-        all_recommended_items = set()
-        total_items = set(train_set.index)
-        for idx, row in train_set.iterrows():
-            # Combine text and numeric features
-            text_features = vectorizer.transform([row['text_features']])
-            count_features = scaler.transform([[row['episodeCount'], row['seasonCount']]])
-            input_features = np.hstack((text_features.toarray(), count_features))
-
-            # Get nearest neighbors
-            distances, indices = knn.kneighbors(input_features)
-            recommended_items = set(indices.flatten()[1:k+1])  # Exclude the item itself and limit to k items
-            all_recommended_items.update(recommended_items)
-
-        # Calculate coverage
-        coverage = len(all_recommended_items) / len(total_items)
-        return coverage
-
-    coverage = calculate_coverage(knn, vectorizer, scaler, train_set)
-
-    # Metric 3: Intra-list Similarity Calculation
-    def calculate_intra_list_similarity(knn, vectorizer, scaler, train_set, k=n_neighbors):
-        total_similarity = 0
-        count = 0
-        for idx, row in train_set.iterrows():
-            # Get features of the current show
-            input_features_text = vectorizer.transform([row['text_features']])
-            input_features_numeric = scaler.transform(pd.DataFrame([[row['episodeCount'], row['seasonCount']]], columns=['episodeCount', 'seasonCount']))
-            input_features_combined = np.hstack((input_features_text.toarray(), input_features_numeric))
-
-            distances, indices = knn.kneighbors(input_features_combined)
-            recommended_items_indices = indices.flatten()[1:k+1]  # Exclude the item itself and limit to k items
-
-            if len(recommended_items_indices) > 1:
-                # Get text features of recommended shows
-                recommended_features_text = vectorizer.transform(train_set.iloc[recommended_items_indices]['text_features'])
-                # Get count features of recommended shows
-                recommended_features_numeric = scaler.transform(train_set.iloc[recommended_items_indices][['episodeCount', 'seasonCount']])
-                # Combine text and count features
-                recommended_features_combined = np.hstack((recommended_features_text.toarray(), recommended_features_numeric))
-
-                similarity_matrix = cosine_similarity(recommended_features_combined)
-
-                # Calculate average similarity within the list
-                n_recommendations = similarity_matrix.shape[0]
-                similarity_sum = (similarity_matrix.sum() - n_recommendations) / 2  # Exclude self-similarities
-                avg_similarity_within_list = similarity_sum / (n_recommendations * (n_recommendations - 1) / 2)
-
-                total_similarity += avg_similarity_within_list
-                count += 1
-
-        # Calculate intra-list similarity
-        intra_list_similarity = total_similarity / count if count > 0 else 0
-        return intra_list_similarity
-
-    intra_list_similarity = calculate_intra_list_similarity(knn, vectorizer, scaler, train_set)
+    # All three metrics share one batched neighbor query over the training features
+    metrics = evaluate_recommendations(knn, features_train, train_set['genres'], k=n_neighbors, coverage_k=10)
+    map_at_k = metrics['map_at_k']
+    coverage = metrics['coverage']
+    intra_list_similarity = metrics['intra_list_similarity']
+
+    # ANN accuracy/latency trade-off against the exact brute-force search
+    ann_metrics = None
+    if ann == 'lsh':
+        ann_metrics = ann_recall_at_k(knn, load_lsh_index(ann_arrays), features_train, k=n_neighbors)
+        print(f"ANN metrics: {ann_metrics}")
 
     ###################################################### Store Model Runs
     insert_query = f"""
@@ -240,14 +355,27 @@ def task(request):
         {'job_id': job_id, 'metric_name': 'Coverage', 'metric_value': coverage, 'created_at': ingest_timestamp},
         {'job_id': job_id, 'metric_name': 'Intra-list Similarity', 'metric_value': intra_list_similarity, 'created_at': ingest_timestamp}
     ]
+    if ann_metrics:
+        metrics_df_data += [
+            {'job_id': job_id, 'metric_name': 'Recall@K', 'metric_value': ann_metrics['recall_at_k'], 'created_at': ingest_timestamp},
+            {'job_id': job_id, 'metric_name': 'ANN ms/query', 'metric_value': ann_metrics['ann_ms_per_query'], 'created_at': ingest_timestamp},
+            {'job_id': job_id, 'metric_name': 'Brute ms/query', 'metric_value': ann_metrics['brute_ms_per_query'], 'created_at': ingest_timestamp}
+        ]
     metrics_df = pd.DataFrame(metrics_df_data)
     md.sql(f"INSERT INTO {db_schema}.shows_job_metrics SELECT * FROM metrics_df")
 
     ###################################################### Record Parameters in Database
     params_df_data = [
         {"job_id": job_id, "parameter_name": "k", "parameter_value": n_neighbors, "created_at": ingest_timestamp},
-        {"job_id": job_id, "parameter_name": "metric", "parameter_value": metric, "created_at": ingest_timestamp}
+        {"job_id": job_id, "parameter_name": "metric", "parameter_value": metric, "created_at": ingest_timestamp},
+        {"job_id": job_id, "parameter_name": "numeric_weight", "parameter_value": numeric_weight, "created_at": ingest_timestamp},
+        {"job_id": job_id, "parameter_name": "ann", "parameter_value": ann, "created_at": ingest_timestamp}
     ]
+    if ann == 'lsh':
+        params_df_data += [
+            {"job_id": job_id, "parameter_name": "lsh_tables", "parameter_value": lsh_tables, "created_at": ingest_timestamp},
+            {"job_id": job_id, "parameter_name": "lsh_bits", "parameter_value": lsh_bits, "created_at": ingest_timestamp}
+        ]
     params_df = pd.DataFrame(params_df_data)
     md.sql(f"INSERT INTO {db_schema}.shows_job_parameters SELECT * FROM params_df")
 
@@ -260,8 +388,12 @@ def task(request):
         "model_path": M_GCS,
         "vectorizer_path": V_GCS,
         "scaler_path": S_GCS,
+        "ann_path": A_GCS,
+        "ann_metrics": ann_metrics,
         "parameters": {
             "k": n_neighbors,
-            "metric": metric
+            "metric": metric,
+            "numeric_weight": numeric_weight,
+            "ann": ann
         }
     }, 200
\ No newline at end of file
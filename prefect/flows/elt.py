@@ -60,10 +60,19 @@ def extract_youtube():
 def load_all_data(netflix_payload, top10_payload, youtube_payload):
     """Load all data into the database"""
     url = "https://us-central1-ba882-inclass-project.cloudfunctions.net/load-all-data"
+    # Exact job file of each dataset (None when an extractor had nothing new), so the loader
+    # does not have to look them up
+    paths = {
+        "netflix_api": netflix_payload.get("filepath"),
+        "youtube_api": youtube_payload.get("filepath")
+    }
+    for dataset, result in top10_payload.get("results", {}).items():
+        paths[dataset] = result.get("filepath")
     payload = {
         "netflix": netflix_payload,
         "top10": top10_payload,
-        "youtube": youtube_payload
+        "youtube": youtube_payload,
+        "paths": paths
     }
     resp = invoke_gcf(url, payload=payload)
     return resp
@@ -97,7 +106,10 @@ def elt_flow():
     load_result = load_all_data(netflix_result.result(), top10_result.result(), youtube_result.result())
     
     print("Data loaded into the database")
-    
+    print(f"Load finished in {load_result.get('elapsed_s')}s")
+    for dataset, timings in load_result.get("datasets", {}).items():
+        print(f"{dataset}: {timings}")
+
 # Run the ETL flow
 if __name__ == "__main__":
     elt_flow()
\ No newline at end of file
@@ -1,8 +1,8 @@
 # create/update a view to associate content length to the title for a regression task
 
 import functions_framework
+import os
 from google.cloud import secretmanager
-from google.cloud import storage
 from google.cloud import aiplatform
 import duckdb
 import pandas as pd
@@ -26,6 +26,28 @@ ml_view_name = "netflix_ml"
 
 ############################################################### helpers
 
+# Local mode for offline runs: DUCKDB_PATH points at a local DuckDB file named after the database
+# (e.g. /data/ba882_project.duckdb) that stands in for MotherDuck, LOCAL_BUCKET_DIR a directory
+# standing in for GCS
+DUCKDB_PATH = os.environ.get('DUCKDB_PATH')
+LOCAL_BUCKET_DIR = os.environ.get('LOCAL_BUCKET_DIR')
+
+def connect_warehouse():
+    """DuckDB connection to the warehouse: the local file in local mode, else MotherDuck"""
+    if DUCKDB_PATH:
+        if os.path.splitext(os.path.basename(DUCKDB_PATH))[0] != db:
+            raise ValueError(f"DUCKDB_PATH must point at a file named {db}.duckdb")
+        return duckdb.connect(DUCKDB_PATH)
+
+    # Access the MotherDuck token in Secret Manager
+    sm = secretmanager.SecretManagerServiceClient()
+    name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
+    response = sm.access_secret_version(request={"name": name})
+    md_token = response.payload.data.decode("UTF-8")
+
+    # initiate the MotherDuck connection through an access token
+    return duckdb.connect(f'md:?motherduck_token={md_token}')
+
 ## define the SQL
 ml_view_sql = f"""
 CREATE OR REPLACE VIEW {ml_schema}.{ml_view_name} AS
@@ -38,16 +60,9 @@ from {stage_db_schema}.netflix_api;
 @functions_framework.http
 def task(request):
 
-    # instantiate the services 
-    sm = secretmanager.SecretManagerServiceClient()
-    storage_client = storage.Client()
-
-    # connect to motherduck, the cloud datawarehouse
+    # connect to motherduck, the cloud datawarehouse (or the local DuckDB file in local mode)
     print("connecting to Motherduck")
-    name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
-    response = sm.access_secret_version(request={"name": name})
-    md_token = response.payload.data.decode("UTF-8")
-    md = duckdb.connect(f'md:?motherduck_token={md_token}') 
+    md = connect_warehouse()
 
     # create the view
     print("creating the schema if it doesn't exist and creating/updating the view")
@@ -60,6 +75,9 @@ def task(request):
     # write the dataset to the training dataset path on GCS
     print("writing the csv file to gcs")
     dataset_path = "gcs://" + ml_bucket_name + ml_dataset_path + "netflix_data.csv"
+    if LOCAL_BUCKET_DIR:
+        dataset_path = os.path.join(LOCAL_BUCKET_DIR, ml_bucket_name + ml_dataset_path + "netflix_data.csv")
+        os.makedirs(os.path.dirname(dataset_path), exist_ok=True)
     df.to_csv(dataset_path, index=False)
 
     return {"dataset_path": dataset_path}, 200
\ No newline at end of file
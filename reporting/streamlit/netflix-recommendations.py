@@ -37,6 +37,7 @@ model = GenerativeModel("gemini-1.5-pro-001")
 # Define Cloud Run URLs
 MOVIE_CLOUD_RUN_URL = "https://us-central1-ba882-inclass-project.cloudfunctions.net/ml-movies-serve"
 TV_SHOW_CLOUD_RUN_URL = "https://us-central1-ba882-inclass-project.cloudfunctions.net/ml-shows-serve"
+GENAI_RETRIEVER_URL = "https://us-central1-ba882-inclass-project.cloudfunctions.net/genai-retriever"
 
 # Load Lottie animation
 def load_lottiefile(filepath: str):
@@ -99,6 +100,19 @@ def fetch_additional_data_from_motherduck(titles):
         return pd.DataFrame()
 
 
+# Semantic search over the overview embeddings: the catalog titles closest to a free-text request,
+# so the prompt only carries those instead of the whole catalog
+def retrieve_similar(query, content_type, top_k=25):
+    try:
+        response = requests.post(GENAI_RETRIEVER_URL, json={"query": query, "content_type": content_type, "top_k": top_k})
+        response.raise_for_status()
+        titles = [result["title"] for result in response.json()["results"]]
+    except requests.exceptions.RequestException as e:
+        st.error(f"Error retrieving similar titles: {e}")
+        return pd.DataFrame()
+    return fetch_additional_data_from_motherduck(titles)
+
+
 # Adding background img
 def load_background_image(image_file):
     with open(image_file, "rb") as f:
@@ -268,14 +282,14 @@ with tab1:
         # Text area for feedback
         feedback = st.text_area("What specifically are you looking for?", key='feedback')
 
-        # Fetch all the movie data
-        page = fetch_additional_data_from_motherduck(get_movies())
-
         # Put button in the expander
         search_button = st.button("Get New Recommendations", key='button1')
 
     if search_button:
         if feedback.strip():
+                # The movies whose overviews best match the request
+                page = retrieve_similar(f"{selected_movie}. {feedback}", 'movie')
+
                 prompt = f"""
                 Our Netflix movie data is here: {page}.
                 The user wants recommendations for shows similar to this one: {selected_movie}.
@@ -348,14 +362,14 @@ with tab2:
 
         feedback = st.text_area("What specifically are you looking for?", key='feedback1')
         
-        # Extract all show data (page)
-        page = fetch_additional_data_from_motherduck(get_tv_shows())
-        
         search_button = st.button("Get New Recommendations", key='button2')
         
     # When the user clicks the button for new recommendations
     if search_button:
         if feedback.strip():
+                # The shows whose overviews best match the request
+                page = retrieve_similar(f"{selected_show}. {feedback}", 'show')
+
                 prompt = f"""
                 Our Netflix show data is here: {page}.
                 The user wants recommendations for shows similar to this one: {selected_show}.